@@ -0,0 +1,152 @@
+import os
+import math
+import time
+import threading
+import functools
+from flask import request, make_response
+
+import store
+import metrics
+import job_queue
+
+# Requests admitted at the same time by one worker; the remaining threads stay free for
+# cheap requests such as /jobs/<id> polling and /metrics
+WORKER_IN_FLIGHT = int(os.getenv('GDOC_ADMISSION_WORKER_IN_FLIGHT', 12))
+# Documents queued or being generated across all workers before new ones are refused
+GLOBAL_IN_FLIGHT = int(os.getenv('GDOC_ADMISSION_GLOBAL_IN_FLIGHT', 1000))
+# Refuse new documents when the estimated wait before a worker starts them exceeds this
+TARGET_QUEUE_DELAY = float(os.getenv('GDOC_ADMISSION_TARGET_QUEUE_DELAY', 60))
+# Requests per minute (and burst) allowed from one client IP, and documents per minute for one IBO
+CLIENT_RATE = float(os.getenv('GDOC_ADMISSION_CLIENT_RATE', 120))
+CLIENT_BURST = float(os.getenv('GDOC_ADMISSION_CLIENT_BURST', 30))
+IBO_RATE = float(os.getenv('GDOC_ADMISSION_IBO_RATE', 6))
+IBO_BURST = float(os.getenv('GDOC_ADMISSION_IBO_BURST', 3))
+# Proxies in front of the app that append to X-Forwarded-For (Railway's router is one)
+TRUSTED_PROXIES = int(os.getenv('GDOC_TRUSTED_PROXIES', 1))
+# Completed jobs over this many seconds give the queue's drain rate
+RATE_WINDOW = 60
+# Assumed seconds per document before any job has finished in the window
+ASSUMED_JOB_SECONDS = 5
+# How long a worker reuses its queue delay estimate
+ESTIMATE_TTL = 1.0
+PRUNE_INTERVAL = 300
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS client_buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS client_buckets_updated_at ON client_buckets (updated_at)',
+]
+
+_slots = threading.BoundedSemaphore(WORKER_IN_FLIGHT)
+_estimate = (0, 0.0, 0)
+_estimate_lock = threading.Lock()
+_pruned_at = 0
+
+
+# Raised to turn a request away with 429 Too Many Requests
+class Rejected(Exception):
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+
+
+def client_ip():
+    route = request.access_route
+    if TRUSTED_PROXIES and request.headers.get('X-Forwarded-For') and len(route) >= TRUSTED_PROXIES:
+        return route[-TRUSTED_PROXIES]
+    return request.remote_addr or 'unknown'
+
+
+def _prune(db, now):
+    global _pruned_at
+    if now - _pruned_at < PRUNE_INTERVAL:
+        return
+    _pruned_at = now
+    # A bucket untouched this long has refilled completely and is the same as no row
+    db.execute('DELETE FROM client_buckets WHERE updated_at < ?', (now - PRUNE_INTERVAL,))
+
+
+# Take one request from a client's token bucket, shared by all workers
+def check_client(key, per_minute=CLIENT_RATE, burst=CLIENT_BURST):
+    if per_minute <= 0:
+        return
+    now = time.time()
+    rate = per_minute / 60
+    store.ensure_schema('client_buckets', SCHEMA)
+    with store.transaction() as db:
+        row = db.execute('SELECT tokens, updated_at FROM client_buckets WHERE key = ?', (key,)).fetchone()
+        tokens = burst if row is None else min(burst, row['tokens'] + (now - row['updated_at']) * rate)
+        allowed = tokens >= 1
+        db.execute(
+            'INSERT OR REPLACE INTO client_buckets (key, tokens, updated_at) VALUES (?, ?, ?)',
+            (key, tokens - 1 if allowed else tokens, now)
+        )
+        _prune(db, now)
+    if not allowed:
+        raise Rejected("Too many requests; slow down.", (1 - tokens) / rate, key.split(':', 1)[0])
+
+
+# Estimated seconds before a document queued now would start, from the backlog and how
+# fast the workers have been finishing jobs. Returns (seconds, unfinished jobs).
+def queue_delay():
+    global _estimate
+    computed_at, delay, unfinished = _estimate
+    if time.monotonic() - computed_at < ESTIMATE_TTL:
+        return delay, unfinished
+
+    with _estimate_lock:
+        backlog = job_queue.backlog()
+        finished = job_queue.finished_since(time.time() - RATE_WINDOW)
+        if backlog['queued'] == 0:
+            delay = 0.0
+        elif finished:
+            delay = backlog['queued'] / (finished / RATE_WINDOW)
+        else:
+            delay = backlog['queued'] * ASSUMED_JOB_SECONDS / max(1, backlog['running'])
+        unfinished = backlog['queued'] + backlog['running']
+        _estimate = (time.monotonic(), delay, unfinished)
+    return delay, unfinished
+
+
+# Refuse new work when the queue is too long to start it within TARGET_QUEUE_DELAY
+def check_queue():
+    delay, unfinished = queue_delay()
+    if unfinished >= GLOBAL_IN_FLIGHT:
+        raise Rejected("The document queue is full; try again shortly.", delay or ASSUMED_JOB_SECONDS, 'global')
+    if delay > TARGET_QUEUE_DELAY:
+        raise Rejected(
+            f"The document queue is {delay:.0f}s long; try again shortly.", delay - TARGET_QUEUE_DELAY, 'queue_delay'
+        )
+
+
+def _reject(e):
+    metrics.inc('gdoc_admission_rejected_total', endpoint=request.endpoint or 'unknown', reason=e.reason)
+    raise e
+
+
+# Decorator for routes that start Google work: holds one of this worker's in-flight slots
+# while the view runs (for a streamed response, until the server closes it) and rate
+# limits the client IP
+def admit(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _slots.acquire(blocking=False):
+            _reject(Rejected("The server is busy; try again shortly.", 1, 'worker'))
+        streamed = False
+        try:
+            check_client(f'ip:{client_ip()}')
+            response = make_response(view(*args, **kwargs))
+            if response.is_streamed:
+                response.call_on_close(_slots.release)
+                streamed = True
+            return response
+        except Rejected as e:
+            _reject(e)
+        finally:
+            if not streamed:
+                _slots.release()
+    return wrapper
@@ -341,42 +341,60 @@
 #     app.run(debug=True, host='0.0.0.0', port=int(port))
 import os
 import logging
-from flask import Flask, jsonify, request, redirect, session, url_for, render_template
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow, Flow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google.auth.transport.requests import Request
+from flask import Flask, jsonify, request, redirect, session, url_for, render_template, send_file, Response, stream_with_context, g
 from flask_cors import CORS
 from datetime import timedelta
+import io
 import json
-from flask_session import Session
+import time
+import hmac
+import click
+
+import logs
+import google_clients
+import credentials_manager
+import credential_pool
+import template_registry
+import doc_plan
+import docx_renderer
+import template_slimmer
+import job_queue
+import bulk
+import idempotency
+import ibo_documents
+import rate_scheduler
+import metrics
+import session_store
+import copy_pool
+import pipeline
+import roster
+import admission
+import profiler
+import export_cache
+import lifecycle
+
+# Structured logs written by a background thread; GDOC_LOG_LEVEL, GDOC_LOG_LEVELS and GDOC_LOG_SAMPLING tune them
+logs.init()
 
 # Initialize Flask app
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'your_secret_key')
 
 app.config.update(
-    SESSION_TYPE='filesystem',  # Use filesystem to store session data
-    SESSION_PERMANENT=True,
     SESSION_COOKIE_SAMESITE="Lax",  # Consider changing to Lax if None doesn't work
     SESSION_COOKIE_SECURE=True,
     PERMANENT_SESSION_LIFETIME=timedelta(minutes=60)
 )
-Session(app)
+# Signed cookie by default; GDOC_SESSION_BACKEND=sqlite or filesystem keeps sessions on the server
+session_store.init_app(app)
 
 CORS(app, resources={r"/*": {"origins": "*"}})
 
 
-print(os.getenv('FLASK_SECRETY_KEY'))
-
 # Scopes for Google Drive and Docs APIs
 SCOPES = ['https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/documents']
 
-# Set up logging for debugging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-
-token_file = 'token.json'
+token_file = credentials_manager.TOKEN_FILE
 logging.info("Checking for token.json")
 
 if os.path.exists(token_file):
@@ -384,6 +402,30 @@ if os.path.exists(token_file):
 else:
     logging.info("token.json not found, starting new OAuth flow")
 
+# 'copy' personalizes a server-side copy of the template master,
+# 'local' fills the .docx here and uploads the finished file in one create call
+RENDER_MODE = os.getenv('GDOC_RENDER_MODE', 'copy')
+# Times a document is started over with a fresh copy after a call that cannot be retried in place failed.
+# Background jobs do not retry these failures again (see job_queue._should_retry).
+PIPELINE_ATTEMPTS = int(os.getenv('GDOC_PIPELINE_ATTEMPTS', rate_scheduler.MAX_RETRIES + 1))
+TEMPLATE_FILE = 'ServiceLinkTemplate.docx'
+TEMPLATE_FILES = [TEMPLATE_FILE, 'ModifiedServiceLinkTemplate.docx']
+
+# Build the slimmed template at startup so the first request does not pay for it
+template_slimmer.slim_template(TEMPLATE_FILE)
+
+# Credentials are kept in memory and refreshed ahead of expiry by a background thread
+credential_manager = credentials_manager.CredentialManager(token_file, SCOPES)
+# Documents are spread over every Google identity that is authorized (token.json being one)
+identity_pool = credential_pool.CredentialPool(credential_manager, SCOPES)
+
+# Token for the admin endpoints (Authorization: Bearer <token> or ?token=); they are disabled when unset
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+def is_admin():
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip() or request.args.get('token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode())
+
 @app.before_request
 def before_request():
     if request.headers.get('X-Forwarded-Proto', 'http') == 'http':
@@ -392,75 +434,67 @@ def before_request():
     
 app.permanent_session_lifetime = timedelta(minutes=60)
 
-@app.before_request
-def make_session_permanent():
-    session.permanent = True
-
 @app.route('/')
 def index():
     return "Flask Backend is running"
 
 # Authenticate and return credentials
 def get_creds():
-    creds = None
-    token_file = 'token.json'
+    creds = credential_manager.get()
+    if not creds:
+        # Any other identity in the pool can create documents too
+        authorized = identity_pool.authorized()
+        creds = identity_pool.get(authorized[0]) if authorized else None
 
-    if os.path.exists(token_file):
-        creds = Credentials.from_authorized_user_file(token_file, SCOPES)
+    if not creds:
+        return start_oauth_flow()
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            # Use web-based OAuth flow with the correct redirect URI
-            client_config = {
-                "web": {
-                    "client_id": os.getenv('GOOGLE_CLIENT_ID'),
-                    "project_id": os.getenv('GOOGLE_PROJECT_ID'),
-                    "auth_uri": os.getenv('GOOGLE_AUTH_URI', 'https://accounts.google.com/o/oauth2/auth'),
-                    "token_uri": os.getenv('GOOGLE_TOKEN_URI', 'https://oauth2.googleapis.com/token'),
-                    "auth_provider_x509_cert_url": os.getenv('GOOGLE_AUTH_PROVIDER_CERT_URL', 'https://www.googleapis.com/oauth2/v1/certs'),
-                    "client_secret": os.getenv('GOOGLE_CLIENT_SECRET'),
-                    "redirect_uris": [os.getenv('RAILWAY_REDIRECT_URI')]
-                }
-            }
+    return creds
 
-            # Initiate OAuth flow with the correct redirect URI for Railway
-            flow = Flow.from_client_config(client_config, SCOPES)
-            flow.redirect_uri = "https://gdoccreator-production.up.railway.app/oauth2callback"
+# Start the web OAuth flow and return the authorization URL to send the user to
+def start_oauth_flow():
+    # Use web-based OAuth flow with the correct redirect URI
+    client_config = {
+        "web": {
+            "client_id": os.getenv('GOOGLE_CLIENT_ID'),
+            "project_id": os.getenv('GOOGLE_PROJECT_ID'),
+            "auth_uri": os.getenv('GOOGLE_AUTH_URI', 'https://accounts.google.com/o/oauth2/auth'),
+            "token_uri": os.getenv('GOOGLE_TOKEN_URI', 'https://oauth2.googleapis.com/token'),
+            "auth_provider_x509_cert_url": os.getenv('GOOGLE_AUTH_PROVIDER_CERT_URL', 'https://www.googleapis.com/oauth2/v1/certs'),
+            "client_secret": os.getenv('GOOGLE_CLIENT_SECRET'),
+            "redirect_uris": [os.getenv('RAILWAY_REDIRECT_URI')]
+        }
+    }
 
-            # Generate the authorization URL for the user, with consent prompt to ensure refresh token is issued
-            authorization_url, state = flow.authorization_url(
-                access_type='offline',  # Request offline access to get a refresh token
-                prompt='consent',  # Force consent screen to receive refresh token again
-                include_granted_scopes='true'
-            )
+    # Initiate OAuth flow with the correct redirect URI for Railway
+    from google_auth_oauthlib.flow import Flow
+    flow = Flow.from_client_config(client_config, SCOPES)
+    flow.redirect_uri = "https://gdoccreator-production.up.railway.app/oauth2callback"
 
-            print(authorization_url)
-            print("Authentication url is printed, I am printing state now (not sessions tate)")
-            print("The state is", state)
-            # Store the state in session
-            session['state'] = state
-            print("Cool hehe now I am printing session['state']")
-            print(session['state'])
-            logging.debug(f"Session state set: {session['state']}")
-            logging.debug(f"Session state in callback: {session.get('state')}")
+    # Generate the authorization URL for the user, with consent prompt to ensure refresh token is issued
+    authorization_url, state = flow.authorization_url(
+        access_type='offline',  # Request offline access to get a refresh token
+        prompt='consent',  # Force consent screen to receive refresh token again
+        include_granted_scopes='true'
+    )
 
-            authorization_url_with_state = f"{authorization_url}&state={state}"
+    logging.debug(f"Authorization URL: {authorization_url}")
+    # Store the state in session (only the OAuth flow needs one)
+    session.permanent = True
+    session['state'] = state
+    logging.debug(f"Session state set: {session['state']}")
+    logging.debug(f"Session state in callback: {session.get('state')}")
 
+    authorization_url_with_state = f"{authorization_url}&state={state}"
 
-            # Return the authorization URL so the frontend can redirect the user
-            return authorization_url
 
-    return creds
+    # Return the authorization URL so the frontend can redirect the user
+    return authorization_url
 
 @app.route('/oauth2callback')
 def oauth2callback():
     try:
         incoming_state = request.args.get('state')
-        print("I am trying to print state and incoming state one by one")
-        print("Here is incoming state")
-        print("Incoming state is",incoming_state)
         logging.info(f"Incoming state: {incoming_state}")
         logging.info(f"Session state: {session.get('state')}")
 
@@ -468,6 +502,7 @@ def oauth2callback():
             return "State parameter is missing", 400
 
         # Proceed with the OAuth flow
+        from google_auth_oauthlib.flow import Flow
         flow = Flow.from_client_config({
             "web": {
                 "client_id": os.getenv('GOOGLE_CLIENT_ID'),
@@ -486,9 +521,14 @@ def oauth2callback():
         flow.fetch_token(authorization_response=authorization_response)
         creds = flow.credentials
 
-        # Save the credentials to token.json for future use
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+        # Save the credentials to token.json for future use, or to the identity whose
+        # registration started this very flow. That is kept server-side, since the callback
+        # may arrive without the session cookie.
+        identity = identity_pool.finish_registration(incoming_state)
+        if identity:
+            identity_pool.register(identity, creds)
+        else:
+            credential_manager.save(creds)
 
         return redirect(url_for('index'))
 
@@ -496,131 +536,400 @@ def oauth2callback():
         logging.error(f"Error during OAuth callback: {e}")
         return f"Error during OAuth callback: {str(e)}", 500
 
-# Upload the `.docx` file and convert it to Google Docs format
-def upload_and_convert_to_gdoc(service, template_file):
-    logging.info(f"Uploading and converting {template_file} to Google Docs format.")
+# Read the IBO JSON from an uploaded file or from the request body
+def read_ibo_data():
+    if request.files:
+        # Get the first uploaded file (in case there's only one)
+        uploaded_file = list(request.files.values())[0]  # This dynamically gets the first file
+        return json.load(uploaded_file)
+    # Alternatively, if you're expecting to pull the JSON data from the body
+    return request.get_json()  # Fallback to JSON data in the request body
+
+# Map every link placeholder in the template to the IBO's shop link
+def build_tag_to_link(shop_links):
+    return {
+        '{xoom_residential}': shop_links[2],
+        '{id_seal}': shop_links[3],
+        '{impact_residential}': shop_links[4],
+        '{truvvi_lifestyle}': shop_links[1],
+        '{directv_residential}': shop_links[6],
+        '{dish_residential}': shop_links[7],
+        '{flash_mobile}': shop_links[0],
+        '{at&t_copy}': shop_links[8],
+        '{spectrum}': shop_links[8],
+        '{spectrum_copy}': shop_links[9],
+        '{at&T_internet}': shop_links[9],
+        '{frontier_internet}': shop_links[10],
+        '{kinetic_internet}': shop_links[11],
+        '{ziply_nternet}': shop_links[12],
+        '{xoom_business}': shop_links[13],
+        '{intermedia}': shop_links[20],
+        '{impact_business}': shop_links[14],
+        '{nmi}': shop_links[15],
+        '{directv_business}': shop_links[17],
+        '{business_internet}': shop_links[18],
+        '{adp}': shop_links[19]
+    }
+
+# Return an error message if the IBO data cannot be used to generate a document
+def validate_ibo_data(ibo_data):
+    if not ibo_data or 'shop_links' not in ibo_data or not ibo_data.get('ibo_id'):
+        return "Invalid JSON data provided."
+    try:
+        build_tag_to_link(ibo_data['shop_links'])
+    except (IndexError, TypeError):
+        return "Not enough shop links provided."
+    return None
+
+# Text placeholders and their values
+def ibo_replacements(ibo_name, ibo_id):
+    return {
+        '{ibo_name}': ibo_name,
+        '{ibo_id}': str(ibo_id) if ibo_id is not None else ''
+    }
+
+# Fill the template locally and upload the finished .docx, converting it to a Google Doc
+@metrics.stage('upload')
+def upload_rendered_docx(drive_service, template_file, tag_to_link, ibo_name, ibo_id):
+    data = docx_renderer.render_file(template_file, tag_to_link, ibo_replacements(ibo_name, ibo_id))
 
     file_metadata = {
         'name': 'Generated Google Doc',
         'mimeType': 'application/vnd.google-apps.document'
     }
-    media = MediaFileUpload(template_file, mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
-
-    uploaded_file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+    from googleapiclient.http import MediaIoBaseUpload
+    media = MediaIoBaseUpload(io.BytesIO(data), mimetype=template_registry.DOCX_MIMETYPE)
+    # A failed create may still have made the file, so it is only retried when rate limited
+    uploaded_file = rate_scheduler.execute(
+        drive_service.files().create(body=file_metadata, media_body=media, fields='id'), 'drive', 'write',
+        safe_to_retry=False
+    )
 
     document_id = uploaded_file.get('id')
-    logging.info(f"Uploaded and converted .docx file. Document ID: {document_id}")
+    logging.info(f"Uploaded rendered .docx ({len(data)} bytes). Document ID: {document_id}")
     return document_id
 
-# Replace placeholders with "Click here"
-def replace_with_click_here(docs_service, document_id, tag_to_link):
-    requests = []
-    for tag, link in tag_to_link.items():
-        logging.debug(f"Replacing tag {tag} with 'Click here'.")
-
-        requests.append({
-            'replaceAllText': {
-                'containsText': {
-                    'text': tag,
-                    'matchCase': True,
-                },
-                'replaceText': "Click here"
-            }
-        })
-
-    try:
-        docs_service.documents().batchUpdate(documentId=document_id, body={'requests': requests}).execute()
-        logging.info(f"Replaced tags with 'Click here' in document ID: {document_id}")
-    except Exception as e:
-        logging.error(f"Error replacing text in document: {e}")
+# Replace every placeholder, apply the hyperlinks and bold styling in a single batchUpdate
+@metrics.stage('personalize')
+def personalize_document(docs_service, document_id, layout, tag_to_link, ibo_name, ibo_id):
+    requests = doc_plan.build_requests(layout, tag_to_link, ibo_replacements(ibo_name, ibo_id))
 
-# Find "Click here" text in the document and apply the hyperlink and bold styling
-def apply_hyperlinks(docs_service, document_id, tag_to_link):
-    document = docs_service.documents().get(documentId=document_id).execute()
-    content = document.get('body').get('content', [])
-
-    requests = []
-    applied_links = {}
-
-    for element in content:
-        if 'paragraph' in element:
-            for run in element.get('paragraph').get('elements', []):
-                text_run = run.get('textRun')
-                if text_run and 'Click here' in text_run.get('content', ''):
-                    start_index = run.get('startIndex')
-                    end_index = run.get('endIndex')
-
-                    for tag, link in tag_to_link.items():
-                        if tag not in applied_links:
-                            logging.debug(f"Found 'Click here' at index {start_index} to {end_index}, applying link: {link}")
-                            applied_links[tag] = True
-
-                            requests.append({
-                                'updateTextStyle': {
-                                    'range': {
-                                        'startIndex': start_index,
-                                        'endIndex': end_index
-                                    },
-                                    'textStyle': {
-                                        'bold': True,
-                                        'link': {
-                                            'url': link
-                                        }
-                                    },
-                                    'fields': 'bold,link'
-                                }
-                            })
-                            break
-
-    try:
-        for i in range(0, len(requests), 50):  # Chunk updates to avoid limits
-            chunk = requests[i:i+50]
-            docs_service.documents().batchUpdate(documentId=document_id, body={'requests': chunk}).execute()
-        logging.info(f"Applied hyperlinks and bold styling in document ID: {document_id}")
-    except Exception as e:
-        logging.error(f"Error applying hyperlinks and styling in document: {e}")
+    # Inserts are not idempotent, so only calls rejected by rate limiting are retried here;
+    # after any other failure create_document_as starts over with a fresh copy
+    rate_scheduler.execute(
+        docs_service.documents().batchUpdate(documentId=document_id, body={'requests': requests}),
+        'docs', 'write', safe_to_retry=False
+    )
+    logging.info(f"Personalized document ID: {document_id} with {len(requests)} requests in one batchUpdate")
 
 # Share the document by making it public
+@metrics.stage('share')
 def share_google_doc(drive_service, document_id):
     logging.info(f"Sharing Google Doc {document_id} publicly.")
-    drive_service.permissions().create(
-        fileId=document_id,
-        body={'role': 'writer', 'type': 'anyone'}
-    ).execute()
-    logging.info(f"Document shared: https://docs.google.com/document/d/{document_id}/edit")
+    rate_scheduler.execute(
+        drive_service.permissions().create(
+            fileId=document_id,
+            body={'role': 'writer', 'type': 'anyone'}
+        ),
+        'drive', 'write'
+    )
+    logging.info(f"Document shared: {document_link(document_id)}")
+    return document_link(document_id)
+
+def document_link(document_id):
     return f"https://docs.google.com/document/d/{document_id}/edit"
 
-# Replace {ibo_name} and {ibo_id} with actual values
-def replace_ibo_details(docs_service, document_id, ibo_name, ibo_id):
-    requests = [
-        {
-            'replaceAllText': {
-                'containsText': {
-                    'text': '{ibo_name}',
-                    'matchCase': True
-                },
-                'replaceText': ibo_name
-            }
-        },
-        {
-            'replaceAllText': {
-                'containsText': {
-                    'text': '{ibo_id}',
-                    'matchCase': True
-                },
-                'replaceText': ibo_id
-            }
-        }
-    ]
-
+# Delete a document whose pipeline failed; it was never handed out
+def discard_document(drive_service, document_id):
     try:
-        docs_service.documents().batchUpdate(documentId=document_id, body={'requests': requests}).execute()
-        logging.info(f"Replaced IBO details (name and id) in document ID: {document_id}")
+        rate_scheduler.execute(drive_service.files().delete(fileId=document_id), 'drive', 'write')
+        logging.info(f"Deleted unfinished document ID: {document_id}")
     except Exception as e:
-        logging.error(f"Error replacing IBO details in document: {e}")
+        logging.error(f"Could not delete unfinished document ID {document_id}: {e}")
+
+# Create and personalize the document for one IBO and return its ID, sharing it too when
+# share is True. progress(stage) is called as each pipeline stage starts.
+# The document is created as the identity with the most quota left; when Google throttles
+# that identity, the document is started again as the next one.
+def create_personalized_document(ibo_data, progress=None, share=False):
+    identities = identity_pool.ranked()
+    if not identities:
+        raise RuntimeError("Google authorization is required. Open the app to sign in again.")
+
+    for position, identity in enumerate(identities):
+        fallback = position < len(identities) - 1
+        try:
+            with rate_scheduler.identity(identity, fallback=fallback):
+                return create_document_as(identity, ibo_data, progress, share)
+        except Exception as e:
+            if not (fallback and rate_scheduler.is_rate_limited(e)):
+                raise
+            metrics.inc('gdoc_identity_fallbacks_total', identity=identity)
+            logging.warning(f"{identity} is throttled ({e}); creating the document as {identities[position + 1]}")
+
+# The pipeline of create_personalized_document for one identity.
+# The stages run as a small dependency graph: the template layout and the copy are fetched
+# at the same time, and sharing only needs the document ID, so it overlaps personalization.
+def create_document_as(identity, ibo_data, progress=None, share=False):
+    creds = identity_pool.get(identity)
+    if not creds:
+        raise RuntimeError(f"Google authorization for {identity} is required. Open the app to sign in again.")
+
+    # Clients are shared by every thread and safe to use from any stage
+    def drive():
+        return google_clients.drive_service(creds, identity)
+
+    def docs():
+        return google_clients.docs_service(creds, identity)
+
+    # The new document is deleted if the pipeline fails, even when it is only created after
+    # the pipeline gave up on it
+    def discard(document_id):
+        with rate_scheduler.identity(identity):
+            discard_document(drive(), document_id)
+
+    # Use the shop links provided in the JSON file
+    tag_to_link = build_tag_to_link(ibo_data['shop_links'])
+    ibo_name = ibo_data.get('ibo_name')
+    ibo_number = ibo_data.get('ibo_id')
+
+    template_file = TEMPLATE_FILE
+    if RENDER_MODE == 'local':
+        # Fill in the .docx locally; the upload is the only call before sharing
+        stages = [
+            pipeline.Stage(
+                'document',
+                lambda: upload_rendered_docx(drive(), template_file, tag_to_link, ibo_name, ibo_number),
+                progress='uploading', on_abandon=discard
+            ),
+        ]
+    else:
+        # Copy the converted template master instead of re-uploading the .docx
+        stages = [
+            pipeline.Stage(
+                'layout', lambda: get_template_layout(drive(), docs(), template_file, identity), progress='copying'
+            ),
+            pipeline.Stage(
+                'document', lambda: copy_template_document(drive(), template_file, identity),
+                progress='copying', on_abandon=discard
+            ),
+            # Replace placeholders and IBO details, apply hyperlinks and bold styling
+            pipeline.Stage(
+                'personalize',
+                lambda layout, document_id: personalize_document(
+                    docs(), document_id, layout, tag_to_link, ibo_name, ibo_number
+                ),
+                deps=('layout', 'document'), progress='personalizing'
+            ),
+        ]
+    if share:
+        # Share the Google Doc publicly
+        stages.append(pipeline.Stage(
+            'share', lambda document_id: share_google_doc(drive(), document_id), deps=('document',), progress='sharing'
+        ))
+
+    for attempt in range(PIPELINE_ATTEMPTS):
+        try:
+            results = pipeline.run(stages, progress)
+            break
+        except Exception as e:
+            # A 5xx on a create, copy or batchUpdate: the failed document is discarded, make another one.
+            # Throttling is left to create_personalized_document, which moves to another identity.
+            transient = rate_scheduler.is_retryable(e) and not rate_scheduler.is_rate_limited(e)
+            if not transient or isinstance(e, pipeline.StageTimeout) or attempt == PIPELINE_ATTEMPTS - 1:
+                raise
+            delay = rate_scheduler.backoff_delay(attempt)
+            logging.warning(f"Document pipeline failed ({e}); starting over with a new document in {delay:.1f}s")
+            time.sleep(delay)
+    document_id = results['document']
+    link_ranges = None
+    if 'layout' in results:
+        link_ranges = doc_plan.final_ranges(results['layout'], tag_to_link, ibo_replacements(ibo_name, ibo_number))
+
+    # Remember the document and its links so later link changes can be applied in place
+    previous = ibo_documents.get(ibo_number)
+    ibo_documents.save(
+        ibo_number, document_id, ibo_name, template_registry.template_hash(template_file), tag_to_link, link_ranges,
+        identity
+    )
+    # Supersedes the IBO's earlier documents, which lifecycle deletes once their retention is over;
+    # they no longer answer repeated requests either
+    lifecycle.record(document_id, identity, ibo_number, previous)
+    # The IBO's earlier document is no longer theirs to download
+    if previous and previous['document_id'] != document_id:
+        export_cache.invalidate(previous['document_id'])
+    return document_id
+
+@metrics.stage('layout')
+def get_template_layout(drive_service, docs_service, template_file, identity='default'):
+    return doc_plan.get_layout(drive_service, docs_service, template_file, identity)
+
+# A ready copy from the pool when there is one, otherwise a fresh copy of the master
+@metrics.stage('copy')
+def copy_template_document(drive_service, template_file, identity='default'):
+    return copy_pool.take(template_file, identity) or template_registry.copy_template(
+        drive_service, template_file, identity=identity
+    )
+
+# Point an IBO's existing document at its new links, sending only the links that changed.
+# Returns (document_id, number of changed tags), or None if the IBO has no document yet.
+@metrics.stage('update')
+def update_document(ibo_data):
+    record = ibo_documents.get(ibo_data['ibo_id'])
+    if not record:
+        return None
+
+    # The document can only be edited by the identity that created it
+    identity = record['identity']
+    creds = identity_pool.get(identity)
+    if not creds:
+        raise RuntimeError(f"Google authorization for {identity} is required. Open the app to sign in again.")
+    docs_service = google_clients.docs_service(creds, identity)
+
+    document_id = record['document_id']
+    old_tag_to_link = record['tag_to_link']
+    tag_to_link = build_tag_to_link(ibo_data['shop_links'])
+    changed = ibo_documents.changed_tags(old_tag_to_link, tag_to_link)
+    link_ranges = record['link_ranges']
+
+    requests = []
+    if changed and link_ranges is not None:
+        # The final range of every link is known from the plan the document was built with
+        changed_ranges = [text_range for text_range in link_ranges if text_range['tag'] in changed]
+        requests += doc_plan.relink_requests(changed_ranges, lambda text_range: tag_to_link[text_range['tag']])
+    elif changed:
+        # Built without a plan: find the links to change by their current URL
+        old_to_new = {old_tag_to_link[tag]: tag_to_link[tag] for tag in changed if old_tag_to_link.get(tag)}
+        with rate_scheduler.identity(identity):
+            document = rate_scheduler.execute(
+                docs_service.documents().get(documentId=document_id, fields=doc_plan.LINK_FIELDS), 'docs', 'read'
+            )
+        links = [link for link in doc_plan.locate_links(document) if link['url'] in old_to_new]
+        requests += doc_plan.relink_requests(links, lambda link: old_to_new[link['url']])
+
+    ibo_name = ibo_data.get('ibo_name') or record['ibo_name']
+    renamed = ibo_name != record['ibo_name']
+    name_ranges = [text_range for text_range in link_ranges or [] if text_range['tag'] == '{ibo_name}']
+    if renamed and not name_ranges:
+        # Where the name was filled in is not known (documents made before the ranges were
+        # recorded, or uploaded by the 'local' renderer): make a new document instead of
+        # searching for the old name, which may also appear in the template's own text
+        logging.info(f"Regenerating the document of IBO {ibo_data['ibo_id']} to change its name")
+        document_id, _ = idempotency.run_once(
+            generation_key(ibo_data), str(ibo_data['ibo_id']),
+            lambda: create_personalized_document(ibo_data, share=True)
+        )
+        return document_id, len(changed)
+    if renamed:
+        # Rewrite only the ranges {ibo_name} was filled into; text after them moves
+        requests += doc_plan.replace_text_requests(name_ranges, ibo_name)
+        link_ranges = doc_plan.shift_ranges(link_ranges, name_ranges, ibo_name)
+
+    if requests:
+        # Inserting the new name is not idempotent, so that batch is only retried when rate limited
+        with rate_scheduler.identity(identity):
+            rate_scheduler.execute(
+                docs_service.documents().batchUpdate(documentId=document_id, body={'requests': requests}),
+                'docs', 'write', safe_to_retry=not renamed
+            )
+        logging.info(f"Updated {len(changed)} links in document ID: {document_id} with {len(requests)} requests")
+
+    ibo_documents.save(
+        ibo_data['ibo_id'], document_id, ibo_name, record['template_hash'], tag_to_link, link_ranges, identity
+    )
+
+    # The document now answers requests with the new data, not the old
+    idempotency.forget_document(document_id)
+    export_cache.invalidate(document_id)
+    idempotency.remember(generation_key(ibo_data), str(ibo_data['ibo_id']), document_id)
+    return document_id, len(changed)
+
+# Idempotency key of a request: same IBO data and same template version, same document
+def generation_key(ibo_data):
+    return idempotency.request_key(ibo_data, template_registry.template_hash(TEMPLATE_FILE))
+
+# Run the whole pipeline for one IBO and return the shared document link.
+# Identical requests reuse the document generated the first time.
+def generate_document(ibo_data, progress=None):
+    def run():
+        return create_personalized_document(ibo_data, progress, share=True)
+
+    with metrics.stage('generate'):
+        document_id, reused = idempotency.run_once(generation_key(ibo_data), str(ibo_data.get('ibo_id')), run)
+    return document_link(document_id)
+
+# Background job handler: payload is what /create-doc queued
+def run_job(payload, progress):
+    name = f"job generate {payload['ibo_data'].get('ibo_id')}"
+    profile = payload.get('profile') or profiler.should_profile()
+    with logs.request_id(payload.get('request_id')), profiler.trace(name, profile, parent=payload.get('trace_id')):
+        return generate_document(payload['ibo_data'], progress)
+
+# Drive clients of the authorized identities, for the copy pool refiller and document expiry
+def pool_drive_services():
+    services = {}
+    for identity in identity_pool.authorized():
+        services[identity] = google_clients.drive_service(identity_pool.get(identity), identity)
+    return services
 
-# Route to handle Google Doc creation from the frontend
+@app.before_request
+def start_job_workers():
+    job_queue.start_workers(run_job)
+    if RENDER_MODE == 'copy':
+        copy_pool.start(pool_drive_services, TEMPLATE_FILE)
+    lifecycle.start(pool_drive_services)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # Admins profile a request with the X-Gdoc-Profile header; others are sampled at the configured rate
+    profile = (request.headers.get('X-Gdoc-Profile') and is_admin()) or profiler.should_profile()
+    g.trace = profiler.start(f'{request.method} {request.path}', profile)
+    # Log lines carry the caller's X-Request-Id, or the trace ID when there is none
+    supplied = request.headers.get('X-Request-Id', '')
+    g.request_id = supplied if 0 < len(supplied) <= 64 and supplied.isprintable() else g.trace.id
+    g.request_id_token = logs.set_request_id(g.request_id)
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' in g:
+        endpoint = request.endpoint or 'unknown'
+        metrics.inc('gdoc_http_requests_total', endpoint=endpoint, status=str(response.status_code))
+        metrics.observe('gdoc_http_request_seconds', time.perf_counter() - g.request_start, endpoint=endpoint)
+    if 'trace' in g:
+        response.headers['X-Gdoc-Trace-Id'] = g.trace.id
+        response.headers['X-Request-Id'] = g.request_id
+    return response
+
+# Save the request's trace when it was profiled or slow
+@app.teardown_request
+def finish_request_trace(error=None):
+    if 'trace' in g:
+        profiler.finish(g.trace, **({'error': str(error)} if error else {}))
+    if 'request_id_token' in g:
+        try:
+            logs.reset_request_id(g.request_id_token)
+        except ValueError:
+            # Torn down from another context (a streamed response)
+            pass
+
+# Requests turned away by admission control; clients should retry after Retry-After seconds
+@app.errorhandler(admission.Rejected)
+def admission_rejected(e):
+    response = jsonify(success=False, message=str(e), retryAfter=e.retry_after)
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+# Prometheus metrics, summed over every gunicorn worker
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Route to handle Google Doc creation from the frontend.
+# The document is generated by a background worker; poll /jobs/<id> for the link.
 @app.route('/create-doc', methods=['POST'])
+@admission.admit
 def create_doc():
     try:
         # Get IBO name and IBO number from form data (optional, but not needed since JSON is provided)
@@ -628,24 +937,15 @@ def create_doc():
         ibo_number = request.form.get('iboNumber')
         
         # Ensure that the JSON file is sent as part of the request or the JSON data is available
-        if request.files:
-            # Get the first uploaded file (in case there's only one)
-            uploaded_file = list(request.files.values())[0]  # This dynamically gets the first file
-            ibo_data = json.load(uploaded_file)
-        else:
-            # Alternatively, if you're expecting to pull the JSON data from the body
-            ibo_data = request.get_json()  # Fallback to JSON data in the request body
-
-        # Validate the data in JSON
-        if not ibo_data or 'shop_links' not in ibo_data or not ibo_data.get('ibo_id'):
-            return jsonify(success=False, message="Invalid JSON data provided.")
+        ibo_data = read_ibo_data()
 
         # Validate the data in JSON
-        if not ibo_data or not 'shop_links' in ibo_data or not ibo_data.get('ibo_id'):
-            return jsonify(success=False, message="Invalid JSON data provided.")
+        error = validate_ibo_data(ibo_data)
+        if error:
+            return jsonify(success=False, message=error)
 
-        ibo_name = ibo_data.get('ibo_name', ibo_name)
-        ibo_number = ibo_data.get('ibo_id', ibo_number)
+        ibo_data['ibo_name'] = ibo_data.get('ibo_name', ibo_name)
+        ibo_data['ibo_id'] = ibo_data.get('ibo_id', ibo_number)
 
         creds = get_creds()
 
@@ -653,70 +953,354 @@ def create_doc():
         if isinstance(creds, str):
             return jsonify(success=False, oauth_url=creds)
 
-        # If credentials exist and are valid, proceed with doc creation
-        if creds:
-            drive_service = build('drive', 'v3', credentials=creds)
-            docs_service = build('docs', 'v1', credentials=creds)
-
-            # Use the shop links provided in the JSON file
-            tag_to_link = {
-            '{xoom_residential}': ibo_data['shop_links'][2],
-            '{id_seal}': ibo_data['shop_links'][3],
-            '{impact_residential}': ibo_data['shop_links'][4],
-            '{truvvi_lifestyle}': ibo_data['shop_links'][1],
-            '{directv_residential}': ibo_data['shop_links'][6],
-            '{dish_residential}': ibo_data['shop_links'][7],
-            '{flash_mobile}': ibo_data['shop_links'][0],
-            '{at&t_copy}': ibo_data['shop_links'][8],
-            '{spectrum}': ibo_data['shop_links'][8],
-            '{spectrum_copy}': ibo_data['shop_links'][9],
-            '{at&T_internet}': ibo_data['shop_links'][9],
-            '{frontier_internet}': ibo_data['shop_links'][10],
-            '{kinetic_internet}': ibo_data['shop_links'][11],
-            '{ziply_nternet}': ibo_data['shop_links'][12],
-            '{xoom_business}': ibo_data['shop_links'][13],
-            '{intermedia}': ibo_data['shop_links'][20],
-            '{impact_business}': ibo_data['shop_links'][14],
-            '{nmi}': ibo_data['shop_links'][15],
-            '{directv_business}': ibo_data['shop_links'][17],
-            '{business_internet}': ibo_data['shop_links'][18],
-            '{adp}': ibo_data['shop_links'][19]
-        }
+        # An identical request was already generated: return its document right away
+        document_id = idempotency.lookup(generation_key(ibo_data))
+        if document_id:
+            return jsonify(success=True, status='done', docLink=document_link(document_id))
 
-            # Upload and convert the template to Google Docs format
-            template_file = 'ServiceLinkTemplate.docx'
-            document_id = upload_and_convert_to_gdoc(drive_service, template_file)
+        # Turn the request away now rather than queue it behind more work than we can start in time
+        admission.check_client(f"ibo:{ibo_data['ibo_id']}", admission.IBO_RATE, admission.IBO_BURST)
+        admission.check_queue()
+
+        # If credentials exist and are valid, queue the document for a background worker
+        if creds:
+            # The job is profiled and logged under this request's trace and request IDs
+            job_id = job_queue.enqueue({
+                'ibo_data': ibo_data, 'profile': g.trace.profiled, 'trace_id': g.trace.id, 'request_id': g.request_id
+            })
+            return jsonify(
+                success=True,
+                jobId=job_id,
+                status='queued',
+                statusUrl=url_for('job_status', job_id=job_id)
+            ), 202
+
+    except admission.Rejected:
+        raise
+    except Exception as e:
+        logging.error(f"Error creating Google Doc: {e}")
+        return jsonify(success=False, message=str(e))
 
-            # Replace placeholders with "Click here" text
-            replace_with_click_here(docs_service, document_id, tag_to_link)
+# Progress of a queued document, with its link once it is done
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify(success=False, message="Unknown job."), 404
+
+    response = {
+        'success': job['status'] != 'failed',
+        'jobId': job['id'],
+        'status': job['status'],
+        'stage': job['stage'],
+        'attempts': job['attempts']
+    }
+    if job['doc_link']:
+        response['docLink'] = job['doc_link']
+    if job['error']:
+        response['message'] = job['error']
+    return jsonify(response)
+
+# Generate documents for many IBOs in one request. The body is an NDJSON stream or a
+# JSON array of links.json-shaped records; one NDJSON result line is streamed back per
+# record as soon as its document is shared (or has failed).
+@app.route('/create-docs/batch', methods=['POST'])
+@admission.admit
+def create_docs_batch():
+    creds = get_creds()
+
+    # If creds is a string (OAuth URL), send it to the frontend for redirect
+    if isinstance(creds, str):
+        return jsonify(success=False, oauth_url=creds)
+
+    # Records identical to an earlier request reuse its document (sharing it again is harmless).
+    # Batch calls run at bulk priority so they leave quota for interactive requests.
+    # A document made here is only handed out to identical requests once it is shared.
+    claimed = {}
+
+    def create(ibo_data):
+        key = generation_key(ibo_data)
+        with rate_scheduler.priority('bulk'):
+            document_id, reused = idempotency.run_once(
+                key, str(ibo_data.get('ibo_id')), lambda: create_personalized_document(ibo_data), deferred=True
+            )
+        if not reused:
+            claimed[document_id] = key
+        return document_id
+
+    def settle(document_id, error=None):
+        key = claimed.pop(document_id, None)
+        if key is None:
+            if error:
+                # Do not hand out a document that never became public
+                idempotency.forget_document(document_id)
+        elif error:
+            idempotency.abandon(key, error)
+        else:
+            idempotency.complete(key, document_id)
+
+    def share(document_ids):
+        # Each document is shared by the identity that created it
+        by_identity = {}
+        for document_id in document_ids:
+            record = ibo_documents.get_by_document(document_id)
+            by_identity.setdefault(record['identity'] if record else credential_pool.DEFAULT, []).append(document_id)
+        errors = {}
+        try:
+            for identity, identity_document_ids in by_identity.items():
+                drive_service = google_clients.drive_service(identity_pool.get(identity), identity)
+                with rate_scheduler.priority('bulk'), rate_scheduler.identity(identity):
+                    errors.update(bulk.share_documents(drive_service, identity_document_ids))
+        except Exception as e:
+            for document_id in document_ids:
+                settle(document_id, e)
+            raise
+        for document_id in document_ids:
+            settle(document_id, errors.get(document_id))
+        return errors
+
+    # The batch stopped before these were shared: delete the ones made for it, and make the
+    # documents they replaced current again
+    def discard(document_ids):
+        for document_id in document_ids:
+            if document_id not in claimed:
+                continue
+            settle(document_id, RuntimeError("The batch request stopped before the document was shared"))
+            record = ibo_documents.get_by_document(document_id)
+            identity = record['identity'] if record else credential_pool.DEFAULT
+            lifecycle.unrecord(document_id)
+            discard_document(google_clients.drive_service(identity_pool.get(identity), identity), document_id)
+
+    def results():
+        records = bulk.iter_records(request.stream, request.content_type)
+        for result in bulk.run(records, validate_ibo_data, create, share, document_link, discard=discard):
+            yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson')
+
+# Update the links of an IBO's existing document in place; the document and its URL stay the same
+@app.route('/update-doc', methods=['POST'])
+@admission.admit
+def update_doc():
+    try:
+        ibo_data = read_ibo_data()
+        error = validate_ibo_data(ibo_data)
+        if error:
+            return jsonify(success=False, message=error)
+        admission.check_client(f"ibo:{ibo_data['ibo_id']}", admission.IBO_RATE, admission.IBO_BURST)
 
-            # Apply hyperlinks and bold styling
-            apply_hyperlinks(docs_service, document_id, tag_to_link)
+        creds = get_creds()
 
-            # Replace IBO details
-            replace_ibo_details(docs_service, document_id, ibo_name, ibo_number)
+        # If creds is a string (OAuth URL), send it to the frontend for redirect
+        if isinstance(creds, str):
+            return jsonify(success=False, oauth_url=creds)
 
-            # Share the Google Doc publicly
-            doc_link = share_google_doc(drive_service, document_id)
+        updated = update_document(ibo_data)
+        if updated is None:
+            return jsonify(success=False, message="No document found for this IBO. Use /create-doc first."), 404
 
-            return jsonify(success=True, docLink=doc_link)
+        document_id, changed = updated
+        return jsonify(success=True, docLink=document_link(document_id), updatedLinks=changed)
 
+    except admission.Rejected:
+        raise
     except Exception as e:
-        logging.error(f"Error creating Google Doc: {e}")
+        logging.error(f"Error updating Google Doc: {e}")
         return jsonify(success=False, message=str(e))
 
+# Download a generated document as PDF or .docx: /docs/<document_id>/export?format=pdf.
+# Google renders each export once; it is then served from the disk cache (with ETag and Range
+# support) until the document is updated or regenerated.
+@app.route('/docs/<document_id>/export', methods=['GET'])
+@admission.admit
+def export_doc(document_id):
+    export_format = request.args.get('format', 'pdf')
+    if export_format not in export_cache.FORMATS:
+        return jsonify(success=False, message=f"format must be one of: {', '.join(export_cache.FORMATS)}."), 400
+    record = ibo_documents.get_by_document(document_id)
+    if not record:
+        return jsonify(success=False, message="Unknown document."), 404
+
+    identity = record['identity']
+    creds = identity_pool.get(identity)
+    if not creds:
+        return jsonify(success=False, message=f"Google authorization for {identity} is required."), 503
+    try:
+        with rate_scheduler.identity(identity):
+            for attempt in range(2):
+                export = export_cache.get(
+                    google_clients.drive_service(creds, identity), document_id, export_format, record['updated_at']
+                )
+                try:
+                    response = send_file(
+                        export.path, mimetype=export_cache.FORMATS[export_format], as_attachment=True,
+                        download_name=f"{record['ibo_id']}.{export_format}", etag=export.sha256, conditional=True
+                    )
+                    break
+                except FileNotFoundError:
+                    # Evicted by another worker between the lookup and the open; export it again
+                    if attempt:
+                        raise
+    except Exception as e:
+        logging.error(f"Error exporting document {document_id}: {e}")
+        return jsonify(success=False, message=str(e)), 502
+    # Cached by the client, but checked against the ETag every time. Werkzeug only advertises
+    # ranges on a 206; PDF viewers look for it on the first response.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+# Render the personalized .docx without touching Google and return it as a download
+@app.route('/render-docx', methods=['POST'])
+def render_docx():
+    ibo_data = read_ibo_data()
+    error = validate_ibo_data(ibo_data)
+    if error:
+        return jsonify(success=False, message=error), 400
+
+    tag_to_link = build_tag_to_link(ibo_data['shop_links'])
+    replacements = ibo_replacements(ibo_data.get('ibo_name'), ibo_data.get('ibo_id'))
+    data = docx_renderer.render_file(TEMPLATE_FILE, tag_to_link, replacements)
+    return send_file(
+        io.BytesIO(data),
+        mimetype=template_registry.DOCX_MIMETYPE,
+        as_attachment=True,
+        download_name=f"{ibo_data['ibo_id']}.docx"
+    )
+
+# Add another Google account to the credential pool: redirects to Google's consent screen,
+# and /oauth2callback stores the account's token as identity `name`
+@app.route('/identities/register', methods=['GET'])
+def register_identity():
+    if not is_admin():
+        return jsonify(success=False, message="Admin token required."), 403
+    name = request.args.get('name', '')
+    if not credential_pool.NAME_PATTERN.match(name) or name == credential_pool.DEFAULT:
+        return jsonify(success=False, message="Pass ?name= using letters, digits, '-' and '_'."), 400
+    authorization_url = start_oauth_flow()
+    # Tied to this flow's state, so an abandoned registration never claims a later sign-in
+    identity_pool.start_registration(session['state'], name)
+    return redirect(authorization_url)
+
+# Quota use of every Google identity in the pool
+@app.route('/identities', methods=['GET'])
+def list_identities():
+    if not is_admin():
+        return jsonify(success=False, message="Admin token required."), 403
+    return jsonify(success=True, identities=identity_pool.stats())
+
+# Saved traces (profiled or slow requests and jobs), newest first
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    if not is_admin():
+        return jsonify(success=False, message="Admin token required."), 403
+    return jsonify(success=True, sampleRate=profiler.sample_rate(), profiles=profiler.list_saved())
+
+# Download one saved trace as JSON, or its stack samples with ?format=folded (for flamegraph.pl or speedscope)
+@app.route('/admin/profiles/<trace_id>', methods=['GET'])
+def download_profile(trace_id):
+    if not is_admin():
+        return jsonify(success=False, message="Admin token required."), 403
+    data = profiler.load_saved(trace_id) if trace_id.isalnum() else None
+    if data is None:
+        return jsonify(success=False, message="Unknown trace."), 404
+    if request.args.get('format') == 'folded':
+        body, mimetype, extension = profiler.folded_stacks(data), 'text/plain', 'folded'
+    else:
+        body, mimetype, extension = json.dumps(data, indent=1), 'application/json', 'json'
+    return Response(
+        body, mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename=trace-{trace_id}.{extension}'}
+    )
+
+# Profile a fraction of all requests and jobs: POST {"sampleRate": 0.05}; 0 turns it off
+@app.route('/admin/profiling', methods=['POST'])
+def set_profiling():
+    if not is_admin():
+        return jsonify(success=False, message="Admin token required."), 403
+    try:
+        rate = profiler.set_sample_rate((request.get_json(silent=True) or {}).get('sampleRate'))
+    except (TypeError, ValueError):
+        return jsonify(success=False, message="sampleRate must be a number between 0 and 1."), 400
+    return jsonify(success=True, sampleRate=rate)
+
 @app.route('/reset-auth', methods=['GET'])
 def reset_auth():
-    token_file = 'token.json'
-    if os.path.exists(token_file):
-        os.remove(token_file)
+    if credential_manager.clear():
         return jsonify(success=True, message="Token file deleted. Please re-authenticate.")
     else:
         return jsonify(success=False, message="No token file found to delete.")
 
+# flask slim-templates: strip embedded fonts from the templates and report the savings
+@app.cli.command('slim-templates')
+def slim_templates():
+    for row in template_slimmer.report(TEMPLATE_FILES):
+        click.echo(
+            f"{row['template']}: {row['original_bytes']} -> {row['slim_bytes']} bytes "
+            f"({row['saved_percent']}% smaller), estimated upload "
+            f"{row['estimated_original_upload_seconds']}s -> {row['estimated_slim_upload_seconds']}s "
+            f"at an assumed {template_slimmer.UPLOAD_MBPS} Mbps (GDOC_UPLOAD_MBPS)"
+        )
+
+# flask generate-roster ROSTER_FILE: generate and share a document for every IBO in a .csv or
+# JSON-lines roster without the web tier. Results are appended to ROSTER_FILE.results.jsonl as
+# they come in; rerunning the same command after a crash continues from the checkpoint.
+@app.cli.command('generate-roster')
+@click.argument('roster_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', help='JSON-lines results file (default: ROSTER_FILE.results.jsonl)')
+@click.option('--processes', type=int, default=roster.PROCESSES, show_default=True)
+@click.option('--threads', type=int, default=roster.THREADS, show_default=True, help='documents in flight per process')
+@click.option('--restart', is_flag=True, help='ignore the checkpoint and earlier results')
+def generate_roster(roster_file, output, processes, threads, restart):
+    if not identity_pool.authorized():
+        raise click.ClickException("Google authorization is required. Open the app to sign in first.")
+    output = output or f'{roster_file}.results.jsonl'
+    start = time.monotonic()
+    last_report = [0]
+
+    def progress(counts):
+        finished = counts['done'] + counts['failed']
+        if time.monotonic() - last_report[0] >= 5:
+            last_report[0] = time.monotonic()
+            rate = finished / (time.monotonic() - start) * 60
+            click.echo(
+                f"{finished + counts['invalid'] + counts['skipped']}/{counts['total']} rows: {counts['done']} done, "
+                f"{counts['failed']} failed, {counts['invalid']} invalid ({rate:.0f} docs/min)"
+            )
+
+    try:
+        counts = roster.run(
+            roster_file, output, f'{output}.checkpoint', validate_ibo_data, generate_document,
+            processes=processes, threads=threads, restart=restart, progress=progress
+        )
+    except roster.RosterError as e:
+        raise click.ClickException(str(e))
+    click.echo(
+        f"{counts['total']} rows: {counts['done']} done, {counts['failed']} failed, {counts['invalid']} invalid, "
+        f"{counts['skipped']} already done earlier. Results in {output}"
+    )
+
+# flask expire-docs: delete the generated documents past their retention now instead of waiting
+# for the background run. --scan first records the documents created before they were tracked.
+@app.cli.command('expire-docs')
+@click.option('--dry-run', is_flag=True, help='only count the documents that would be deleted')
+@click.option('--scan', is_flag=True, help="record untracked generated documents found in each identity's Drive")
+@click.option('--limit', type=int, default=lifecycle.MAX_PER_RUN, show_default=True, help='documents deleted at most')
+def expire_docs(dry_run, scan, limit):
+    if not identity_pool.authorized():
+        raise click.ClickException("Google authorization is required. Open the app to sign in first.")
+    drive_services = pool_drive_services()
+    if scan:
+        for identity, drive_service in drive_services.items():
+            click.echo(f"{identity}: recorded {lifecycle.adopt_untracked(drive_service, identity)} untracked documents")
+    counts = lifecycle.expire(drive_services, dry_run=dry_run, max_documents=limit)
+    click.echo(
+        f"{'Would delete' if dry_run else 'Deleted'} {counts['superseded']} superseded and {counts['age']} expired "
+        f"documents, {counts['failed']} failed, {counts['skipped']} skipped without authorization"
+    )
+
 # Check and print/log the PORT environment variable
 port = os.environ.get('PORT', 5000)
-print(f"Running on port: {port}")
+logging.info(f"Running on port: {port}")
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=int(port))
@@ -0,0 +1,167 @@
+# End-to-end /create-doc benchmark against the fake Google server, no real quota used.
+#
+#   python benchmarks/bench_create_doc.py [--concurrency 1,4,16] [--requests 40] [--workers 2]
+#                                         [--render-mode copy|local] [fake server options...]
+#
+# Starts benchmarks/fake_google.py in-process and the app under gunicorn (with the shipped
+# gunicorn.conf.py) with its state (database, locks, token) in a temporary directory, then
+# submits unique IBOs at each concurrency level. A request's latency runs from POST
+# /create-doc until /jobs/<id> reports the shared link. Reports p50/p95/p99 latency,
+# documents per minute, the average number of generations in flight (throughput x mean
+# latency) and the resident memory of each gunicorn worker after the level. The app is
+# given the fake server's quotas so its rate scheduler paces itself the way it would
+# against Google.
+#
+# Capacity of a single worker: --workers 1 --job-workers 32 --concurrency 8,16,32,64
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_google
+
+HEADERS = {'X-Forwarded-Proto': 'https'}
+# How often a client polls /jobs/<id>; polling is part of the load on the app
+POLL_INTERVAL = 0.1
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else float('nan')
+
+
+def start_app(args, api_root, state_dir):
+    token_file = os.path.join(state_dir, 'token.json')
+    with open(token_file, 'w') as handle:
+        json.dump({
+            'token': 'benchmark', 'refresh_token': 'benchmark', 'client_id': 'benchmark',
+            'client_secret': 'benchmark', 'expiry': '2099-01-01T00:00:00Z'
+        }, handle)
+
+    env = dict(
+        os.environ,
+        GDOC_GOOGLE_API_ROOT=api_root,
+        GDOC_DB_PATH=os.path.join(state_dir, 'gdoccreator.db'),
+        GDOC_LOCK_DIR=os.path.join(state_dir, 'locks'),
+        GDOC_TOKEN_FILE=token_file,
+        GDOC_RENDER_MODE=args.render_mode,
+        GDOC_JOB_POLL_INTERVAL='0.05',
+    )
+    if args.job_workers:
+        env['GDOC_JOB_WORKERS'] = str(args.job_workers)
+    for api in ('docs', 'drive'):
+        for quota in ('read', 'write'):
+            limit = getattr(args, f'{api}_{quota}_quota')
+            env[f'GDOC_QUOTA_{api.upper()}_{quota.upper()}'] = str(limit or 10 ** 6)
+            env[f'GDOC_PROJECT_QUOTA_{api.upper()}_{quota.upper()}'] = str(10 ** 6)
+
+    url = f'http://127.0.0.1:{args.port}'
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'), '-w', str(args.workers),
+         '--threads', str(args.threads), '-b', f'127.0.0.1:{args.port}', '--log-level', 'warning', 'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if not args.verbose else None
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(url + '/', headers=HEADERS, timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("The app did not start within 30 seconds.")
+
+
+# Submit one unique IBO and wait for its document; returns (seconds, error or None)
+def create_one(url, ibo_data, timeout):
+    ibo_data = dict(ibo_data, ibo_id=uuid.uuid4().hex[:8])
+    start = time.perf_counter()
+    response = requests.post(url + '/create-doc', json=ibo_data, headers=HEADERS, timeout=timeout).json()
+    status_url = response.get('statusUrl')
+    while response.get('status') != 'done':
+        if not response.get('success'):
+            return time.perf_counter() - start, response.get('message') or response
+        if time.perf_counter() - start > timeout:
+            return time.perf_counter() - start, 'timed out'
+        time.sleep(POLL_INTERVAL)
+        response = requests.get(url + status_url, headers=HEADERS, timeout=timeout).json()
+    return time.perf_counter() - start, None
+
+
+def worker_rss(process):
+    return [child.memory_info().rss for child in psutil.Process(process.pid).children()]
+
+
+def run_level(url, ibo_data, concurrency, count, timeout):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: create_one(url, ibo_data, timeout), range(count)))
+    elapsed = time.perf_counter() - start
+    latencies = [seconds for seconds, error in results if error is None]
+    errors = [error for _, error in results if error is not None]
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--concurrency', default='1,4,16', help='comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=40, help='documents generated per level')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=16, help='gunicorn threads per worker')
+    parser.add_argument('--job-workers', type=int, help='document generation threads per worker (GDOC_JOB_WORKERS)')
+    parser.add_argument('--render-mode', choices=('copy', 'local'), default='copy')
+    parser.add_argument('--port', type=int, default=5099, help='port for the app')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds before a request counts as failed')
+    parser.add_argument('--ibo-file', default=os.path.join(ROOT, 'links.json'))
+    parser.add_argument('--verbose', action='store_true', help="show the app's log output")
+    fake_google.add_arguments(parser)
+    args = parser.parse_args()
+
+    with open(args.ibo_file) as handle:
+        ibo_data = json.load(handle)
+
+    server = fake_google.serve(fake_google.from_arguments(args))
+    api_root = f'http://127.0.0.1:{server.server_port}/'
+
+    with tempfile.TemporaryDirectory(prefix='gdoc-bench-') as state_dir:
+        process, url = start_app(args, api_root, state_dir)
+        try:
+            print(f"{args.workers} workers x {args.threads} threads, {args.job_workers or 'default'} job workers, "
+                  f"{args.render_mode} mode, fake latency {args.latency_ms:g}+/-{args.jitter_ms:g} ms, "
+                  f"error rate {args.error_rate:g}")
+            # Warm up: upload the template master and compute its layout outside the measurements
+            create_one(url, ibo_data, args.timeout)
+
+            print(f"{'conc':>5} {'ok':>5} {'fail':>5} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'docs/min':>9} "
+                  f"{'in-flight':>9}  worker RSS MB")
+            for concurrency in [int(level) for level in args.concurrency.split(',')]:
+                latencies, errors, elapsed = run_level(url, ibo_data, concurrency, args.requests, args.timeout)
+                in_flight = sum(latencies) / elapsed
+                rss = ', '.join(f'{value / 2 ** 20:.0f}' for value in worker_rss(process))
+                print(f"{concurrency:>5} {len(latencies):>5} {len(errors):>5} {percentile(latencies, 0.5):>8.2f} "
+                      f"{percentile(latencies, 0.95):>8.2f} {percentile(latencies, 0.99):>8.2f} "
+                      f"{len(latencies) / elapsed * 60:>9.1f} {in_flight:>9.1f}  {rss}")
+                for error in sorted(set(map(str, errors)))[:3]:
+                    print(f"      error: {error}")
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+            server.shutdown()
+
+    print(f"Fake server calls: {json.dumps(dict(sorted(server.fake.stats.items())))}")
+
+
+if __name__ == '__main__':
+    main()
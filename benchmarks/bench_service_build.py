@@ -0,0 +1,58 @@
+# Compare the cost of getting Drive/Docs clients per request before and after google_clients.
+#
+#   python benchmarks/bench_service_build.py [iterations]
+#
+# "build()" is what create_doc used to do on every request: read and parse the discovery
+# document and construct a new client with a fresh HTTP connection. "build_service" parses
+# nothing (discovery docs are cached per process) and "get_service" is the per-request path
+# now used by the app, which returns the process's shared client.
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+import google_clients
+
+
+def measure(label, fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    print(f"{label:<32} mean {statistics.mean(samples):8.3f} ms   "
+          f"p50 {samples[len(samples) // 2]:8.3f} ms   p95 {samples[int(len(samples) * 0.95)]:8.3f} ms")
+    return statistics.mean(samples)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    creds = Credentials(token='benchmark-token')
+
+    def before():
+        build('drive', 'v3', credentials=creds, cache_discovery=False)
+        build('docs', 'v1', credentials=creds, cache_discovery=False)
+
+    def after_build():
+        google_clients.build_service('drive', 'v3', creds)
+        google_clients.build_service('docs', 'v1', creds)
+
+    def after():
+        google_clients.drive_service(creds)
+        google_clients.docs_service(creds)
+
+    print(f"Building a Drive + Docs client pair, {iterations} iterations")
+    baseline = measure("build() per request", before, iterations)
+    measure("build_service (cached discovery)", after_build, iterations)
+    cached = measure("get_service (shared client)", after, iterations)
+    print(f"Speedup per request: {baseline / max(cached, 1e-6):.0f}x")
+
+
+if __name__ == '__main__':
+    main()
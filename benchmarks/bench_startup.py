@@ -0,0 +1,105 @@
+# Measure worker cold start and the cost of a log call on the request path.
+#
+#   python benchmarks/bench_startup.py [runs] [log_calls]
+#
+# "import app" is what a gunicorn worker pays before it accepts requests; "import app + Google
+# stack" adds the client libraries it used to import eagerly (now loaded by google_clients.preload
+# after the worker is up). Each run is a fresh interpreter.
+# The logging part compares the old setup, a StreamHandler formatting and writing every record
+# in the calling thread, with logs.BackgroundHandler, which queues the record and returns. CPU
+# time is the calling thread's own; on a single core the writer thread's work still shows in
+# the wall time.
+import os
+import sys
+import time
+import logging
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import logs
+
+IMPORT_APP = 'import time; start = time.perf_counter(); import app; {extra}print(time.perf_counter() - start)'
+GOOGLE_STACK = (
+    'import httplib2, google_auth_httplib2, google.oauth2.credentials, googleapiclient.discovery, '
+    'googleapiclient.http, google_auth_oauthlib.flow, google.auth.transport.requests; '
+)
+
+
+def cold_start(label, extra, runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_APP.format(extra=extra)], cwd=ROOT, capture_output=True, text=True,
+            env=dict(os.environ, GDOC_LOG_LEVEL='WARNING'), check=True
+        ).stdout
+        samples.append(float(output.split()[-1]) * 1000)
+    print(f"{label:<32} median {statistics.median(samples):8.1f} ms   min {min(samples):8.1f} ms")
+    return statistics.median(samples)
+
+
+# A log destination that stalls on every write, like a stdout pipe the log shipper is behind on
+class SlowStream:
+    def __init__(self, stream, delay):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def log_calls(label, handler, calls):
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(logging.INFO)
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    for index in range(calls):
+        logging.info(f"Copied template master {index:032x} to document ID: {index:032x}")
+    wall = (time.perf_counter() - start) / calls * 1e6
+    cpu = (time.thread_time() - cpu_start) / calls * 1e6
+    print(f"{label:<40} {wall:8.2f} us wall   {cpu:8.2f} us CPU per call in the calling thread")
+    return wall
+
+
+def compare(title, open_stream, calls):
+    print(f"\n{title}")
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'sync.log'), 'w') as sync_file:
+            sync = logging.StreamHandler(open_stream(sync_file))
+            sync.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+            before = log_calls("StreamHandler, text (before)", sync, calls)
+        with open(os.path.join(directory, 'queued.log'), 'w') as queued_file:
+            target = logging.StreamHandler(open_stream(queued_file))
+            target.setFormatter(logs.JsonFormatter())
+            handler = logs.BackgroundHandler(target)
+            handler.addFilter(logs.RequestFilter(logging.INFO, {}, {}))
+            after = log_calls("BackgroundHandler, JSON", handler, calls)
+            handler.close()
+    print(f"Speedup per log call: {before / max(after, 1e-9):.1f}x")
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    print(f"Worker cold start, {runs} runs")
+    lazy = cold_start("import app", '', runs)
+    eager = cold_start("import app + Google stack", GOOGLE_STACK, runs)
+    print(f"Boot time saved: {eager - lazy:.0f} ms per worker")
+
+    compare(f"Logging {calls} records to a file", lambda stream: stream, calls)
+    compare(
+        f"Logging {calls // 10} records to a destination stalling 100 us per write",
+        lambda stream: SlowStream(stream, 0.0001), calls // 10
+    )
+
+
+if __name__ == '__main__':
+    main()
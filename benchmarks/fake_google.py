@@ -0,0 +1,464 @@
+# A local stand-in for the Drive and Docs endpoints the app calls, for benchmarks.
+#
+#   python benchmarks/fake_google.py [--port 8999] [--latency-ms 150] [--error-rate 0.01] ...
+#
+# Point the app at it with GDOC_GOOGLE_API_ROOT=http://127.0.0.1:8999/. It implements
+# Drive files.create (multipart upload of a .docx converted to a Google Doc), files.copy,
+# files.list, files.delete, files.export, permissions.create and batch requests, and Docs documents.get and documents.batchUpdate.
+# Documents are kept in memory as UTF-16 text with one link per character, which is enough
+# for the app's placeholder layout, personalization and relinking to run unchanged.
+# Every call waits latency-ms (+/- jitter-ms), fails with a 503 at error-rate, and is
+# rejected with a 429 once its per-minute quota is used up. GET /_stats returns counters.
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import zipfile
+import argparse
+import threading
+from io import BytesIO
+from html import unescape
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PARAGRAPH_RE = re.compile(r'<w:p[ >].*?</w:p>|<w:p/>', re.S)
+TEXT_RE = re.compile(r'<w:t(?: [^>]*)?>(.*?)</w:t>', re.S)
+NAME_QUERY_RE = re.compile(r"name = '((?:[^'\\]|\\.)*)'")
+
+ROUTES = [
+    ('POST', re.compile(r'^/upload/drive/v3/files$'), 'drive.files.create', ('drive', 'write')),
+    ('POST', re.compile(r'^/drive/v3/files/(?P<id>[^/]+)/copy$'), 'drive.files.copy', ('drive', 'write')),
+    ('POST', re.compile(r'^/drive/v3/files/(?P<id>[^/]+)/permissions$'), 'drive.permissions.create', ('drive', 'write')),
+    ('GET', re.compile(r'^/drive/v3/files$'), 'drive.files.list', ('drive', 'read')),
+    ('DELETE', re.compile(r'^/drive/v3/files/(?P<id>[^/]+)$'), 'drive.files.delete', ('drive', 'write')),
+    ('GET', re.compile(r'^/drive/v3/files/(?P<id>[^/]+)/export$'), 'drive.files.export', ('drive', 'read')),
+    ('GET', re.compile(r'^/v1/documents/(?P<id>[^/:]+)$'), 'docs.documents.get', ('docs', 'read')),
+    ('POST', re.compile(r'^/v1/documents/(?P<id>[^/:]+):batchUpdate$'), 'docs.documents.batchUpdate', ('docs', 'write')),
+]
+
+
+class ApiError(Exception):
+    def __init__(self, status, reason, message):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+
+def error_body(status, reason, message):
+    return {'error': {'code': status, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}
+
+
+# Paragraph texts of a .docx, in document order (table cells are flattened)
+def docx_paragraphs(data):
+    with zipfile.ZipFile(BytesIO(data)) as archive:
+        xml = archive.read('word/document.xml').decode('utf-8')
+    return [''.join(unescape(text) for text in TEXT_RE.findall(paragraph)) for paragraph in PARAGRAPH_RE.findall(xml)]
+
+
+class Document:
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text.encode('utf-16-le')
+        self.links = [None] * (len(self.text) // 2)
+        self.revision = 1
+        self.created = time.time()
+
+    def copy(self, name):
+        document = Document(name, '')
+        document.text, document.links = self.text, list(self.links)
+        return document
+
+    @property
+    def end_index(self):
+        # Body content starts at index 1, after the section break
+        return len(self.links) + 1
+
+    def _check(self, start, end):
+        if not 1 <= start <= end <= self.end_index or (start == end and start == self.end_index):
+            raise ApiError(400, 'badRequest', f'Invalid range [{start}, {end}) for a body ending at {self.end_index}.')
+
+    def insert_text(self, index, text):
+        self._check(index, index)
+        data = text.encode('utf-16-le')
+        offset = index - 1
+        self.text = self.text[:offset * 2] + data + self.text[offset * 2:]
+        self.links[offset:offset] = [None] * (len(data) // 2)
+
+    def delete(self, start, end):
+        self._check(start, end)
+        self.text = self.text[:(start - 1) * 2] + self.text[(end - 1) * 2:]
+        del self.links[start - 1:end - 1]
+
+    def set_link(self, start, end, url):
+        self._check(start, end)
+        self.links[start - 1:end - 1] = [url] * (end - start)
+
+    def replace_all(self, old, new):
+        text = self.text.decode('utf-16-le')
+        count = text.count(old)
+        if count:
+            # Links are not tracked through replaceAllText; it is only used for plain text
+            self.text = text.replace(old, new).encode('utf-16-le')
+            self.links = [None] * (len(self.text) // 2)
+        return count
+
+    # The document resource: one paragraph per line, one text run per link change
+    def resource(self, document_id):
+        content = [{'startIndex': 0, 'endIndex': 1, 'sectionBreak': {'sectionStyle': {}}}]
+        units = self.text.decode('utf-16-le')
+        index = 1
+        for line in re.findall(r'[^\n]*\n|[^\n]+$', units):
+            size = len(line.encode('utf-16-le')) // 2
+            elements = []
+            run_start = index
+            for position in range(index, index + size + 1):
+                at_end = position == index + size
+                if at_end or (position > run_start and self.links[position - 1] != self.links[run_start - 1]):
+                    if position > run_start:
+                        run_text = self.text[(run_start - 1) * 2:(position - 1) * 2].decode('utf-16-le')
+                        style = {'link': {'url': self.links[run_start - 1]}} if self.links[run_start - 1] else {}
+                        elements.append({
+                            'startIndex': run_start, 'endIndex': position,
+                            'textRun': {'content': run_text, 'textStyle': style}
+                        })
+                    run_start = position
+            content.append({'startIndex': index, 'endIndex': index + size, 'paragraph': {'elements': elements}})
+            index += size
+        return {'documentId': document_id, 'title': self.name, 'revisionId': str(self.revision), 'body': {'content': content}}
+
+
+class FakeGoogle:
+    def __init__(self, latency_ms=150, jitter_ms=50, error_rate=0.0, quotas=None, upload_mbps=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        # {(api, 'read' | 'write'): calls per minute}; 0 or missing means unlimited
+        self.quotas = quotas or {}
+        self.upload_mbps = upload_mbps
+        self.documents = {}
+        self.permissions = Counter()
+        self.stats = Counter()
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _take_quota(self, bucket):
+        limit = self.quotas.get(bucket)
+        if not limit:
+            return True
+        window = int(time.time() // 60)
+        with self._lock:
+            start, used = self._windows.get(bucket, (window, 0))
+            if start != window:
+                used = 0
+            if used >= limit:
+                return False
+            self._windows[bucket] = (window, used + 1)
+            return True
+
+    def _delay(self, body_size):
+        delay = max(0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        if self.upload_mbps:
+            delay += body_size * 8 / (self.upload_mbps * 1e6)
+        time.sleep(delay)
+
+    # Handle one API call; returns (status, JSON-serializable body).
+    # Calls inside a batch share the latency of the batch request itself.
+    def dispatch(self, method, url, headers, body, delay=True):
+        path = urlsplit(url).path
+        for route_method, pattern, name, bucket in ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, error_body(404, 'notFound', f'No fake endpoint for {method} {path}.')
+
+        self._count(f'{name}.calls')
+        if delay:
+            self._delay(len(body))
+        if not self._take_quota(bucket):
+            self._count(f'{name}.429')
+            return 429, error_body(429, 'rateLimitExceeded', f'Quota exceeded for {bucket[0]} {bucket[1]} requests.')
+        if random.random() < self.error_rate:
+            self._count(f'{name}.503')
+            return 503, error_body(503, 'backendError', 'Backend Error')
+
+        try:
+            handler = getattr(self, name.split('.', 1)[1].replace('.', '_'))
+            params = match.groupdict()
+            if 'query' in handler.__code__.co_varnames:
+                params['query'] = {key: values[-1] for key, values in parse_qs(urlsplit(url).query).items()}
+            result = handler(headers=headers, body=body, **params)
+        except ApiError as e:
+            self._count(f'{name}.{e.status}')
+            return e.status, error_body(e.status, e.reason, str(e))
+        return 200, result
+
+    def _get(self, document_id):
+        with self._lock:
+            document = self.documents.get(document_id)
+        if document is None:
+            raise ApiError(404, 'notFound', f'File not found: {document_id}.')
+        return document
+
+    def _add(self, document):
+        document_id = uuid.uuid4().hex
+        with self._lock:
+            self.documents[document_id] = document
+        return document_id
+
+    def files_create(self, headers, body):
+        metadata, media = parse_related(headers.get('content-type', ''), body)
+        paragraphs = docx_paragraphs(media) if media else []
+        self._count('bytes_uploaded', len(media or b''))
+        return {'id': self._add(Document(metadata.get('name', 'Untitled'), ''.join(f'{text}\n' for text in paragraphs)))}
+
+    def files_copy(self, headers, body, id):
+        name = json.loads(body or b'{}').get('name', 'Copy')
+        return {'id': self._add(self._get(id).copy(name))}
+
+    # Only the name filter of q is understood; pageToken is the offset of the page
+    def files_list(self, headers, body, query):
+        name = NAME_QUERY_RE.search(query.get('q', ''))
+        offset, page_size = int(query.get('pageToken', 0)), min(int(query.get('pageSize', 100)), 1000)
+        with self._lock:
+            matching = [
+                (document_id, document) for document_id, document in self.documents.items()
+                if name is None or document.name == name.group(1)
+            ]
+        files = [
+            {
+                'id': document_id, 'name': document.name,
+                'createdTime': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(document.created)),
+            }
+            for document_id, document in matching[offset:offset + page_size]
+        ]
+        result = {'files': files}
+        if offset + page_size < len(matching):
+            result['nextPageToken'] = str(offset + page_size)
+        return result
+
+    def files_delete(self, headers, body, id):
+        self._get(id)
+        with self._lock:
+            del self.documents[id]
+        return {}
+
+    # The document's text as a stand-in for the exported file (raw bytes, not JSON)
+    def files_export(self, headers, body, id):
+        document = self._get(id)
+        with self._lock:
+            return document.text.decode('utf-16-le').encode()
+
+    def permissions_create(self, headers, body, id):
+        self._get(id)
+        with self._lock:
+            self.permissions[id] += 1
+        return {'id': 'anyoneWithLink', 'type': 'anyone', 'role': json.loads(body or b'{}').get('role')}
+
+    def documents_get(self, headers, body, id):
+        document = self._get(id)
+        with self._lock:
+            return document.resource(id)
+
+    def documents_batchUpdate(self, headers, body, id):
+        document = self._get(id)
+        requests = json.loads(body).get('requests', [])
+        replies = []
+        with self._lock:
+            # Apply to a copy so a failing request leaves the document untouched, like the real API
+            working = document.copy(document.name)
+            for request in requests:
+                replies.append(apply_request(working, request))
+            document.text, document.links = working.text, working.links
+            document.revision += 1
+        return {'documentId': id, 'replies': replies}
+
+    def batch(self, headers, body):
+        self._count('drive.batch.calls')
+        self._delay(len(body))
+        responses = []
+        for content_id, method, url, part_headers, part_body in parse_batch(headers.get('content-type', ''), body):
+            status, result = self.dispatch(method, url, part_headers, part_body, delay=False)
+            responses.append((content_id, status, result))
+        return responses
+
+
+def apply_request(document, request):
+    if 'insertText' in request:
+        spec = request['insertText']
+        document.insert_text(spec['location']['index'], spec['text'])
+    elif 'deleteContentRange' in request:
+        text_range = request['deleteContentRange']['range']
+        document.delete(text_range['startIndex'], text_range['endIndex'])
+    elif 'updateTextStyle' in request:
+        spec = request['updateTextStyle']
+        text_range = spec['range']
+        if 'link' in spec.get('fields', '').split(',') or spec.get('fields') == '*':
+            document.set_link(text_range['startIndex'], text_range['endIndex'], spec['textStyle'].get('link', {}).get('url'))
+    elif 'replaceAllText' in request:
+        spec = request['replaceAllText']
+        count = document.replace_all(spec['containsText']['text'], spec['replaceText'])
+        return {'replaceAllText': {'occurrencesChanged': count}}
+    else:
+        raise ApiError(400, 'badRequest', f'Unsupported request: {", ".join(request)}.')
+    return {}
+
+
+def _boundary(content_type):
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise ApiError(400, 'badRequest', 'Missing multipart boundary.')
+    return match.group(1).encode()
+
+
+def _parts(content_type, body):
+    boundary = b'--' + _boundary(content_type)
+    for chunk in body.split(boundary)[1:]:
+        if chunk.startswith(b'--'):
+            break
+        head, _, content = _split_part(chunk)
+        yield head, content
+
+
+def _split_part(chunk):
+    chunk = chunk.lstrip(b'\r\n')
+    match = re.search(rb'\r?\n\r?\n', chunk)
+    if not match:
+        return chunk, b'', b''
+    content = chunk[match.end():]
+    if content.endswith(b'\r\n'):
+        content = content[:-2]
+    elif content.endswith(b'\n'):
+        content = content[:-1]
+    return chunk[:match.start()], b'', content
+
+
+def _headers(head):
+    headers = {}
+    # Unfold long header lines (the client folds Content-ID for long request IDs)
+    for line in re.sub(r'\r?\n[ \t]', ' ', head.decode('latin-1')).splitlines():
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+    return headers
+
+
+# (metadata, media bytes) of a multipart/related upload
+def parse_related(content_type, body):
+    if 'multipart/related' not in content_type:
+        return json.loads(body or b'{}'), None
+    parts = list(_parts(content_type, body))
+    metadata = json.loads(parts[0][1]) if parts else {}
+    return metadata, parts[1][1] if len(parts) > 1 else None
+
+
+# Sub-requests of a batch request: (content_id, method, url, headers, body)
+def parse_batch(content_type, body):
+    for head, content in _parts(content_type, body):
+        content_id = _headers(head).get('content-id', '')
+        request_head, _, request_body = _split_part(content)
+        request_line, _, header_lines = request_head.partition(b'\n')
+        method, url, _ = request_line.decode('latin-1').strip().split(' ', 2)
+        yield content_id, method, url, _headers(header_lines), request_body
+
+
+def render_batch(responses):
+    boundary = f'batch_{uuid.uuid4().hex}'
+    chunks = []
+    for content_id, status, result in responses:
+        payload = json.dumps(result)
+        chunks.append(
+            f'--{boundary}\r\nContent-Type: application/http\r\n'
+            f'Content-ID: <response-{content_id.strip("<>")}>\r\n\r\n'
+            f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+            f'Content-Type: application/json; charset=UTF-8\r\nContent-Length: {len(payload)}\r\n\r\n'
+            f'{payload}\r\n'
+        )
+    chunks.append(f'--{boundary}--\r\n')
+    return f'multipart/mixed; boundary={boundary}', ''.join(chunks).encode('utf-8')
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, status, content_type, data):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            headers = {key.lower(): value for key, value in self.headers.items()}
+            path = urlsplit(self.path).path
+            if path == '/_stats':
+                stats = dict(fake.stats, documents=len(fake.documents), shared=len(fake.permissions))
+                return self._send(200, 'application/json', json.dumps(stats).encode())
+            if path.startswith('/batch/'):
+                try:
+                    content_type, data = render_batch(fake.batch(headers, body))
+                except ApiError as e:
+                    return self._send(e.status, 'application/json', json.dumps(error_body(e.status, e.reason, str(e))).encode())
+                return self._send(200, content_type, data)
+            status, result = fake.dispatch(self.command, self.path, headers, body)
+            if isinstance(result, bytes):
+                return self._send(status, 'application/octet-stream', result)
+            self._send(status, 'application/json; charset=UTF-8', json.dumps(result).encode())
+
+        do_GET = do_POST = do_DELETE = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+# Start the fake server in a background thread and return it (server.server_port is the port)
+def serve(fake, host='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    server.fake = fake
+    threading.Thread(target=server.serve_forever, name='fake-google', daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency-ms', type=float, default=150, help='mean latency of every call')
+    parser.add_argument('--jitter-ms', type=float, default=50, help='latency varies uniformly by this much')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls failing with a 503')
+    parser.add_argument('--upload-mbps', type=float, default=0, help='simulated upload bandwidth (0 = unlimited)')
+    for api, quota, default in (('docs', 'read', 3000), ('docs', 'write', 600), ('drive', 'read', 12000), ('drive', 'write', 3000)):
+        parser.add_argument(f'--{api}-{quota}-quota', type=int, default=default, help=f'{api} {quota} calls per minute (0 = unlimited)')
+
+
+def from_arguments(args):
+    quotas = {(api, quota): getattr(args, f'{api}_{quota}_quota') for api in ('docs', 'drive') for quota in ('read', 'write')}
+    return FakeGoogle(args.latency_ms, args.jitter_ms, args.error_rate, quotas, args.upload_mbps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8999)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = serve(from_arguments(args), args.host, args.port)
+    print(f"Fake Google APIs on http://{args.host}:{server.server_port}/ (GDOC_GOOGLE_API_ROOT)", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
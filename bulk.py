@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import rate_scheduler
+
+# Documents personalized at the same time for one batch request
+PARALLELISM = int(os.getenv('GDOC_BATCH_PARALLELISM', 8))
+# Permission calls combined into one Drive batch HTTP request (Drive allows up to 100)
+SHARE_BATCH_SIZE = min(int(os.getenv('GDOC_SHARE_BATCH_SIZE', 50)), 100)
+# Seconds to wait for more finished documents before sending a partial share batch
+SHARE_FLUSH_INTERVAL = float(os.getenv('GDOC_SHARE_FLUSH_INTERVAL', 2))
+
+
+# A record that could not be read; run() reports it without stopping the batch
+class InvalidRecord:
+    def __init__(self, message):
+        self.message = message
+
+
+# IBO records from an NDJSON stream (one object per line) or a JSON array.
+# Lines that are not valid JSON come out as InvalidRecord.
+def iter_records(stream, content_type):
+    if 'ndjson' in (content_type or '') or 'jsonlines' in (content_type or ''):
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield InvalidRecord(f"Line {number} is not valid JSON: {e}")
+    else:
+        try:
+            records = json.load(stream)
+        except ValueError as e:
+            yield InvalidRecord(f"The request body is not valid JSON: {e}")
+            return
+        if not isinstance(records, list):
+            records = [records]
+        yield from records
+
+
+# Share several documents with one Drive batch HTTP request. Every permission in the
+# batch counts against the Drive quota; throttled ones are resent in a smaller batch.
+# Returns {document_id: error or None}.
+def share_documents(drive_service, document_ids):
+    errors = {}
+    remaining = list(document_ids)
+
+    def callback(request_id, response, exception):
+        errors[request_id] = exception
+
+    for attempt in range(rate_scheduler.MAX_RETRIES + 1):
+        batch = drive_service.new_batch_http_request(callback=callback)
+        for document_id in remaining:
+            batch.add(
+                drive_service.permissions().create(fileId=document_id, body={'role': 'writer', 'type': 'anyone'}),
+                request_id=document_id
+            )
+        rate_scheduler.call(batch.execute, 'drive', 'write', cost=len(remaining), method='drive.batch')
+        logging.info(f"Shared {len(remaining)} documents in one batch request")
+
+        remaining = [document_id for document_id in remaining if rate_scheduler.is_retryable(errors[document_id])]
+        if not remaining or attempt == rate_scheduler.MAX_RETRIES:
+            return errors
+        if any(rate_scheduler.is_rate_limited(errors[document_id]) for document_id in remaining):
+            rate_scheduler.drain('drive', 'write')
+        time.sleep(rate_scheduler.backoff_delay(attempt))
+    return errors
+
+
+# Run create(record) for every record with bounded parallelism, share the finished
+# documents in batches and yield one result dict per record as soon as it is known.
+# validate(record) returns an error message or None; share(document_ids) returns
+# {document_id: error or None}; link(document_id) builds the docLink. When the batch stops
+# early (e.g. the client went away), discard(document_ids) gets the documents created but
+# not shared yet.
+def run(records, validate, create, share, link, parallelism=PARALLELISM, share_batch_size=SHARE_BATCH_SIZE,
+        discard=None):
+    records = enumerate(records)
+    exhausted = False
+    pending = {}
+    to_share = []
+
+    def result(index, record, **fields):
+        return dict(index=index, ibo_id=record.get('ibo_id') if isinstance(record, dict) else None, **fields)
+
+    def check(record):
+        if isinstance(record, InvalidRecord):
+            return record.message
+        if not isinstance(record, dict):
+            return "Each record must be a JSON object."
+        return validate(record)
+
+    def flush():
+        batch = to_share[:share_batch_size]
+        del to_share[:share_batch_size]
+        try:
+            errors = share([document_id for _, _, document_id in batch])
+        except Exception as e:
+            errors = {document_id: e for _, _, document_id in batch}
+        for index, record, document_id in batch:
+            error = errors.get(document_id)
+            if error:
+                yield result(index, record, success=False, documentId=document_id, message=str(error))
+            else:
+                yield result(index, record, success=True, documentId=document_id, docLink=link(document_id))
+
+    pool = ThreadPoolExecutor(max_workers=parallelism)
+    try:
+        while True:
+            # Keep a bounded number of records in flight so large streams are never fully buffered
+            while not exhausted and len(pending) < parallelism * 2:
+                try:
+                    index, record = next(records)
+                except StopIteration:
+                    exhausted = True
+                    break
+                error = check(record)
+                if error:
+                    yield result(index, record, success=False, message=error)
+                    continue
+                pending[pool.submit(create, record)] = (index, record)
+
+            if not pending:
+                while to_share:
+                    yield from flush()
+                return
+
+            done, _ = wait(pending, timeout=SHARE_FLUSH_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, record = pending.pop(future)
+                try:
+                    to_share.append((index, record, future.result()))
+                except Exception as e:
+                    logging.error(f"Batch record {index} failed: {e}")
+                    yield result(index, record, success=False, message=str(e))
+
+            # Share when a full batch is ready, or when nothing else finished in a while
+            while len(to_share) >= share_batch_size or (to_share and not done):
+                yield from flush()
+    finally:
+        # Cancel what has not started; what is running still finishes and is discarded below
+        pool.shutdown(wait=True, cancel_futures=True)
+        unshared = [document_id for _, _, document_id in to_share]
+        unshared += [
+            future.result() for future in pending
+            if not future.cancelled() and future.exception() is None
+        ]
+        if unshared and discard is not None:
+            discard(unshared)
@@ -0,0 +1,146 @@
+import os
+import time
+import threading
+import logging
+from googleapiclient.errors import HttpError
+
+import store
+import metrics
+import rate_scheduler
+import template_registry
+
+# Unpersonalized copies of the template kept ready in Drive (0 disables the pool)
+POOL_SIZE = int(os.getenv('GDOC_COPY_POOL_SIZE', 5))
+# How often the refiller checks the pool even when nothing was taken
+REFILL_INTERVAL = float(os.getenv('GDOC_COPY_POOL_REFILL_INTERVAL', 30))
+# Copies older than this are deleted and replaced, so the pool never hands out very old documents
+MAX_AGE = int(os.getenv('GDOC_COPY_POOL_MAX_AGE', 7 * 24 * 3600))
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS copy_pool (
+        document_id TEXT PRIMARY KEY,
+        template_hash TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS copy_pool_template ON copy_pool (template_hash, created_at)',
+    # Each Google identity (see credential_pool) keeps its own copies, in its own Drive
+    store.add_column('copy_pool', 'identity', "TEXT NOT NULL DEFAULT 'default'"),
+]
+
+_wake = threading.Event()
+_started_pid = None
+_start_lock = threading.Lock()
+
+
+def _db():
+    store.ensure_schema('copy_pool', SCHEMA)
+    return store.get_db()
+
+
+# Take a ready copy of the template's current version owned by an identity, or None when its pool is empty
+def take(template_file, identity='default'):
+    if POOL_SIZE <= 0:
+        return None
+    content_hash = template_registry.template_hash(template_file)
+    _db()
+    with store.transaction() as db:
+        row = db.execute(
+            'SELECT document_id FROM copy_pool WHERE template_hash = ? AND identity = ? AND created_at > ? '
+            'ORDER BY created_at LIMIT 1',
+            (content_hash, identity, time.time() - MAX_AGE)
+        ).fetchone()
+        if row:
+            db.execute('DELETE FROM copy_pool WHERE document_id = ?', (row['document_id'],))
+    _wake.set()
+    metrics.inc('gdoc_copy_pool_requests_total', outcome='hit' if row else 'miss')
+    return row['document_id'] if row else None
+
+
+def size(template_file, identity='default'):
+    return _db().execute(
+        'SELECT COUNT(*) AS count FROM copy_pool WHERE template_hash = ? AND identity = ?',
+        (template_registry.template_hash(template_file), identity)
+    ).fetchone()['count']
+
+
+# Every copy in the pool, of any template version and identity
+def document_ids():
+    return {row['document_id'] for row in _db().execute('SELECT document_id FROM copy_pool')}
+
+
+# Delete an identity's copies made from an older template version or past MAX_AGE
+def remove_stale(drive_service, template_file, identity='default'):
+    content_hash = template_registry.template_hash(template_file)
+    _db()
+    with store.transaction() as db:
+        stale = db.execute(
+            'SELECT document_id, template_hash, created_at FROM copy_pool '
+            'WHERE identity = ? AND (template_hash != ? OR created_at <= ?)',
+            (identity, content_hash, time.time() - MAX_AGE)
+        ).fetchall()
+        db.executemany('DELETE FROM copy_pool WHERE document_id = ?', [(row['document_id'],) for row in stale])
+
+    for row in stale:
+        try:
+            rate_scheduler.execute(drive_service.files().delete(fileId=row['document_id']), 'drive', 'write')
+        except HttpError as e:
+            if e.resp.status != 404:
+                # Keep it listed so the next round tries again
+                _db().execute(
+                    'INSERT OR IGNORE INTO copy_pool (document_id, template_hash, created_at, identity) '
+                    'VALUES (?, ?, ?, ?)',
+                    (row['document_id'], row['template_hash'], row['created_at'], identity)
+                )
+                logging.error(f"Could not delete stale pooled copy {row['document_id']}: {e}")
+                continue
+        metrics.inc('gdoc_copy_pool_removed_total')
+    if stale:
+        logging.info(f"Removed {len(stale)} stale pooled copies of {template_file} ({identity})")
+
+
+# Top an identity's pool up to POOL_SIZE copies of the template's current version
+def refill(drive_service, template_file, identity='default'):
+    content_hash = template_registry.template_hash(template_file)
+    missing = POOL_SIZE - size(template_file, identity)
+    for _ in range(missing):
+        document_id = template_registry.copy_template(drive_service, template_file, identity=identity)
+        _db().execute(
+            'INSERT INTO copy_pool (document_id, template_hash, created_at, identity) VALUES (?, ?, ?, ?)',
+            (document_id, content_hash, time.time(), identity)
+        )
+        metrics.inc('gdoc_copy_pool_refills_total')
+    if missing > 0:
+        logging.info(f"Added {missing} copies of {template_file} to the pool ({identity})")
+
+
+def _refill_loop(get_drive_services, template_file):
+    while True:
+        _wake.wait(REFILL_INTERVAL)
+        _wake.clear()
+        try:
+            # One worker maintains the pool at a time; refill copies are bulk work
+            with store.file_lock('copy-pool', blocking=False) as locked, rate_scheduler.priority('bulk'):
+                if not locked:
+                    continue
+                for identity, drive_service in get_drive_services().items():
+                    with rate_scheduler.identity(identity):
+                        remove_stale(drive_service, template_file, identity)
+                        refill(drive_service, template_file, identity)
+        except Exception as e:
+            logging.error(f"Could not refill the copy pool: {e}")
+
+
+# Start this process's pool refiller (once per gunicorn worker, after fork).
+# get_drive_services() returns {identity: Drive client} for the identities that are authorized.
+def start(get_drive_services, template_file):
+    global _started_pid
+    if POOL_SIZE <= 0 or _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+        threading.Thread(
+            target=_refill_loop, args=(get_drive_services, template_file), name='copy-pool-refiller', daemon=True
+        ).start()
+        _wake.set()
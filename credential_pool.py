@@ -0,0 +1,154 @@
+import os
+import re
+import time
+import threading
+import logging
+
+import store
+import credentials_manager
+import rate_scheduler
+
+# OAuth tokens of additional Google accounts, one <identity>.json per account
+IDENTITY_DIR = os.getenv('GDOC_IDENTITY_DIR', '.identities')
+# Comma-separated service account key files; each becomes an identity named after its file
+SERVICE_ACCOUNT_FILES = [path for path in os.getenv('GDOC_SERVICE_ACCOUNT_FILES', '').split(',') if path.strip()]
+# Quota classes a new document spends the most of, used to pick the identity to create it as
+ROUTING_QUOTAS = (('docs', 'write'), ('drive', 'write'))
+# Seconds an admin has to finish the consent screen of /identities/register
+REGISTRATION_TTL = int(os.getenv('GDOC_REGISTRATION_TTL', 3600))
+
+DEFAULT = 'default'
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+SCHEMA = [
+    # Registrations waiting for their OAuth callback, by the state of the flow that started them
+    '''CREATE TABLE IF NOT EXISTS pending_registrations (
+        state TEXT PRIMARY KEY,
+        identity TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )''',
+]
+
+
+def _db():
+    store.ensure_schema('pending_registrations', SCHEMA)
+    return store.get_db()
+
+
+# Service account credentials. google-auth fetches a new access token whenever the current
+# one has expired, so there is nothing to store or refresh in the background.
+class ServiceAccountIdentity:
+    def __init__(self, key_file, scopes):
+        self.key_file = key_file
+        self.scopes = scopes
+        self._creds = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._creds is None:
+            with self._lock:
+                if self._creds is None:
+                    from google.oauth2 import service_account
+                    try:
+                        self._creds = service_account.Credentials.from_service_account_file(
+                            self.key_file, scopes=self.scopes
+                        )
+                    except (OSError, ValueError) as e:
+                        logging.error(f"Could not load service account {self.key_file}: {e}")
+                        return None
+        return self._creds
+
+
+# Every Google identity documents can be created as: the account in token.json ('default'),
+# the accounts registered through /identities/register and the configured service accounts.
+# Each identity has its own rate buckets, so the pool multiplies the per-user quotas.
+class CredentialPool:
+    def __init__(self, default_manager, scopes):
+        self.scopes = scopes
+        self._identities = {DEFAULT: default_manager}
+        self._lock = threading.Lock()
+        for key_file in SERVICE_ACCOUNT_FILES:
+            name = os.path.splitext(os.path.basename(key_file.strip()))[0]
+            self._identities[name] = ServiceAccountIdentity(key_file.strip(), scopes)
+
+    def _token_file(self, name):
+        return os.path.join(IDENTITY_DIR, f'{name}.json')
+
+    def _oauth_identity(self, name):
+        with self._lock:
+            if name not in self._identities:
+                self._identities[name] = credentials_manager.CredentialManager(
+                    self._token_file(name), self.scopes, lock_name=f'token-refresh-{name}'
+                )
+            return self._identities[name]
+
+    # Identity names, including accounts registered by other workers since this one started
+    def names(self):
+        if os.path.isdir(IDENTITY_DIR):
+            for file_name in sorted(os.listdir(IDENTITY_DIR)):
+                name, extension = os.path.splitext(file_name)
+                if extension == '.json' and NAME_PATTERN.match(name) and name not in self._identities:
+                    self._oauth_identity(name)
+        return list(self._identities)
+
+    # Credentials of an identity, or None when it is unknown or not authorized
+    def get(self, name):
+        if name not in self._identities and name not in self.names():
+            return None
+        return self._identities[name].get()
+
+    def authorized(self):
+        return [name for name in self.names() if self.get(name)]
+
+    # Authorized identities, the one with the most quota left first
+    def ranked(self):
+        names = self.authorized()
+        return sorted(names, key=lambda name: -rate_scheduler.headroom(name, ROUTING_QUOTAS))
+
+    # Add (or re-authorize) an OAuth identity with credentials from the OAuth callback
+    def register(self, name, creds):
+        if name == DEFAULT:
+            self._identities[DEFAULT].save(creds)
+            return
+        if not NAME_PATTERN.match(name):
+            raise ValueError("Identity names may only use letters, digits, '-' and '_'.")
+        if isinstance(self._identities.get(name), ServiceAccountIdentity):
+            raise ValueError(f"{name} is a service account.")
+        os.makedirs(IDENTITY_DIR, exist_ok=True)
+        self._oauth_identity(name).save(creds)
+        logging.info(f"Registered Google identity {name}")
+
+    # Remember that the OAuth flow with this state registers identity `name`
+    def start_registration(self, state, name):
+        now = time.time()
+        db = _db()
+        db.execute('DELETE FROM pending_registrations WHERE created_at < ?', (now - REGISTRATION_TTL,))
+        db.execute(
+            'INSERT OR REPLACE INTO pending_registrations (state, identity, created_at) VALUES (?, ?, ?)',
+            (state, name, now)
+        )
+
+    # The identity the OAuth flow with this state registers, or None for an ordinary sign-in.
+    # Each registration is used once.
+    def finish_registration(self, state):
+        _db()
+        with store.transaction() as db:
+            row = db.execute(
+                'SELECT identity FROM pending_registrations WHERE state = ? AND created_at >= ?',
+                (state, time.time() - REGISTRATION_TTL)
+            ).fetchone()
+            db.execute('DELETE FROM pending_registrations WHERE state = ?', (state,))
+        return row['identity'] if row else None
+
+    # Quota use of every identity, summed over all workers
+    def stats(self):
+        return [
+            {
+                'identity': name,
+                'type': 'service_account' if isinstance(self._identities[name], ServiceAccountIdentity) else 'oauth',
+                'authorized': self.get(name) is not None,
+                'headroom': round(rate_scheduler.headroom(name, ROUTING_QUOTAS), 3),
+                'usage': rate_scheduler.usage(name),
+            }
+            for name in self.names()
+        ]
@@ -0,0 +1,138 @@
+import os
+import time
+import threading
+import logging
+from datetime import datetime, timedelta
+from google.auth.exceptions import RefreshError
+
+import store
+
+TOKEN_FILE = os.getenv('GDOC_TOKEN_FILE', 'token.json')
+# Refresh this many seconds before the access token expires
+REFRESH_AHEAD = int(os.getenv('GDOC_TOKEN_REFRESH_AHEAD', 300))
+# How often the background thread looks at the token (and at token.json written by other workers)
+CHECK_INTERVAL = int(os.getenv('GDOC_TOKEN_CHECK_INTERVAL', 30))
+
+
+# Keeps OAuth credentials in memory and refreshes them in the background before they expire.
+# Refreshes are serialized across all gunicorn workers with a file lock, and the winner writes
+# the new token to token.json so the other workers pick it up instead of refreshing again.
+# Each token file needs its own lock_name.
+class CredentialManager:
+    def __init__(self, token_file, scopes, lock_name='token-refresh'):
+        self.token_file = token_file
+        self.scopes = scopes
+        self.lock_name = lock_name
+        self._creds = None
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+
+    # Credentials for the request path: served from memory, only touching disk on a cold start
+    def get(self):
+        self._start_refresher()
+        creds = self._creds
+        if creds is not None and creds.valid:
+            return creds
+
+        with self._lock:
+            if self._creds is None or not self._creds.valid:
+                self._load()
+                if self._needs_refresh(self._creds):
+                    self._refresh()
+            creds = self._creds
+        return creds if creds is not None and creds.valid else None
+
+    # Save credentials from the OAuth callback and make them current in this worker
+    def save(self, creds):
+        with self._lock, store.file_lock(self.lock_name):
+            self._write(creds)
+            self._creds = creds
+
+    # Forget the credentials and delete token.json; returns False when there was nothing to delete
+    def clear(self):
+        with self._lock, store.file_lock(self.lock_name):
+            self._creds = None
+            self._mtime = None
+            if not os.path.exists(self.token_file):
+                return False
+            os.remove(self.token_file)
+            return True
+
+    def _needs_refresh(self, creds):
+        if creds is None or not creds.refresh_token:
+            return False
+        if creds.expiry is None:
+            return not creds.valid
+        return creds.expiry - datetime.utcnow() < timedelta(seconds=REFRESH_AHEAD)
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.token_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        mtime = self._file_mtime()
+        if mtime is None:
+            self._creds = None
+            self._mtime = None
+            return
+        if mtime == self._mtime and self._creds is not None:
+            return
+
+        from google.oauth2.credentials import Credentials
+        loaded = Credentials.from_authorized_user_file(self.token_file, self.scopes)
+        current = self._creds
+        if current is not None and current.refresh_token == loaded.refresh_token:
+            # Same grant: update in place so clients built on these credentials stay valid
+            current.token = loaded.token
+            current.expiry = loaded.expiry
+        else:
+            self._creds = loaded
+        self._mtime = mtime
+        logging.info(f"Loaded credentials from {self.token_file}")
+
+    def _write(self, creds):
+        tmp_file = f'{self.token_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as token:
+            token.write(creds.to_json())
+        os.replace(tmp_file, self.token_file)
+        self._mtime = self._file_mtime()
+
+    # Refresh once across all workers: whoever holds the lock refreshes, everyone else reloads
+    def _refresh(self):
+        with store.file_lock(self.lock_name):
+            self._load()
+            if not self._needs_refresh(self._creds):
+                return
+            # requests (used only for token refreshes) is slow to import; load it on first use
+            from google.auth.transport.requests import Request
+            try:
+                self._creds.refresh(Request())
+            except RefreshError as e:
+                logging.error(f"Could not refresh credentials: {e}")
+                return
+            self._write(self._creds)
+            logging.info(f"Refreshed credentials, new expiry {self._creds.expiry}")
+
+    def _start_refresher(self):
+        # Started lazily so every gunicorn worker (after fork) gets its own thread
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            threading.Thread(target=self._refresh_loop, name='credential-refresher', daemon=True).start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            try:
+                with self._lock:
+                    self._load()
+                    if self._needs_refresh(self._creds):
+                        self._refresh()
+            except Exception as e:
+                logging.error(f"Background credential refresh failed: {e}")
@@ -0,0 +1,272 @@
+import re
+import json
+import time
+import logging
+
+import store
+import template_registry
+import rate_scheduler
+
+CLICK_HERE = 'Click here'
+PLACEHOLDER_RE = re.compile(r'\{[^{}\s]+\}')
+# Bump when locate_placeholders() changes, so cached layouts are recomputed
+LAYOUT_VERSION = 2
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS template_layouts (
+        template_hash TEXT PRIMARY KEY,
+        layout TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )''',
+]
+
+
+# Docs API indexes count UTF-16 code units
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+# Text of a paragraph plus the document index it starts at. Non-text elements
+# (inline objects, page breaks...) are padded so offsets still line up with indexes.
+def _paragraph_text(paragraph):
+    elements = paragraph.get('elements', [])
+    if not elements:
+        return None, ''
+    start = elements[0].get('startIndex', 0)
+    parts = []
+    for element in elements:
+        text_run = element.get('textRun')
+        if text_run:
+            parts.append(text_run.get('content', ''))
+        else:
+            parts.append('\ufffc' * (element.get('endIndex', 0) - element.get('startIndex', 0)))
+    return start, ''.join(parts)
+
+
+# Fields mask for structural content: paragraphs with the given element fields, walked into
+# tables nested up to `depth` levels (deeper ones are fetched whole)
+def _content_fields(element_fields, depth=3):
+    paragraph = f'paragraph(elements({element_fields}))'
+    if depth == 0:
+        return f'content({paragraph},table)'
+    return f'content({paragraph},table(tableRows(tableCells({_content_fields(element_fields, depth - 1)}))))'
+
+
+# Only what the locators read; headers, footers and footnotes are small and fetched whole
+PLACEHOLDER_FIELDS = f"body({_content_fields('startIndex,endIndex,textRun(content)')}),headers,footers,footnotes"
+LINK_FIELDS = f"body({_content_fields('startIndex,endIndex,textRun(textStyle(link(url)))')}),headers,footers,footnotes"
+
+
+# Every paragraph of a structural content list, including those inside (nested) tables
+def _paragraphs(content):
+    for element in content:
+        if 'paragraph' in element:
+            yield element['paragraph']
+        elif 'table' in element:
+            for row in element['table'].get('tableRows', []):
+                for cell in row.get('tableCells', []):
+                    yield from _paragraphs(cell.get('content', []))
+        elif 'tableOfContents' in element:
+            yield from _paragraphs(element['tableOfContents'].get('content', []))
+
+
+# (segment_id, paragraph) for the body (segment None), every header, footer and footnote
+def _segment_paragraphs(document):
+    for paragraph in _paragraphs(document.get('body', {}).get('content', [])):
+        yield None, paragraph
+    for key in ('headers', 'footers', 'footnotes'):
+        for segment_id, segment in document.get(key, {}).items():
+            for paragraph in _paragraphs(segment.get('content', [])):
+                yield segment_id, paragraph
+
+
+# Find every {placeholder} in a Docs API document in one pass over its structure:
+# body, tables and nested cells, headers, footers and footnotes
+def locate_placeholders(document):
+    occurrences = []
+    for segment_id, paragraph in _segment_paragraphs(document):
+        start, text = _paragraph_text(paragraph)
+        if start is None or '{' not in text:
+            continue
+        for match in PLACEHOLDER_RE.finditer(text):
+            tag_start = start + utf16_len(text[:match.start()])
+            occurrences.append({
+                'tag': match.group(),
+                'segment_id': segment_id,
+                'start': tag_start,
+                'end': tag_start + utf16_len(match.group()),
+            })
+    return occurrences
+
+
+# Placeholder layout of a template, computed once from its master Google Doc and cached by content hash
+def get_layout(drive_service, docs_service, template_file, identity='default'):
+    # Layouts found by an older locator may miss placeholders, so the version is part of the key
+    layout_key = f'{template_registry.template_hash(template_file)}-v{LAYOUT_VERSION}'
+    store.ensure_schema('template_layouts', SCHEMA)
+    row = store.get_db().execute(
+        'SELECT layout FROM template_layouts WHERE template_hash = ?', (layout_key,)
+    ).fetchone()
+    if row:
+        return json.loads(row['layout'])
+
+    # The layout is the same for every identity, but each reads its own master
+    master_id = template_registry.get_master_id(drive_service, template_file, identity)
+    document = rate_scheduler.execute(
+        docs_service.documents().get(documentId=master_id, fields=PLACEHOLDER_FIELDS), 'docs', 'read'
+    )
+    layout = locate_placeholders(document)
+    store.get_db().execute(
+        'INSERT OR REPLACE INTO template_layouts (template_hash, layout, created_at) VALUES (?, ?, ?)',
+        (layout_key, json.dumps(layout), time.time())
+    )
+    logging.info(f"Computed placeholder layout for {template_file}: {len(layout)} placeholders.")
+    return layout
+
+
+def _range(segment_id, start, end):
+    text_range = {'startIndex': start, 'endIndex': end}
+    if segment_id:
+        text_range['segmentId'] = segment_id
+    return text_range
+
+
+# Build the single batchUpdate that personalizes a copy of the template.
+# Placeholders are rewritten from the end of each segment backwards, so every request
+# uses the indexes from the layout as-is: nothing earlier in the segment has moved yet.
+# Text is inserted after the placeholder's opening brace before the placeholder is
+# removed, so it picks up the placeholder's own formatting.
+def build_requests(layout, tag_to_link, replacements):
+    requests = []
+    ordered = sorted(layout, key=lambda o: (o['segment_id'] or '', -o['start']))
+
+    for occurrence in ordered:
+        tag = occurrence['tag']
+        if tag in tag_to_link:
+            text, link = CLICK_HERE, tag_to_link[tag]
+        elif tag in replacements:
+            text, link = replacements[tag] or '', None
+        else:
+            continue
+
+        segment_id, start, end = occurrence['segment_id'], occurrence['start'], occurrence['end']
+        length = utf16_len(text)
+        if length:
+            location = {'index': start + 1}
+            if segment_id:
+                location['segmentId'] = segment_id
+            requests.append({'insertText': {'location': location, 'text': text}})
+            requests.append({'deleteContentRange': {'range': _range(segment_id, start + 1 + length, end + length)}})
+            requests.append({'deleteContentRange': {'range': _range(segment_id, start, start + 1)}})
+        else:
+            requests.append({'deleteContentRange': {'range': _range(segment_id, start, end)}})
+
+        if link and length:
+            requests.append({
+                'updateTextStyle': {
+                    'range': _range(segment_id, start, start + length),
+                    'textStyle': {
+                        'bold': True,
+                        'link': {
+                            'url': link
+                        }
+                    },
+                    'fields': 'bold,link'
+                }
+            })
+    return requests
+
+
+# Where each link and each filled-in placeholder (e.g. {ibo_name}) ends up once build_requests()
+# has been applied: walking each segment forwards, every earlier replacement shifts the later
+# ones by its change in length.
+def final_ranges(layout, tag_to_link, replacements):
+    ranges = []
+    shift = {}
+    ordered = sorted(layout, key=lambda o: (o['segment_id'] or '', o['start']))
+
+    for occurrence in ordered:
+        tag = occurrence['tag']
+        if tag in tag_to_link:
+            text = CLICK_HERE
+        elif tag in replacements:
+            text = replacements[tag] or ''
+        else:
+            continue
+
+        segment_id = occurrence['segment_id']
+        start = occurrence['start'] + shift.get(segment_id, 0)
+        length = utf16_len(text)
+        ranges.append({'tag': tag, 'segment_id': segment_id, 'start': start, 'end': start + length})
+        shift[segment_id] = shift.get(segment_id, 0) + length - (occurrence['end'] - occurrence['start'])
+    return ranges
+
+
+# Requests that replace the text of the given ranges (e.g. every filled-in {ibo_name}) with
+# `text`, from the end of each segment backwards like build_requests(), keeping each range's
+# formatting. Ranges the placeholder was emptied into (start == end) get the text inserted.
+def replace_text_requests(ranges, text):
+    requests = []
+    length = utf16_len(text)
+    for text_range in sorted(ranges, key=lambda r: (r['segment_id'] or '', -r['start'])):
+        segment_id, start, end = text_range['segment_id'], text_range['start'], text_range['end']
+        location = {'index': start + 1 if end > start else start}
+        if segment_id:
+            location['segmentId'] = segment_id
+        if length:
+            requests.append({'insertText': {'location': location, 'text': text}})
+        if end > start and length:
+            requests.append({'deleteContentRange': {'range': _range(segment_id, start + 1 + length, end + length)}})
+            requests.append({'deleteContentRange': {'range': _range(segment_id, start, start + 1)}})
+        elif end > start:
+            requests.append({'deleteContentRange': {'range': _range(segment_id, start, end)}})
+    return requests
+
+
+# `ranges` once replace_text_requests(replaced, text) has been applied: the replaced ones now
+# hold `text`, and everything after them in the same segment has moved
+def shift_ranges(ranges, replaced, text):
+    length = utf16_len(text)
+    replaced_keys = {(r['segment_id'], r['start']) for r in replaced}
+    shifted = []
+    for text_range in ranges:
+        shift = sum(
+            length - (r['end'] - r['start']) for r in replaced
+            if r['segment_id'] == text_range['segment_id'] and r['start'] < text_range['start']
+        )
+        start = text_range['start'] + shift
+        if (text_range['segment_id'], text_range['start']) in replaced_keys:
+            end = start + length
+        else:
+            end = text_range['end'] + shift
+        shifted.append(dict(text_range, start=start, end=end))
+    return shifted
+
+
+# Every linked text run of a document fetched with LINK_FIELDS, in any segment or table
+def locate_links(document):
+    links = []
+    for segment_id, paragraph in _segment_paragraphs(document):
+        for run in paragraph.get('elements', []):
+            url = run.get('textRun', {}).get('textStyle', {}).get('link', {}).get('url')
+            if url:
+                links.append({'url': url, 'segment_id': segment_id, 'start': run['startIndex'], 'end': run['endIndex']})
+    return links
+
+
+# Requests that point existing links at new URLs without touching the text
+def relink_requests(ranges, url_for_range):
+    requests = []
+    for text_range in ranges:
+        requests.append({
+            'updateTextStyle': {
+                'range': _range(text_range['segment_id'], text_range['start'], text_range['end']),
+                'textStyle': {
+                    'link': {
+                        'url': url_for_range(text_range)
+                    }
+                },
+                'fields': 'link'
+            }
+        })
+    return requests
@@ -0,0 +1,292 @@
+import io
+import re
+import zipfile
+import threading
+import logging
+from collections import namedtuple
+from xml.sax.saxutils import escape, unescape
+
+import template_registry
+import template_slimmer
+
+DOCUMENT_PART = 'word/document.xml'
+RELS_PART = 'word/_rels/document.xml.rels'
+HYPERLINK_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink'
+CLICK_HERE = 'Click here'
+PLACEHOLDER_RE = re.compile(r'\{[^{}\s]+\}')
+
+# An opening, closing or self-closing tag
+TAG_RE = re.compile(r'<(/?)([\w.:-]+)[^>]*?(/?)>')
+
+# Order of the run properties we add, as required by the WordprocessingML schema
+RPR_ORDER = ['w:rStyle', 'w:rFonts', 'w:b']
+
+
+# A placeholder in the parsed template, to be filled in at render time
+class Slot:
+    def __init__(self, tag, rpr):
+        self.tag = tag
+        self.rpr = rpr
+
+
+# A template parsed once: document.xml split into static XML and slots, plus a
+# zip of every part that never changes between documents
+class ParsedTemplate:
+    def __init__(self, content_hash, segments, rels_xml, static_zip):
+        self.content_hash = content_hash
+        self.segments = segments
+        self.rels_xml = rels_xml
+        self.static_zip = static_zip
+
+    @property
+    def tags(self):
+        return {segment.tag for segment in self.segments if isinstance(segment, Slot)}
+
+
+# An element of the XML being parsed, by position. close_start is None for a self-closing tag.
+Element = namedtuple('Element', 'name start open_end close_start end')
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _text_node(text):
+    return f'<w:t xml:space="preserve">{escape(text)}</w:t>'
+
+
+# The top-level elements of xml[start:end], matching nested tags of the same name
+# (a text box paragraph inside a paragraph) and self-closing ones (<w:p/>, <w:r/>)
+def _elements(xml, start, end):
+    depth = 0
+    for match in TAG_RE.finditer(xml, start, end):
+        closing, name, self_closing = match.groups()
+        if closing:
+            depth -= 1
+            if depth == 0:
+                yield Element(name, element_start, open_end, match.start(), match.end())
+        elif self_closing:
+            if depth == 0:
+                yield Element(name, match.start(), match.end(), None, match.end())
+        else:
+            if depth == 0:
+                element_start, open_end = match.start(), match.end()
+            depth += 1
+
+
+# Join static XML onto the previous segment so rendering is a short join
+def _append(segments, segment):
+    if isinstance(segment, str) and segments and isinstance(segments[-1], str):
+        segments[-1] += segment
+    else:
+        segments.append(segment)
+
+
+# Split a run into its opening tag, properties and children. Text children are ('t', text);
+# any other child is ('x', segments), since a text box in it has paragraphs of its own.
+def _parse_run(xml, run):
+    rpr = ''
+    children = []
+    for child in _elements(xml, run.open_end, run.close_start):
+        if child.name == 'w:rPr' and not rpr and not children:
+            rpr = xml[child.start:child.end]
+        elif child.name == 'w:t':
+            text = '' if child.close_start is None else unescape(xml[child.open_end:child.close_start])
+            children.append(('t', text))
+        else:
+            segments = []
+            _split_paragraphs(xml, child.start, child.end, segments)
+            children.append(('x', segments))
+    return xml[run.start:run.open_end], rpr, children
+
+
+# Runs of a paragraph, including those in hyperlinks, tracked changes and other wrappers, as
+# ('run', parsed run), and the XML between them as ('xml', text)
+def _paragraph_pieces(xml, start, end, pieces):
+    position = start
+    for element in _elements(xml, start, end):
+        if element.close_start is None:
+            continue
+        if element.name == 'w:r':
+            pieces.append(('xml', xml[position:element.start]))
+            pieces.append(('run', _parse_run(xml, element)))
+            position = element.end
+        elif element.name != 'w:p':
+            pieces.append(('xml', xml[position:element.open_end]))
+            _paragraph_pieces(xml, element.open_end, element.close_start, pieces)
+            position = element.close_start
+    pieces.append(('xml', xml[position:end]))
+
+
+# Rewrite one paragraph so every placeholder becomes a Slot, even when Word split it
+# across several runs (spell-check marks, rsid changes...). Returns None if there are none.
+# Other run children in a placeholder (a tab, a break) are kept after its value.
+def _parse_paragraph(inner_xml):
+    pieces = []
+    _paragraph_pieces(inner_xml, 0, len(inner_xml), pieces)
+    pieces = [(kind, piece) for kind, piece in pieces if piece]
+
+    text = ''.join(
+        value for kind, run in pieces if kind == 'run' for child_kind, value in run[2] if child_kind == 't'
+    )
+    spans = [(m.start(), m.end(), m.group()) for m in PLACEHOLDER_RE.finditer(text)]
+    nested = any(
+        isinstance(segment, Slot)
+        for kind, run in pieces if kind == 'run' for child_kind, value in run[2] if child_kind == 'x'
+        for segment in value
+    )
+    if not spans and not nested:
+        return None
+
+    segments = []
+    offset = 0
+    span_index = 0
+    in_span = False
+
+    for kind, piece in pieces:
+        if kind == 'xml':
+            segments.append(piece)
+            continue
+
+        open_tag, rpr, children = piece
+        current = []
+
+        def flush():
+            if current:
+                run = [open_tag + rpr]
+                for segment in current + ['</w:r>']:
+                    _append(run, segment)
+                segments.extend(run)
+                current.clear()
+
+        for child_kind, value in children:
+            if child_kind == 'x':
+                current.extend(value)
+                continue
+            kept = ''
+            for char in value:
+                if span_index < len(spans) and offset == spans[span_index][0]:
+                    if kept:
+                        current.append(_text_node(kept))
+                        kept = ''
+                    flush()
+                    segments.append(Slot(spans[span_index][2], rpr))
+                    in_span = True
+                if not in_span:
+                    kept += char
+                offset += 1
+                if in_span and offset == spans[span_index][1]:
+                    in_span = False
+                    span_index += 1
+            if kept:
+                current.append(_text_node(kept))
+        flush()
+    return segments
+
+
+# Append xml[start:end] to segments with the placeholders of every paragraph in it as Slots
+def _split_paragraphs(xml, start, end, segments):
+    position = start
+    for element in _elements(xml, start, end):
+        if element.close_start is None:
+            continue
+        if element.name == 'w:p':
+            parsed = _parse_paragraph(xml[element.open_end:element.close_start])
+            if parsed is None:
+                continue
+            _append(segments, xml[position:element.open_end])
+            for segment in parsed:
+                _append(segments, segment)
+        else:
+            _append(segments, xml[position:element.open_end])
+            _split_paragraphs(xml, element.open_end, element.close_start, segments)
+        position = element.close_start
+    _append(segments, xml[position:end])
+
+
+def _parse_document(document_xml):
+    segments = []
+    _split_paragraphs(document_xml, 0, len(document_xml), segments)
+    return segments
+
+
+# Zip of every untouched part, compressed once; renders append the two personalized parts
+def _static_zip(source):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as target:
+        for info in source.infolist():
+            if info.filename in (DOCUMENT_PART, RELS_PART):
+                continue
+            target.writestr(info, source.read(info.filename), compress_type=info.compress_type)
+    return buffer.getvalue()
+
+
+# Parse a template, or return the cached parse for its current contents
+def load_template(template_file):
+    content_hash = template_registry.template_hash(template_file)
+    template = _cache.get(template_file)
+    if template is not None and template.content_hash == content_hash:
+        return template
+
+    with _cache_lock:
+        template = _cache.get(template_file)
+        if template is not None and template.content_hash == content_hash:
+            return template
+
+        with zipfile.ZipFile(template_slimmer.slim_template(template_file)) as source:
+            segments = _parse_document(source.read(DOCUMENT_PART).decode('utf-8'))
+            rels_xml = source.read(RELS_PART).decode('utf-8')
+            static_zip = _static_zip(source)
+
+        template = ParsedTemplate(content_hash, segments, rels_xml, static_zip)
+        _cache[template_file] = template
+        logging.info(f"Parsed template {template_file}: {len(template.tags)} distinct placeholders.")
+        return template
+
+
+# Add run properties (e.g. <w:b/>) to a <w:rPr>, keeping the schema order
+def _with_properties(rpr, properties):
+    inner = rpr[len('<w:rPr>'):-len('</w:rPr>')] if rpr.startswith('<w:rPr>') else ''
+    for name, xml in properties:
+        if re.search(rf'<{name}\b', inner):
+            continue
+        later = RPR_ORDER[RPR_ORDER.index(name) + 1:]
+        match = re.search(r'<(' + '|'.join(later) + r')\b', inner) if later else None
+        position = match.start() if match else (0 if name == 'w:rStyle' else len(inner))
+        inner = inner[:position] + xml + inner[position:]
+    return f'<w:rPr>{inner}</w:rPr>'
+
+
+# Fill a parsed template and return the personalized .docx as bytes
+def render(template, tag_to_link, replacements):
+    parts = []
+    relationships = []
+
+    for segment in template.segments:
+        if isinstance(segment, str):
+            parts.append(segment)
+        elif segment.tag in tag_to_link:
+            rel_id = f'rIdGdoc{len(relationships) + 1}'
+            relationships.append(
+                f'<Relationship Id="{rel_id}" Type="{HYPERLINK_REL}" '
+                f'Target="{escape(tag_to_link[segment.tag], {chr(34): "&quot;"})}" TargetMode="External"/>'
+            )
+            rpr = _with_properties(segment.rpr, [('w:rStyle', '<w:rStyle w:val="Hyperlink"/>'), ('w:b', '<w:b/>')])
+            parts.append(f'<w:hyperlink r:id="{rel_id}" w:history="1"><w:r>{rpr}{_text_node(CLICK_HERE)}</w:r></w:hyperlink>')
+        elif segment.tag in replacements:
+            value = replacements[segment.tag]
+            if value:
+                parts.append(f'<w:r>{segment.rpr}{_text_node(str(value))}</w:r>')
+        else:
+            parts.append(f'<w:r>{segment.rpr}{_text_node(segment.tag)}</w:r>')
+
+    rels_xml = template.rels_xml.replace('</Relationships>', ''.join(relationships) + '</Relationships>')
+
+    buffer = io.BytesIO(template.static_zip)
+    with zipfile.ZipFile(buffer, 'a', zipfile.ZIP_DEFLATED) as target:
+        target.writestr(DOCUMENT_PART, ''.join(parts))
+        target.writestr(RELS_PART, rels_xml)
+    return buffer.getvalue()
+
+
+def render_file(template_file, tag_to_link, replacements):
+    return render(load_template(template_file), tag_to_link, replacements)
@@ -0,0 +1,155 @@
+import os
+import time
+import hashlib
+import logging
+from collections import namedtuple
+
+import store
+import metrics
+import rate_scheduler
+import template_registry
+
+# Exported files, one per distinct content, named by its SHA-256 and shared by all workers
+EXPORT_DIR = os.getenv('GDOC_EXPORT_DIR', '.exports')
+# Disk space for exports; the least recently downloaded ones are deleted beyond it
+MAX_BYTES = int(float(os.getenv('GDOC_EXPORT_CACHE_MB', 500)) * 1024 * 1024)
+# How often a cache hit updates the entry's last use (for LRU eviction)
+TOUCH_INTERVAL = 60
+
+FORMATS = {
+    'pdf': 'application/pdf',
+    'docx': template_registry.DOCX_MIMETYPE,
+}
+
+SCHEMA = [
+    # version is the ibo_documents.updated_at the export was made from
+    '''CREATE TABLE IF NOT EXISTS export_cache (
+        document_id TEXT NOT NULL,
+        format TEXT NOT NULL,
+        version REAL NOT NULL,
+        sha256 TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (document_id, format)
+    )''',
+    'CREATE INDEX IF NOT EXISTS export_cache_sha256 ON export_cache (sha256)',
+]
+
+Export = namedtuple('Export', 'path sha256 size')
+
+
+def _db():
+    store.ensure_schema('export_cache', SCHEMA)
+    return store.get_db()
+
+
+# Absolute, since send_file resolves relative paths against the app's directory
+def _blob_path(sha256, export_format):
+    return os.path.abspath(os.path.join(EXPORT_DIR, f'{sha256}.{export_format}'))
+
+
+def _lookup(document_id, export_format, version):
+    row = _db().execute(
+        'SELECT * FROM export_cache WHERE document_id = ? AND format = ?', (document_id, export_format)
+    ).fetchone()
+    if row is None or row['version'] != version or not os.path.exists(_blob_path(row['sha256'], export_format)):
+        return None
+    if time.time() - row['last_used'] > TOUCH_INTERVAL:
+        _db().execute(
+            'UPDATE export_cache SET last_used = ? WHERE document_id = ? AND format = ?',
+            (time.time(), document_id, export_format)
+        )
+    return Export(_blob_path(row['sha256'], export_format), row['sha256'], row['size'])
+
+
+# Delete the files no cache entry points at any more
+def _remove_unused(db, blobs):
+    for sha256, export_format in blobs:
+        if db.execute('SELECT 1 FROM export_cache WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone() is None:
+            try:
+                os.remove(_blob_path(sha256, export_format))
+            except FileNotFoundError:
+                pass
+
+
+# Drop the least recently used exports until the cache fits in MAX_BYTES, always keeping the newest
+def _evict(db):
+    blobs = db.execute(
+        'SELECT sha256, format, MAX(size) AS size, MAX(last_used) AS last_used FROM export_cache '
+        'GROUP BY sha256, format ORDER BY last_used'
+    ).fetchall()
+    total = sum(blob['size'] for blob in blobs)
+    evicted = []
+    for blob in blobs[:-1]:
+        if total <= MAX_BYTES:
+            break
+        db.execute('DELETE FROM export_cache WHERE sha256 = ?', (blob['sha256'],))
+        evicted.append((blob['sha256'], blob['format']))
+        total -= blob['size']
+    _remove_unused(db, evicted)
+    if evicted:
+        metrics.inc('gdoc_export_cache_evictions_total', len(evicted))
+
+
+def _store(document_id, export_format, version, data):
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = _blob_path(sha256, export_format)
+    if not os.path.exists(path):
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as handle:
+            handle.write(data)
+        os.replace(tmp_file, path)
+
+    store.ensure_schema('export_cache', SCHEMA)
+    with store.transaction() as db:
+        previous = db.execute(
+            'SELECT sha256 FROM export_cache WHERE document_id = ? AND format = ?', (document_id, export_format)
+        ).fetchone()
+        db.execute(
+            'INSERT OR REPLACE INTO export_cache (document_id, format, version, sha256, size, last_used) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (document_id, export_format, version, sha256, len(data), time.time())
+        )
+        if previous and previous['sha256'] != sha256:
+            _remove_unused(db, [(previous['sha256'], export_format)])
+        _evict(db)
+    return Export(path, sha256, len(data))
+
+
+# The document exported as `export_format` ('pdf' or 'docx'), from the cache when it was exported
+# since the document last changed. `version` is the document's ibo_documents.updated_at, so an
+# export that raced with an update is never served for the new version. Concurrent requests for
+# the same export wait for the first one instead of exporting again.
+def get(drive_service, document_id, export_format, version):
+    export = _lookup(document_id, export_format, version)
+    if export is None:
+        with store.file_lock(f'export-{document_id}-{export_format}'):
+            export = _lookup(document_id, export_format, version)
+            if export is None:
+                start = time.perf_counter()
+                data = rate_scheduler.execute(
+                    drive_service.files().export(fileId=document_id, mimeType=FORMATS[export_format]), 'drive', 'read'
+                )
+                export = _store(document_id, export_format, version, data)
+                logging.info(
+                    f"Exported document ID: {document_id} as {export_format} ({len(data)} bytes) "
+                    f"in {time.perf_counter() - start:.2f}s"
+                )
+                metrics.inc('gdoc_export_cache_requests_total', format=export_format, result='miss')
+                return export
+    metrics.inc('gdoc_export_cache_requests_total', format=export_format, result='hit')
+    return export
+
+
+# Forget every export of a document (it was updated, regenerated or deleted)
+def invalidate(document_id):
+    store.ensure_schema('export_cache', SCHEMA)
+    with store.transaction() as db:
+        blobs = db.execute(
+            'SELECT sha256, format FROM export_cache WHERE document_id = ?', (document_id,)
+        ).fetchall()
+        if not blobs:
+            return
+        db.execute('DELETE FROM export_cache WHERE document_id = ?', (document_id,))
+        _remove_unused(db, [(blob['sha256'], blob['format']) for blob in blobs])
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import queue
+import threading
+import logging
+from googleapiclient.discovery_cache import DISCOVERY_DOC_DIR
+
+import profiler
+
+# Discovery documents are read from local static copies, never fetched over the network.
+# GDOC_DISCOVERY_DIR can point at pinned copies; by default the ones bundled with googleapiclient are used.
+DISCOVERY_DIR = os.getenv('GDOC_DISCOVERY_DIR', DISCOVERY_DOC_DIR)
+HTTP_TIMEOUT = int(os.getenv('GDOC_HTTP_TIMEOUT', 60))
+# Connections per set of credentials shared by all threads of a worker
+HTTP_POOL_SIZE = int(os.getenv('GDOC_HTTP_POOL_SIZE', 16))
+# Send every Google API call to another server, e.g. http://127.0.0.1:8999/ for benchmarks/fake_google.py
+API_ROOT = os.getenv('GDOC_GOOGLE_API_ROOT')
+
+_documents = {}
+_documents_lock = threading.Lock()
+_services = {}
+_services_lock = threading.Lock()
+
+# httplib2, google-auth and googleapiclient.discovery are imported on first use: together they
+# are most of a worker's import time, and preload() loads them in the background once it serves.
+
+
+# A thread-safe stand-in for an authorized httplib2.Http. httplib2 connections cannot be
+# shared between threads, so each request borrows one from a pool of up to `size`
+# connections and returns it afterwards; the most recently used (still warm) one is reused first.
+class PooledHttp:
+    def __init__(self, credentials, size=HTTP_POOL_SIZE):
+        self.credentials = credentials
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        import httplib2
+        import google_auth_httplib2
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+
+    def request(self, uri, method='GET', body=None, *args, **kwargs):
+        with self._slots:
+            try:
+                http = self._idle.get_nowait()
+            except queue.Empty:
+                http = self._connect()
+            start = time.perf_counter()
+            try:
+                response, content = http.request(uri, method, body, *args, **kwargs)
+            finally:
+                self._idle.put(http)
+        if profiler.current() is not None:
+            profiler.record(
+                'http', start, method=method, path=uri.split('?', 1)[0], status=response.status,
+                request_bytes=len(body or b''), response_bytes=len(content or b''),
+                seconds=round(time.perf_counter() - start, 4)
+            )
+        return response, content
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# Parsed discovery document for an API, loaded once per process
+def get_discovery_document(api, version):
+    key = (api, version)
+    document = _documents.get(key)
+    if document is None:
+        with _documents_lock:
+            document = _documents.get(key)
+            if document is None:
+                path = os.path.join(DISCOVERY_DIR, f'{api}.{version}.json')
+                logging.debug(f"Loading discovery document {path}")
+                with open(path) as handle:
+                    document = json.load(handle)
+                if API_ROOT:
+                    # rootUrl also decides where uploads and batch requests go, not just baseUrl
+                    root = API_ROOT.rstrip('/') + '/'
+                    document.update(rootUrl=root, mtlsRootUrl=root, baseUrl=root + document['servicePath'])
+                _documents[key] = document
+    return document
+
+
+# Build a new client from the cached discovery document with its own authorized connection
+def build_service(api, version, creds):
+    import httplib2
+    import google_auth_httplib2
+    from googleapiclient.discovery import build_from_document
+    http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+    return build_from_document(get_discovery_document(api, version), http=http)
+
+
+# Return this process's client for an API, bound to the given credentials of an identity
+# (see credential_pool). The client is shared by every thread (gthread workers, job workers,
+# pipeline stages) and sends requests over a pool of connections, rebuilt only when the
+# identity's credentials object changes.
+def get_service(api, version, creds, identity='default'):
+    # Keyed by process too: connections opened before a fork must not be shared
+    key = (os.getpid(), api, version, identity)
+    cached = _services.get(key)
+    if cached and cached[0] is creds:
+        return cached[1]
+
+    with _services_lock:
+        cached = _services.get(key)
+        if cached and cached[0] is creds:
+            return cached[1]
+        if cached:
+            cached[1]._http.close()
+        from googleapiclient.discovery import build_from_document
+        service = build_from_document(get_discovery_document(api, version), http=PooledHttp(creds))
+        _services[key] = (creds, service)
+    return service
+
+
+def drive_service(creds, identity='default'):
+    return get_service('drive', 'v3', creds, identity)
+
+
+def docs_service(creds, identity='default'):
+    return get_service('docs', 'v1', creds, identity)
+
+
+# Import the Google client stack and parse the discovery documents on a background thread, so
+# a worker accepts requests right away and its first documents do not pay for the imports
+def preload():
+    def load():
+        import httplib2
+        import google_auth_httplib2
+        import google.oauth2.credentials
+        import googleapiclient.discovery
+        import googleapiclient.http
+        for api, version in (('drive', 'v3'), ('docs', 'v1')):
+            get_discovery_document(api, version)
+        logging.debug("Preloaded the Google client libraries")
+
+    threading.Thread(target=load, name='google-preload', daemon=True).start()
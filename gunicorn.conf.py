@@ -0,0 +1,23 @@
+# gunicorn settings for the web process: gunicorn -c gunicorn.conf.py app:app
+#
+# Threaded (gthread) workers: a request mostly waits on Google, and the Google clients share a
+# pooled, thread-safe transport (google_clients.PooledHttp), so one worker serves many requests
+# at once. Documents are generated by each worker's job threads (GDOC_JOB_WORKERS), which is
+# what bounds in-flight generations; benchmarks/bench_create_doc.py measures it. admission.py
+# turns requests away with 429 before the queue grows longer than those threads can serve in time.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+threads = int(os.getenv('GDOC_WEB_THREADS', 16))
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+
+
+# Workers boot without the Google client libraries and load them in the background once they
+# serve (google_clients.preload); benchmarks/bench_startup.py measures the difference.
+def post_worker_init(worker):
+    import google_clients
+    google_clients.preload()
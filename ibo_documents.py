@@ -0,0 +1,62 @@
+import json
+import time
+
+import store
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS ibo_documents (
+        ibo_id TEXT PRIMARY KEY,
+        document_id TEXT NOT NULL,
+        ibo_name TEXT,
+        template_hash TEXT,
+        tag_to_link TEXT NOT NULL,
+        link_ranges TEXT,
+        updated_at REAL NOT NULL
+    )''',
+    # Google identity (see credential_pool) that owns the document
+    store.add_column('ibo_documents', 'identity', "TEXT NOT NULL DEFAULT 'default'"),
+]
+
+
+def _db():
+    store.ensure_schema('ibo_documents', SCHEMA)
+    return store.get_db()
+
+
+# Remember the current document of an IBO and the links it was generated with.
+# link_ranges are the final ranges of every link and filled-in placeholder, when the pipeline knows them.
+def save(ibo_id, document_id, ibo_name, template_hash, tag_to_link, link_ranges=None, identity='default'):
+    _db().execute(
+        'INSERT OR REPLACE INTO ibo_documents '
+        '(ibo_id, document_id, ibo_name, template_hash, tag_to_link, link_ranges, updated_at, identity) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (
+            str(ibo_id), document_id, ibo_name, template_hash, json.dumps(tag_to_link),
+            json.dumps(link_ranges) if link_ranges is not None else None, time.time(), identity
+        )
+    )
+
+
+def get(ibo_id):
+    row = _db().execute('SELECT * FROM ibo_documents WHERE ibo_id = ?', (str(ibo_id),)).fetchone()
+    if not row:
+        return None
+    record = dict(row)
+    record['tag_to_link'] = json.loads(record['tag_to_link'])
+    record['link_ranges'] = json.loads(record['link_ranges']) if record['link_ranges'] else None
+    return record
+
+
+def get_by_document(document_id):
+    row = _db().execute('SELECT ibo_id FROM ibo_documents WHERE document_id = ?', (document_id,)).fetchone()
+    return get(row['ibo_id']) if row else None
+
+
+# Drop the IBO record pointing at a document that was deleted
+def forget_document(document_id):
+    _db().execute('DELETE FROM ibo_documents WHERE document_id = ?', (document_id,))
+
+
+# Tags whose link differs between the stored map and a new one
+def changed_tags(old_tag_to_link, new_tag_to_link):
+    return [tag for tag, link in new_tag_to_link.items() if old_tag_to_link.get(tag) != link]
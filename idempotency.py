@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+from concurrent.futures import Future
+import psutil
+
+import store
+
+# A pending claim older than this is assumed to belong to a crashed worker
+STALE_AFTER = int(os.getenv('GDOC_IDEMPOTENCY_STALE_AFTER', 300))
+# How often a worker waiting on another worker's identical run checks for its result
+WAIT_INTERVAL = float(os.getenv('GDOC_IDEMPOTENCY_WAIT_INTERVAL', 0.5))
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS generation_index (
+        key TEXT PRIMARY KEY,
+        ibo_id TEXT,
+        status TEXT NOT NULL,
+        document_id TEXT,
+        owner TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )''',
+]
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _db():
+    store.ensure_schema('generation_index', SCHEMA)
+    return store.get_db()
+
+
+# Content address of a generation request: the normalized IBO data plus the template version
+def request_key(ibo_data, template_hash):
+    normalized = {
+        'ibo_id': str(ibo_data.get('ibo_id') or '').strip(),
+        'ibo_name': str(ibo_data.get('ibo_name') or '').strip(),
+        'shop_links': [str(link).strip() for link in ibo_data.get('shop_links') or []],
+    }
+    payload = json.dumps(normalized, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(f'{template_hash}:{payload}'.encode('utf-8')).hexdigest()
+
+
+# Document ID already generated for a key, if any
+def lookup(key):
+    row = _db().execute(
+        "SELECT document_id FROM generation_index WHERE key = ? AND status = 'done'", (key,)
+    ).fetchone()
+    return row['document_id'] if row else None
+
+
+# Drop a result, e.g. when its document could not be shared or was deleted
+def forget(key):
+    _db().execute('DELETE FROM generation_index WHERE key = ?', (key,))
+
+
+# Drop every result answered by a document. Returns the (key, ibo_id) of those that were done.
+def forget_document(document_id):
+    _db()
+    with store.transaction() as db:
+        rows = db.execute(
+            "SELECT key, ibo_id FROM generation_index WHERE document_id = ? AND status = 'done'", (document_id,)
+        ).fetchall()
+        db.execute('DELETE FROM generation_index WHERE document_id = ?', (document_id,))
+    return [(row['key'], row['ibo_id']) for row in rows]
+
+
+# Record that a key is answered by an existing document (e.g. after an in-place update)
+def remember(key, ibo_id, document_id):
+    now = time.time()
+    _db().execute(
+        'INSERT OR REPLACE INTO generation_index (key, ibo_id, status, document_id, owner, created_at, updated_at) '
+        "VALUES (?, ?, 'done', ?, NULL, ?, ?)",
+        (key, ibo_id, document_id, now, now)
+    )
+
+
+# True when the claim belongs to a process on this host that has exited
+def _owner_gone(owner):
+    pid = (owner or '').split('-', 1)[0]
+    return pid.isdigit() and int(pid) != os.getpid() and not psutil.pid_exists(int(pid))
+
+
+# Claim a key for this thread. Returns ('done', document_id), ('pending', None) when
+# another worker is running it, or ('claimed', None) when we should run it.
+def _claim(key, ibo_id, owner):
+    now = time.time()
+    _db()
+    with store.transaction() as db:
+        row = db.execute(
+            'SELECT status, document_id, owner, updated_at FROM generation_index WHERE key = ?', (key,)
+        ).fetchone()
+        if row and row['status'] == 'done':
+            return 'done', row['document_id']
+        if row and row['status'] == 'pending' and row['updated_at'] > now - STALE_AFTER and not _owner_gone(row['owner']):
+            return 'pending', None
+        db.execute(
+            'INSERT OR REPLACE INTO generation_index (key, ibo_id, status, document_id, owner, created_at, updated_at) '
+            "VALUES (?, ?, 'pending', NULL, ?, ?, ?)",
+            (key, ibo_id, owner, now, now)
+        )
+        return 'claimed', None
+
+
+# Settle the in-process waiters of a key with its document ID or the error it failed with
+def _resolve(key, document_id=None, error=None):
+    with _inflight_lock:
+        future = _inflight.pop(key, None)
+    if future is None:
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(document_id)
+
+
+def _run_claimed(key, ibo_id, fn, deferred=False):
+    owner = f'{os.getpid()}-{threading.get_ident()}'
+    while True:
+        status, document_id = _claim(key, ibo_id, owner)
+        if status == 'done':
+            return document_id, True
+        if status == 'claimed':
+            break
+        # An identical request is running in another worker: wait for its result
+        time.sleep(WAIT_INTERVAL)
+
+    try:
+        document_id = fn()
+    except BaseException:
+        forget(key)
+        raise
+    _db().execute(
+        'UPDATE generation_index SET status = ?, document_id = ?, updated_at = ? WHERE key = ?',
+        ('pending' if deferred else 'done', document_id, time.time(), key)
+    )
+    return document_id, False
+
+
+# Run fn() at most once per key and remember the document ID it returns.
+# Identical concurrent requests, in this process or any other worker, share one run.
+# Returns (document_id, reused) where reused is True if fn() was not called here.
+# With deferred=True a document made here is not handed out yet: identical requests keep
+# waiting until complete(key, document_id) (e.g. once it is shared) or abandon(key).
+def run_once(key, ibo_id, fn, deferred=False):
+    document_id = lookup(key)
+    if document_id:
+        logging.info(f"Reusing document {document_id} for an identical request")
+        return document_id, True
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+    if not owner:
+        return future.result(), True
+
+    try:
+        document_id, reused = _run_claimed(key, ibo_id, fn, deferred)
+    except BaseException as e:
+        _resolve(key, error=e)
+        raise
+    if reused or not deferred:
+        _resolve(key, document_id)
+    return document_id, reused
+
+
+# Hand out the document of a deferred run_once
+def complete(key, document_id):
+    _db().execute(
+        "UPDATE generation_index SET status = 'done', document_id = ?, updated_at = ? WHERE key = ?",
+        (document_id, time.time(), key)
+    )
+    _resolve(key, document_id)
+
+
+# Drop a deferred run_once whose document will not be handed out (e.g. it could not be shared)
+def abandon(key, error=None):
+    forget(key)
+    _resolve(key, error=error or RuntimeError("The identical request failed"))
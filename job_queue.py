@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import uuid
+import threading
+import logging
+
+import store
+import pipeline
+import rate_scheduler
+
+# Background workers per gunicorn worker process
+WORKERS = int(os.getenv('GDOC_JOB_WORKERS', 16))
+# Seconds an idle worker waits before checking the queue again
+POLL_INTERVAL = float(os.getenv('GDOC_JOB_POLL_INTERVAL', 1))
+# A running job whose worker has not reported progress for this long is assumed lost and retried
+STALE_AFTER = int(os.getenv('GDOC_JOB_STALE_AFTER', 300))
+# Times a job is run before it fails for good, whether its worker was lost or it was rate
+# limited or timed out (see _should_retry)
+MAX_ATTEMPTS = int(os.getenv('GDOC_JOB_MAX_ATTEMPTS', 3))
+# Hours a finished job (and its request payload) is kept for /jobs/<id> before it is deleted
+RETENTION_HOURS = float(os.getenv('GDOC_JOB_RETENTION_HOURS', 24))
+# How often an idle worker deletes finished jobs past their retention
+PRUNE_INTERVAL = float(os.getenv('GDOC_JOB_PRUNE_INTERVAL', 600))
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        stage TEXT,
+        payload TEXT NOT NULL,
+        doc_link TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        finished_at REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)',
+    'CREATE INDEX IF NOT EXISTS jobs_status_finished ON jobs (status, finished_at)',
+    # A job re-queued after a transient error is not claimed before this time
+    store.add_column('jobs', 'run_after', 'REAL'),
+]
+
+_wake = threading.Event()
+_started_pid = None
+_start_lock = threading.Lock()
+_pruned_at = 0
+_prune_lock = threading.Lock()
+
+
+def _db():
+    store.ensure_schema('jobs', SCHEMA)
+    return store.get_db()
+
+
+# Store a job durably and return its ID; a worker picks it up from the queue
+def enqueue(payload):
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    _db().execute(
+        'INSERT INTO jobs (id, status, stage, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+        (job_id, 'queued', 'queued', json.dumps(payload), now, now)
+    )
+    _wake.set()
+    logging.info(f"Queued job {job_id}")
+    return job_id
+
+
+def get(job_id):
+    row = _db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+# Take the oldest queued job (or one abandoned by a dead worker) and mark it running
+def claim(worker):
+    now = time.time()
+    _db()
+    with store.transaction() as db:
+        row = db.execute(
+            "SELECT id, payload, attempts FROM jobs "
+            "WHERE (status = 'queued' AND (run_after IS NULL OR run_after <= ?)) "
+            "OR (status = 'running' AND updated_at < ?) "
+            "ORDER BY created_at LIMIT 1",
+            (now, now - STALE_AFTER)
+        ).fetchone()
+        if row is None:
+            return None
+        if row['attempts'] >= MAX_ATTEMPTS:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+                ('Job was abandoned too many times.', now, now, row['id'])
+            )
+            return None
+        db.execute(
+            "UPDATE jobs SET status = 'running', stage = 'started', worker = ?, attempts = attempts + 1, "
+            "updated_at = ? WHERE id = ?",
+            (worker, now, row['id'])
+        )
+    return row['id'], json.loads(row['payload'])
+
+
+# Jobs waiting for a worker and jobs being generated, across all workers
+def backlog():
+    counts = {'queued': 0, 'running': 0}
+    for row in _db().execute(
+        "SELECT status, COUNT(*) AS count FROM jobs WHERE status IN ('queued', 'running') GROUP BY status"
+    ):
+        counts[row['status']] = row['count']
+    return counts
+
+
+# Jobs that finished (successfully or not) since a time.time() timestamp
+def finished_since(timestamp):
+    return _db().execute(
+        "SELECT COUNT(*) AS count FROM jobs WHERE status IN ('done', 'failed') AND finished_at > ?", (timestamp,)
+    ).fetchone()['count']
+
+
+def set_stage(job_id, stage):
+    _db().execute('UPDATE jobs SET stage = ?, updated_at = ? WHERE id = ?', (stage, time.time(), job_id))
+
+
+def complete(job_id, doc_link):
+    now = time.time()
+    _db().execute(
+        "UPDATE jobs SET status = 'done', stage = 'done', doc_link = ?, error = NULL, updated_at = ?, finished_at = ? "
+        "WHERE id = ?",
+        (doc_link, now, now, job_id)
+    )
+
+
+def fail(job_id, error):
+    now = time.time()
+    _db().execute(
+        "UPDATE jobs SET status = 'failed', error = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+        (error, now, now, job_id)
+    )
+
+
+# Put a job that failed on a transient error back in the queue after a backoff, unless it has
+# used up its attempts. Returns whether it was re-queued.
+def retry(job_id, error):
+    now = time.time()
+    _db()
+    with store.transaction() as db:
+        row = db.execute('SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None or row['attempts'] >= MAX_ATTEMPTS:
+            return False
+        db.execute(
+            "UPDATE jobs SET status = 'queued', stage = 'queued', error = ?, worker = NULL, run_after = ?, "
+            "updated_at = ? WHERE id = ?",
+            (str(error), now + rate_scheduler.backoff_delay(row['attempts'] - 1, error), now, job_id)
+        )
+    return True
+
+
+# Delete finished jobs past their retention. Returns the number deleted.
+def prune():
+    cursor = _db().execute(
+        "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+        (time.time() - RETENTION_HOURS * 3600,)
+    )
+    if cursor.rowcount:
+        logging.info(f"Deleted {cursor.rowcount} finished jobs")
+    return cursor.rowcount
+
+
+# Prune at most once per PRUNE_INTERVAL in this process
+def _prune_if_due():
+    global _pruned_at
+    with _prune_lock:
+        if time.time() - _pruned_at < PRUNE_INTERVAL:
+            return
+        _pruned_at = time.time()
+    try:
+        prune()
+    except Exception as e:
+        logging.error(f"Could not delete finished jobs: {e}")
+
+
+# Whether a failed job goes back in the queue. The document pipeline already starts over with
+# a new document after a 5xx or a network error (app.PIPELINE_ATTEMPTS); retrying those here
+# as well would multiply the documents made for one job. Left to the queue are rate limits,
+# raised once every identity is throttled, and stages that timed out.
+def _should_retry(error):
+    return rate_scheduler.is_rate_limited(error) or isinstance(error, pipeline.StageTimeout)
+
+
+def _worker_loop(handler, worker):
+    while True:
+        try:
+            claimed = claim(worker)
+        except Exception as e:
+            logging.error(f"Job worker {worker} could not claim a job: {e}")
+            claimed = None
+
+        if claimed is None:
+            _prune_if_due()
+            _wake.wait(POLL_INTERVAL)
+            _wake.clear()
+            continue
+
+        job_id, payload = claimed
+        logging.info(f"Job worker {worker} running job {job_id}")
+        try:
+            doc_link = handler(payload, lambda stage: set_stage(job_id, stage))
+        except Exception as e:
+            if _should_retry(e) and retry(job_id, e):
+                logging.warning(f"Job {job_id} failed, will retry: {e}")
+            else:
+                logging.error(f"Job {job_id} failed: {e}")
+                fail(job_id, str(e))
+        else:
+            complete(job_id, doc_link)
+            logging.info(f"Job {job_id} finished: {doc_link}")
+
+
+# Start this process's worker threads (once per gunicorn worker, after fork).
+# handler(payload, progress) runs the pipeline and returns the document link.
+def start_workers(handler):
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+        for index in range(WORKERS):
+            worker = f'{os.getpid()}-{index}'
+            threading.Thread(target=_worker_loop, args=(handler, worker), name=f'job-worker-{index}', daemon=True).start()
+        logging.info(f"Started {WORKERS} job workers in process {os.getpid()}")
@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import calendar
+import threading
+import logging
+from googleapiclient.errors import HttpError
+
+import store
+import metrics
+import rate_scheduler
+import copy_pool
+import idempotency
+import ibo_documents
+import export_cache
+
+# Days an IBO's earlier document is kept after a newer one replaced it, so links already
+# handed out keep working for a while
+SUPERSEDED_RETENTION_DAYS = float(os.getenv('GDOC_RETAIN_SUPERSEDED_DAYS', 30))
+# Delete every document older than this many days, current ones included (0 keeps them)
+MAX_AGE_DAYS = float(os.getenv('GDOC_RETAIN_MAX_AGE_DAYS', 0))
+# How often a worker expires documents in the background (0 leaves it to `flask expire-docs`)
+INTERVAL = float(os.getenv('GDOC_LIFECYCLE_INTERVAL', 3600))
+# Deletions per run, so one run never holds the bulk share of the Drive quota for long
+MAX_PER_RUN = int(os.getenv('GDOC_LIFECYCLE_MAX_PER_RUN', 1000))
+# Deletions combined into one Drive batch HTTP request (Drive allows up to 100)
+DELETE_BATCH_SIZE = min(int(os.getenv('GDOC_LIFECYCLE_BATCH_SIZE', 100)), 100)
+# Name of every document the app creates, used to find the ones created before they were recorded
+GENERATED_NAME = 'Generated Google Doc'
+# Untracked files younger than this may still be in the middle of being generated
+SCAN_GRACE = 24 * 3600
+
+SCHEMA = [
+    # superseded_at is when a newer document replaced this one for its IBO
+    '''CREATE TABLE IF NOT EXISTS document_lifecycle (
+        document_id TEXT PRIMARY KEY,
+        identity TEXT NOT NULL,
+        ibo_id TEXT,
+        created_at REAL NOT NULL,
+        superseded_at REAL
+    )''',
+    'CREATE INDEX IF NOT EXISTS document_lifecycle_ibo ON document_lifecycle (ibo_id)',
+    'CREATE INDEX IF NOT EXISTS document_lifecycle_created ON document_lifecycle (created_at)',
+    # What recording the document replaced, for unrecord(): the IBO's previous ibo_documents record
+    # and the generation keys its earlier documents answered
+    store.add_column('document_lifecycle', 'replaced', 'TEXT'),
+]
+
+_started_pid = None
+_start_lock = threading.Lock()
+
+
+def _db():
+    store.ensure_schema('document_lifecycle', SCHEMA)
+    return store.get_db()
+
+
+# Record a document created for an IBO; the IBO's earlier documents are superseded from now on.
+# A superseded document no longer answers identical requests, so its link is not handed out
+# again shortly before it is deleted. `previous` is the IBO's ibo_documents record the new
+# document replaces, kept so unrecord() can put it back.
+def record(document_id, identity, ibo_id, previous=None):
+    now = time.time()
+    _db()
+    with store.transaction() as db:
+        db.execute(
+            'INSERT OR REPLACE INTO document_lifecycle (document_id, identity, ibo_id, created_at, superseded_at) '
+            'VALUES (?, ?, ?, ?, NULL)',
+            (document_id, identity, str(ibo_id), now)
+        )
+        superseded = db.execute(
+            'SELECT document_id FROM document_lifecycle '
+            'WHERE ibo_id = ? AND document_id != ? AND superseded_at IS NULL',
+            (str(ibo_id), document_id)
+        ).fetchall()
+        db.executemany(
+            'UPDATE document_lifecycle SET superseded_at = ? WHERE document_id = ?',
+            [(now, row['document_id']) for row in superseded]
+        )
+    forgotten = [row['document_id'] for row in superseded]
+    if previous and previous['document_id'] != document_id and previous['document_id'] not in forgotten:
+        forgotten.append(previous['document_id'])
+    keys = [
+        (key, key_ibo_id, forgotten_id)
+        for forgotten_id in forgotten for key, key_ibo_id in idempotency.forget_document(forgotten_id)
+    ]
+    _db().execute(
+        'UPDATE document_lifecycle SET replaced = ? WHERE document_id = ?',
+        (json.dumps({'record': previous, 'keys': keys}), document_id)
+    )
+
+
+# Undo record() for a document that was never handed out and is being deleted, e.g. when a
+# batch stopped before sharing it. If it was the IBO's current document, the documents it
+# superseded are current again and the IBO's previous record and generation keys come back.
+def unrecord(document_id):
+    row = _db().execute(
+        'SELECT ibo_id, created_at, superseded_at, replaced FROM document_lifecycle WHERE document_id = ?',
+        (document_id,)
+    ).fetchone()
+    current = ibo_documents.get_by_document(document_id)
+    ibo_documents.forget_document(document_id)
+    idempotency.forget_document(document_id)
+    if row is None:
+        return
+    with store.transaction() as db:
+        db.execute('DELETE FROM document_lifecycle WHERE document_id = ?', (document_id,))
+        if row['superseded_at'] is not None:
+            return
+        db.execute(
+            'UPDATE document_lifecycle SET superseded_at = NULL WHERE ibo_id = ? AND superseded_at = ?',
+            (row['ibo_id'], row['created_at'])
+        )
+
+    replaced = json.loads(row['replaced']) if row['replaced'] else {}
+    previous = replaced.get('record')
+    if current and previous:
+        ibo_documents.save(
+            previous['ibo_id'], previous['document_id'], previous['ibo_name'], previous['template_hash'],
+            previous['tag_to_link'], previous['link_ranges'], previous['identity']
+        )
+    for key, ibo_id, previous_document_id in replaced.get('keys', []):
+        if idempotency.lookup(key) is None:
+            idempotency.remember(key, ibo_id, previous_document_id)
+
+
+# Documents past their retention, oldest first, one page at a time after the (created_at, document_id)
+# of the previous page: [(document_id, identity, reason, created_at)]
+def _expired(limit, after=(0, '')):
+    now = time.time()
+    oldest = now - MAX_AGE_DAYS * 86400 if MAX_AGE_DAYS > 0 else 0
+    rows = _db().execute(
+        'SELECT document_id, identity, created_at, superseded_at FROM document_lifecycle '
+        'WHERE (superseded_at <= ? OR created_at <= ?) AND (created_at, document_id) > (?, ?) '
+        'ORDER BY created_at, document_id LIMIT ?',
+        (now - SUPERSEDED_RETENTION_DAYS * 86400, oldest, after[0], after[1], limit)
+    ).fetchall()
+    return [
+        (row['document_id'], row['identity'], 'superseded' if row['superseded_at'] else 'age', row['created_at'])
+        for row in rows
+    ]
+
+
+# Delete documents with Drive batch HTTP requests. Throttled or failed deletions are resent
+# in a smaller batch. Returns {document_id: error or None}; a document already gone is not an error.
+def delete_documents(drive_service, document_ids):
+    errors = {}
+    remaining = list(document_ids)
+
+    def callback(request_id, response, exception):
+        if isinstance(exception, HttpError) and exception.resp.status == 404:
+            exception = None
+        errors[request_id] = exception
+
+    for attempt in range(rate_scheduler.MAX_RETRIES + 1):
+        batch = drive_service.new_batch_http_request(callback=callback)
+        for document_id in remaining:
+            batch.add(drive_service.files().delete(fileId=document_id), request_id=document_id)
+        rate_scheduler.call(batch.execute, 'drive', 'write', cost=len(remaining), method='drive.batch')
+
+        remaining = [document_id for document_id in remaining if rate_scheduler.is_retryable(errors[document_id])]
+        if not remaining or attempt == rate_scheduler.MAX_RETRIES:
+            return errors
+        if any(rate_scheduler.is_rate_limited(errors[document_id]) for document_id in remaining):
+            rate_scheduler.drain('drive', 'write')
+        time.sleep(rate_scheduler.backoff_delay(attempt))
+    return errors
+
+
+# Forget everything the app kept about deleted documents
+def _forget(document_ids):
+    for document_id in document_ids:
+        idempotency.forget_document(document_id)
+        ibo_documents.forget_document(document_id)
+        export_cache.invalidate(document_id)
+    _db().executemany('DELETE FROM document_lifecycle WHERE document_id = ?', [(document_id,) for document_id in document_ids])
+
+
+# Delete the documents past their retention, at bulk priority and at most MAX_PER_RUN of them.
+# drive_services is {identity: Drive client}; documents of identities missing from it are left
+# for a later run. With dry_run nothing is deleted. Returns counts by outcome.
+def expire(drive_services, dry_run=False, max_documents=MAX_PER_RUN):
+    counts = {'superseded': 0, 'age': 0, 'failed': 0, 'skipped': 0}
+    after = (0, '')
+    done = 0
+    with rate_scheduler.priority('bulk'):
+        while done < max_documents:
+            page = _expired(min(DELETE_BATCH_SIZE * 10, max_documents - done), after)
+            if not page:
+                break
+            after = (page[-1][3], page[-1][0])
+            by_identity = {}
+            for document_id, identity, reason, created_at in page:
+                if identity not in drive_services:
+                    counts['skipped'] += 1
+                    continue
+                by_identity.setdefault(identity, []).append((document_id, reason))
+
+            for identity, documents in by_identity.items():
+                for start in range(0, len(documents), DELETE_BATCH_SIZE):
+                    chunk = documents[start:start + DELETE_BATCH_SIZE]
+                    done += len(chunk)
+                    if dry_run:
+                        for document_id, reason in chunk:
+                            counts[reason] += 1
+                        continue
+                    with rate_scheduler.identity(identity):
+                        errors = delete_documents(drive_services[identity], [document_id for document_id, _ in chunk])
+                    deleted = []
+                    for document_id, reason in chunk:
+                        if errors.get(document_id) is None:
+                            deleted.append(document_id)
+                            counts[reason] += 1
+                            metrics.inc('gdoc_lifecycle_deleted_total', reason=reason)
+                        else:
+                            counts['failed'] += 1
+                            logging.error(f"Could not delete expired document ID {document_id}: {errors[document_id]}")
+                    _forget(deleted)
+    if counts['superseded'] or counts['age'] or counts['failed']:
+        logging.info(
+            f"{'Would delete' if dry_run else 'Deleted'} {counts['superseded']} superseded and {counts['age']} "
+            f"expired documents ({counts['failed']} failed, {counts['skipped']} without credentials)"
+        )
+    return counts
+
+
+# Record an identity's generated documents that were created before documents were recorded,
+# listing its Drive page by page. Those that are no IBO's current document count as superseded
+# now. Returns the number of documents added.
+def adopt_untracked(drive_service, identity):
+    # Unused template copies are named like generated documents but belong to the copy pool
+    pooled = copy_pool.document_ids()
+    now = time.time()
+    added = 0
+    page_token = None
+    with rate_scheduler.priority('bulk'), rate_scheduler.identity(identity):
+        while True:
+            response = rate_scheduler.execute(
+                drive_service.files().list(
+                    q=f"name = '{GENERATED_NAME}' and 'me' in owners and trashed = false",
+                    fields='nextPageToken, files(id, createdTime)', pageSize=1000, pageToken=page_token
+                ),
+                'drive', 'read'
+            )
+            rows = []
+            for file in response.get('files', []):
+                created_at = calendar.timegm(time.strptime(file['createdTime'][:19], '%Y-%m-%dT%H:%M:%S'))
+                if file['id'] in pooled or now - created_at < SCAN_GRACE:
+                    continue
+                current = ibo_documents.get_by_document(file['id'])
+                rows.append((
+                    file['id'], identity, current['ibo_id'] if current else None, created_at, None if current else now
+                ))
+            if rows:
+                cursor = _db().executemany(
+                    'INSERT OR IGNORE INTO document_lifecycle (document_id, identity, ibo_id, created_at, superseded_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    rows
+                )
+                added += cursor.rowcount
+                for row in rows:
+                    if row[4]:
+                        idempotency.forget_document(row[0])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+    if added:
+        logging.info(f"Recorded {added} untracked generated documents of {identity}")
+    return added
+
+
+def _expire_loop(get_drive_services):
+    while True:
+        time.sleep(INTERVAL)
+        try:
+            # One worker expires documents at a time
+            with store.file_lock('lifecycle', blocking=False) as locked:
+                if locked:
+                    expire(get_drive_services())
+        except Exception as e:
+            logging.error(f"Could not expire documents: {e}")
+
+
+# Start this process's background expiry (once per gunicorn worker, after fork).
+# get_drive_services() returns {identity: Drive client} for the identities that are authorized.
+def start(get_drive_services):
+    global _started_pid
+    if INTERVAL <= 0 or _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+        threading.Thread(
+            target=_expire_loop, args=(get_drive_services,), name='document-lifecycle', daemon=True
+        ).start()
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import zlib
+import queue
+import random
+import threading
+import contextvars
+import logging
+import logging.handlers
+from contextlib import contextmanager
+
+# Level of every logger not listed in LEVELS
+LEVEL = os.getenv('GDOC_LOG_LEVEL', 'INFO').upper()
+# 'json' writes one JSON object per line; 'text' is the human-readable format for local runs
+FORMAT = os.getenv('GDOC_LOG_FORMAT', 'json')
+# Per-logger levels, e.g. "copy_pool=DEBUG,googleapiclient=INFO", on top of DEFAULT_LEVELS. The app's
+# modules log through the root logger, so they are matched by module name; library loggers by
+# logger name (and its parents).
+LEVELS = os.getenv('GDOC_LOG_LEVELS', '')
+DEFAULT_LEVELS = {
+    'googleapiclient': 'WARNING', 'google_auth_httplib2': 'WARNING', 'google.auth': 'WARNING',
+    'httplib2': 'WARNING', 'urllib3': 'WARNING', 'oauthlib': 'WARNING', 'requests_oauthlib': 'WARNING',
+}
+# Share of DEBUG/INFO records kept per logger, e.g. "werkzeug=0.1,job_queue=0.5". A request keeps
+# all of its sampled records or none of them; warnings and errors are never sampled out.
+SAMPLING = os.getenv('GDOC_LOG_SAMPLING', '')
+# Records waiting for the writer thread before new ones are dropped
+QUEUE_SIZE = int(os.getenv('GDOC_LOG_QUEUE_SIZE', 10000))
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# ID of the request (or of the request that queued the job) being handled in this context
+_request_id = contextvars.ContextVar('log_request_id', default=None)
+_handler = None
+_init_lock = threading.Lock()
+
+# Attributes every LogRecord has; anything else was passed with extra= and is logged as a field
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'request_id'}
+
+
+def _parse(spec, convert):
+    settings = {}
+    for item in spec.split(','):
+        name, _, value = item.partition('=')
+        if name.strip() and value.strip():
+            settings[name.strip()] = convert(value.strip())
+    return settings
+
+
+def _level(name):
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level {name!r}")
+    return level
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+# Tag every record logged in this context with request_id; returns the token for reset_request_id
+def set_request_id(value):
+    return _request_id.set(value)
+
+
+def reset_request_id(token):
+    _request_id.reset(token)
+
+
+@contextmanager
+def request_id(value):
+    token = _request_id.set(value)
+    try:
+        yield
+    finally:
+        _request_id.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name if record.name != 'root' else record.module,
+            'message': record.getMessage(),
+        }
+        if record.request_id:
+            entry['request_id'] = record.request_id
+        entry['thread'] = record.threadName
+        entry['pid'] = record.process
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        return f'{line} [{record.request_id}]' if record.request_id else line
+
+
+# Runs in the logging thread before a record is queued: tags it with the request ID and applies
+# the per-logger levels and sampling. Returns False to drop the record.
+class RequestFilter(logging.Filter):
+    def __init__(self, default_level, levels, sampling):
+        super().__init__()
+        self.default_level = default_level
+        self.levels = levels
+        self.sampling = sampling
+        self._settings = {}
+
+    def _lookup(self, name):
+        settings = self._settings.get(name)
+        if settings is None:
+            level, rate = self.default_level, 1.0
+            parts = name.split('.')
+            for end in range(len(parts), 0, -1):
+                prefix = '.'.join(parts[:end])
+                if prefix in self.levels:
+                    level = self.levels[prefix]
+                    break
+            for end in range(len(parts), 0, -1):
+                prefix = '.'.join(parts[:end])
+                if prefix in self.sampling:
+                    rate = self.sampling[prefix]
+                    break
+            settings = self._settings[name] = (level, rate)
+        return settings
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        level, rate = self._lookup(record.name if record.name != 'root' else record.module)
+        if record.levelno < level:
+            return False
+        if rate < 1 and record.levelno < logging.WARNING:
+            if record.request_id:
+                return zlib.crc32(record.request_id.encode()) / 2 ** 32 < rate
+            return random.random() < rate
+        return True
+
+
+# Hands records to a background thread that formats and writes them, so a log call on the
+# request path never waits on stdout. When the queue is full, records are dropped and counted.
+class BackgroundHandler(logging.handlers.QueueHandler):
+    def __init__(self, target):
+        super().__init__(queue.SimpleQueue())
+        self.target = target
+        self.dropped = 0
+        self._listener = None
+        self._start()
+
+    def _start(self):
+        self._listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+        self._listener.start()
+
+    # After a fork only the calling thread survives: give the child its own queue and writer thread
+    def _restart_in_child(self):
+        self.queue = queue.SimpleQueue()
+        self._start()
+
+    def prepare(self, record):
+        # Merge the arguments now (they may change later); formatting happens on the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        # SimpleQueue has no maximum size, but a put costs a tenth of a Queue.put
+        if self.queue.qsize() >= QUEUE_SIZE:
+            self.dropped += 1
+            return
+        if self.dropped:
+            self.queue.put(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING', 'request_id': None,
+                'msg': f"Dropped {self.dropped} log records; the log queue was full",
+            }))
+            self.dropped = 0
+        self.queue.put(record)
+
+    # Write everything queued so far; logging.shutdown() calls this at exit
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        super().close()
+
+
+# Install the background JSON (or text) handler on the root logger. Safe to call more than once.
+def init(level=LEVEL, log_format=FORMAT, levels=None, sampling=None, stream=None):
+    global _handler
+    with _init_lock:
+        if _handler is not None:
+            return _handler
+        levels = {
+            name: _level(value)
+            for name, value in {**DEFAULT_LEVELS, **_parse(LEVELS, str), **(levels or {})}.items()
+        }
+        sampling = {**_parse(SAMPLING, float), **(sampling or {})}
+        default_level = _level(level)
+
+        target = logging.StreamHandler(stream or sys.stderr)
+        target.setFormatter(JsonFormatter() if log_format == 'json' else TextFormatter(TEXT_FORMAT))
+        _handler = BackgroundHandler(target)
+        _handler.addFilter(RequestFilter(default_level, levels, sampling))
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(_handler)
+        # Module-level settings below the default still have to get past the root logger
+        root.setLevel(min([default_level, *levels.values()]))
+        for name, value in levels.items():
+            # Library loggers then skip disabled records at the call site
+            logging.getLogger(name).setLevel(value)
+        os.register_at_fork(after_in_child=_handler._restart_in_child)
+        return _handler
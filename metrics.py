@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import threading
+import logging
+from contextlib import contextmanager
+import psutil
+
+import store
+
+# How often each worker writes its counters to the shared store
+FLUSH_INTERVAL = float(os.getenv('GDOC_METRICS_FLUSH_INTERVAL', 5))
+# Histogram bucket bounds in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Worker that owns the samples of processes that have exited, so their counts are kept
+RETIRED_PID = 0
+
+METRICS = {
+    'gdoc_http_requests_total': ('counter', 'HTTP requests handled, by endpoint and status.'),
+    'gdoc_http_request_seconds': ('histogram', 'HTTP request latency, by endpoint.'),
+    'gdoc_admission_rejected_total': ('counter', 'Requests turned away with 429, by endpoint and reason.'),
+    'gdoc_stage_seconds': ('histogram', 'Latency of each document pipeline stage.'),
+    'gdoc_stage_errors_total': ('counter', 'Pipeline stages that raised, by stage.'),
+    'gdoc_google_api_seconds': ('histogram', 'Latency of Google API calls, including retries.'),
+    'gdoc_google_api_calls_total': ('counter', 'Google API calls, by method, outcome and identity.'),
+    'gdoc_identity_fallbacks_total': ('counter', 'Documents moved to another identity after one was throttled.'),
+    'gdoc_google_api_retries_total': ('counter', 'Google API calls retried after a throttled or failed attempt.'),
+    'gdoc_google_api_quota_wait_seconds_total': ('counter', 'Time spent waiting for the shared rate limit.'),
+    'gdoc_google_api_request_bytes_total': ('counter', 'Request body bytes sent to Google APIs.'),
+    'gdoc_copy_pool_requests_total': ('counter', 'Documents requested from the template copy pool, by hit or miss.'),
+    'gdoc_copy_pool_refills_total': ('counter', 'Template copies added to the pool.'),
+    'gdoc_copy_pool_removed_total': ('counter', 'Stale template copies deleted from the pool.'),
+    'gdoc_export_cache_requests_total': ('counter', 'Document exports served, by format and cache hit or miss.'),
+    'gdoc_export_cache_evictions_total': ('counter', 'Cached exports deleted to stay within the cache size.'),
+    'gdoc_lifecycle_deleted_total': ('counter', 'Generated documents deleted from Drive, by superseded or age.'),
+    'gdoc_process_resident_memory_bytes': ('gauge', 'Resident memory of each worker process.'),
+    'gdoc_process_cpu_seconds_total': ('counter', 'CPU time used by each worker process.'),
+}
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS metric_samples (
+        pid INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        labels TEXT NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (pid, name, labels)
+    )''',
+]
+
+_values = {}
+_lock = threading.Lock()
+_flusher_pid = None
+
+
+def _key(name, labels):
+    return name, json.dumps(labels, sort_keys=True)
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+    _start_flusher()
+
+
+def observe(name, seconds, **labels):
+    with _lock:
+        for bound in BUCKETS + (float('inf'),):
+            if seconds <= bound:
+                key = _key(f'{name}_bucket', dict(labels, le='+Inf' if bound == float('inf') else str(bound)))
+                _values[key] = _values.get(key, 0) + 1
+        for suffix, value in (('_sum', seconds), ('_count', 1)):
+            key = _key(f'{name}{suffix}', labels)
+            _values[key] = _values.get(key, 0) + value
+    _start_flusher()
+
+
+# Time a block (or, used as a decorator, a function) as one pipeline stage
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc('gdoc_stage_errors_total', stage=name)
+        raise
+    finally:
+        observe('gdoc_stage_seconds', time.perf_counter() - start, stage=name)
+
+
+def _process_samples():
+    process = psutil.Process()
+    cpu = process.cpu_times()
+    pid = str(os.getpid())
+    return {
+        _key('gdoc_process_resident_memory_bytes', {'pid': pid}): process.memory_info().rss,
+        _key('gdoc_process_cpu_seconds_total', {'pid': pid}): cpu.user + cpu.system,
+    }
+
+
+# Write this worker's current totals to the shared store
+def flush():
+    with _lock:
+        samples = dict(_values)
+    samples.update(_process_samples())
+    store.ensure_schema('metric_samples', SCHEMA)
+    with store.transaction() as db:
+        db.execute('DELETE FROM metric_samples WHERE pid = ?', (os.getpid(),))
+        db.executemany(
+            'INSERT INTO metric_samples (pid, name, labels, value) VALUES (?, ?, ?, ?)',
+            [(os.getpid(), name, labels, value) for (name, labels), value in samples.items()]
+        )
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            logging.error(f"Could not flush metrics: {e}")
+
+
+def _start_flusher():
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True).start()
+
+
+# Fold the samples of exited workers into the retired row so totals never go backwards
+def _retire_dead_workers(db):
+    pids = [row['pid'] for row in db.execute('SELECT DISTINCT pid FROM metric_samples WHERE pid != ?', (RETIRED_PID,))]
+    for pid in pids:
+        if psutil.pid_exists(pid):
+            continue
+        db.execute(
+            "INSERT INTO metric_samples (pid, name, labels, value) "
+            "SELECT ?, name, labels, value FROM metric_samples WHERE pid = ? AND name NOT LIKE 'gdoc_process_%' "
+            "ON CONFLICT (pid, name, labels) DO UPDATE SET value = value + excluded.value",
+            (RETIRED_PID, pid)
+        )
+        db.execute('DELETE FROM metric_samples WHERE pid = ?', (pid,))
+
+
+def _format_labels(labels):
+    labels = json.loads(labels)
+    if not labels:
+        return ''
+    escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in labels.items()}
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped.items()) + '}'
+
+
+# Prometheus text exposition of the totals of all workers
+def render():
+    flush()
+    with store.transaction() as db:
+        _retire_dead_workers(db)
+        rows = db.execute(
+            'SELECT name, labels, SUM(value) AS value FROM metric_samples GROUP BY name, labels ORDER BY name, labels'
+        ).fetchall()
+
+    by_metric = {}
+    for row in rows:
+        base = row['name']
+        for suffix in ('_bucket', '_sum', '_count'):
+            if base.endswith(suffix) and base[:-len(suffix)] in METRICS:
+                base = base[:-len(suffix)]
+        by_metric.setdefault(base, []).append(row)
+
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        samples = by_metric.get(name, [])
+        if kind == 'histogram':
+            # Buckets must be listed in increasing order of their bound
+            samples.sort(key=lambda row: (row['name'], _bucket_order(row['labels'])))
+        for row in samples:
+            value = row['value']
+            lines.append(f"{row['name']}{_format_labels(row['labels'])} {int(value) if value.is_integer() else value}")
+    return '\n'.join(lines) + '\n'
+
+
+def _bucket_order(labels):
+    labels = json.loads(labels)
+    le = labels.pop('le', None)
+    bound = float('inf') if le in (None, '+Inf') else float(le)
+    return json.dumps(labels, sort_keys=True), bound
@@ -0,0 +1,158 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import profiler
+
+# Threads shared by every pipeline in this process
+THREADS = int(os.getenv('GDOC_PIPELINE_THREADS', 16))
+# Seconds a stage may run before the pipeline gives up on it
+STAGE_TIMEOUT = float(os.getenv('GDOC_STAGE_TIMEOUT', 90))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+# Clock of the stage running in the current context
+_clock = contextvars.ContextVar('pipeline_stage_clock', default=None)
+
+
+class StageTimeout(TimeoutError):
+    pass
+
+
+# Raised in a stage that is still running after its pipeline gave up
+class StageCancelled(Exception):
+    pass
+
+
+# One step of a document pipeline: fn receives the results of its dependencies, in order.
+# progress is the job stage reported when it starts. on_abandon(result) cleans up after the
+# stage (e.g. deletes the document it made) when the pipeline fails, even if the stage
+# only finishes after the pipeline gave up on it.
+class Stage:
+    def __init__(self, name, fn, deps=(), timeout=STAGE_TIMEOUT, progress=None, on_abandon=None):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.timeout = timeout
+        self.progress = progress
+        self.on_abandon = on_abandon
+
+
+# When a stage started running and how long it waited for quota since, which does not
+# count against its timeout
+class _Clock:
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.started = None
+        self.excluded = 0.0
+        self.cancelled = threading.Event()
+
+    def deadline(self):
+        return None if self.started is None else self.started + self.excluded + self.timeout
+
+
+# Leave `seconds` spent waiting (e.g. for the shared rate limit) out of the current stage's timeout
+def exclude(seconds):
+    clock = _clock.get()
+    if clock is not None:
+        clock.excluded += seconds
+
+
+# Raise StageCancelled when the pipeline of the current stage gave up on it, so a stage
+# that outlived its timeout stops before its next Google call
+def check_cancelled():
+    clock = _clock.get()
+    if clock is not None and clock.cancelled.is_set():
+        raise StageCancelled("The pipeline gave up on this stage")
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix='pipeline')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _call(stage, clock, args, progress):
+    clock.started = time.monotonic()
+    _clock.set(clock)
+    if progress and stage.progress:
+        progress(stage.progress)
+    start = time.perf_counter()
+    with profiler.attach():
+        try:
+            return stage.fn(*args)
+        finally:
+            profiler.record('stage', start, name=stage.name, seconds=round(time.perf_counter() - start, 4))
+
+
+def _abandon(stage, result):
+    try:
+        stage.on_abandon(result)
+    except Exception as e:
+        logging.error(f"Could not clean up after stage {stage.name}: {e}")
+
+
+def _abandon_when_done(stage, future):
+    if not future.cancelled() and future.exception() is None:
+        _abandon(stage, future.result())
+
+
+# Run a DAG of stages, starting each one as soon as its dependencies have finished, and
+# return {stage name: result}. Stages run in a copy of the caller's context (so contextvars
+# such as the rate limit priority carry over). A stage's timeout counts from when it starts
+# running, without its waits for quota. When a stage fails or times out, stages that have not
+# started are cancelled, running ones stop at their next Google call, and every stage's
+# on_abandon runs on the result it produced, now or later; then the error is raised.
+def run(stages, progress=None):
+    executor = _get_executor()
+    pending = {stage.name: stage for stage in stages}
+    results = {}
+    running = {}
+
+    try:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(dep in results for dep in stage.deps):
+                    del pending[name]
+                    args = [results[dep] for dep in stage.deps]
+                    clock = _Clock(stage.timeout)
+                    future = executor.submit(contextvars.copy_context().run, _call, stage, clock, args, progress)
+                    running[future] = (stage, clock)
+            if not running:
+                raise ValueError(f"Stages with unknown or circular dependencies: {', '.join(pending)}")
+
+            # Stages still queued for a thread have no deadline yet: look again shortly
+            deadlines = [clock.deadline() for _, clock in running.values()]
+            next_deadline = min([deadline for deadline in deadlines if deadline is not None] + [time.monotonic() + 1])
+            done, _ = wait(running, timeout=max(0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, _ = running.pop(future)
+                results[stage.name] = future.result()
+
+            now = time.monotonic()
+            for stage, clock in running.values():
+                deadline = clock.deadline()
+                if deadline is not None and now >= deadline:
+                    raise StageTimeout(f"Stage {stage.name} did not finish within {stage.timeout:g}s")
+    except BaseException as e:
+        by_name = {stage.name: stage for stage in stages}
+        for name, result in results.items():
+            if by_name[name].on_abandon:
+                _abandon(by_name[name], result)
+        for future, (stage, clock) in running.items():
+            future.cancel()
+            clock.cancelled.set()
+            if stage.on_abandon:
+                future.add_done_callback(lambda future, stage=stage: _abandon_when_done(stage, future))
+        if pending or running:
+            skipped = list(pending) + [stage.name for stage, _ in running.values()]
+            logging.warning(f"Pipeline stopped ({e}); abandoned stages: {', '.join(skipped)}")
+        raise
+    return results
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import threading
+import contextvars
+import logging
+from collections import Counter
+from contextlib import contextmanager
+
+import store
+
+# Directory holding the ring buffer of saved traces, shared by all workers
+PROFILE_DIR = os.getenv('GDOC_PROFILE_DIR', '.profiles')
+RING_SIZE = int(os.getenv('GDOC_PROFILE_RING_SIZE', 50))
+# Requests and jobs slower than this are saved even when they were not profiled
+SLOW_THRESHOLD = float(os.getenv('GDOC_SLOW_REQUEST_SECONDS', 10))
+# Share of requests profiled when no admin has set a rate (see set_sample_rate)
+DEFAULT_SAMPLE_RATE = float(os.getenv('GDOC_PROFILE_SAMPLE_RATE', 0))
+# Seconds between two stack samples of a profiled trace
+SAMPLE_INTERVAL = float(os.getenv('GDOC_PROFILE_SAMPLE_INTERVAL', 0.005))
+# Timeline events kept per trace
+MAX_EVENTS = 1000
+# How long a worker reuses the sample rate read from the store
+SETTINGS_TTL = 5
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS profiler_settings (
+        name TEXT PRIMARY KEY,
+        value REAL NOT NULL
+    )''',
+]
+
+# Trace of the request or job running in the current context; pipeline stages inherit it
+_current = contextvars.ContextVar('profiler_trace', default=None)
+_profiling = set()
+_profiling_lock = threading.Lock()
+_sampler_pid = None
+_sample_rate = (0, DEFAULT_SAMPLE_RATE)
+
+
+# Timeline of one request or job: pipeline stages and outbound Google calls with their
+# sizes, plus, when profiled, stack samples of every thread working on it
+class Trace:
+    def __init__(self, name, profile=False, parent=None):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.parent = parent
+        self.started_at = time.time()
+        self.profiled = profile
+        self.events = []
+        self.stacks = Counter()
+        self.samples = 0
+        self.threads = set()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def add(self, kind, start=None, **fields):
+        event = dict(kind=kind, at=round((start if start is not None else time.perf_counter()) - self._start, 4),
+                     thread=threading.current_thread().name, **fields)
+        with self._lock:
+            if len(self.events) < MAX_EVENTS:
+                self.events.append(event)
+
+    def to_dict(self, **fields):
+        with self._lock:
+            return dict(
+                id=self.id, name=self.name, parent=self.parent, started_at=self.started_at,
+                seconds=round(self.elapsed(), 4), profiled=self.profiled, sample_interval=SAMPLE_INTERVAL,
+                samples=self.samples, events=list(self.events), stacks=dict(self.stacks.most_common()), **fields
+            )
+
+
+def current():
+    return _current.get()
+
+
+# Add an event to the current trace, if there is one
+def record(kind, start=None, **fields):
+    trace = _current.get()
+    if trace is not None:
+        trace.add(kind, start, **fields)
+
+
+def _folded(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _sample_loop():
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        with _profiling_lock:
+            traces = list(_profiling)
+        if not traces:
+            continue
+        frames = sys._current_frames()
+        for trace in traces:
+            with trace._lock:
+                for ident in trace.threads:
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        trace.stacks[_folded(frame)] += 1
+                trace.samples += 1
+
+
+def _start_sampler():
+    global _sampler_pid
+    if _sampler_pid == os.getpid():
+        return
+    with _profiling_lock:
+        if _sampler_pid == os.getpid():
+            return
+        _sampler_pid = os.getpid()
+    threading.Thread(target=_sample_loop, name='profiler-sampler', daemon=True).start()
+
+
+# Count the current thread as working for the current trace while the block runs
+@contextmanager
+def attach():
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    ident = threading.get_ident()
+    with trace._lock:
+        added = ident not in trace.threads
+        trace.threads.add(ident)
+    try:
+        yield
+    finally:
+        if added:
+            with trace._lock:
+                trace.threads.discard(ident)
+
+
+def start(name, profile=False, parent=None):
+    trace = Trace(name, profile, parent)
+    trace.token = _current.set(trace)
+    trace.threads.add(threading.get_ident())
+    if profile:
+        _start_sampler()
+        with _profiling_lock:
+            _profiling.add(trace)
+    return trace
+
+
+# End a trace; it is saved when it was profiled or slower than SLOW_THRESHOLD.
+# Returns the saved trace's ID, or None.
+def finish(trace, **fields):
+    with _profiling_lock:
+        _profiling.discard(trace)
+    try:
+        _current.reset(trace.token)
+    except ValueError:
+        # Finished from another context (e.g. a streamed response); the context is gone anyway
+        pass
+    if not trace.profiled and trace.elapsed() < SLOW_THRESHOLD:
+        return None
+    try:
+        return save(trace.to_dict(**fields))
+    except OSError as e:
+        logging.error(f"Could not save trace {trace.id}: {e}")
+        return None
+
+
+@contextmanager
+def trace(name, profile=False, parent=None):
+    current_trace = start(name, profile, parent)
+    try:
+        yield current_trace
+    except BaseException as e:
+        finish(current_trace, error=str(e))
+        raise
+    else:
+        finish(current_trace)
+
+
+def _db():
+    store.ensure_schema('profiler_settings', SCHEMA)
+    return store.get_db()
+
+
+def sample_rate():
+    global _sample_rate
+    read_at, rate = _sample_rate
+    if time.monotonic() - read_at > SETTINGS_TTL:
+        row = _db().execute("SELECT value FROM profiler_settings WHERE name = 'sample_rate'").fetchone()
+        rate = row['value'] if row else DEFAULT_SAMPLE_RATE
+        _sample_rate = (time.monotonic(), rate)
+    return rate
+
+
+# Profile this fraction (0-1) of requests in every worker, until changed again
+def set_sample_rate(rate):
+    global _sample_rate
+    rate = min(1.0, max(0.0, float(rate)))
+    _db().execute("INSERT OR REPLACE INTO profiler_settings (name, value) VALUES ('sample_rate', ?)", (rate,))
+    _sample_rate = (time.monotonic(), rate)
+    return rate
+
+
+def should_profile():
+    rate = sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+def _path(trace_id):
+    for file_name in os.listdir(PROFILE_DIR) if os.path.isdir(PROFILE_DIR) else ():
+        if file_name.endswith(f'-{trace_id}.json'):
+            return os.path.join(PROFILE_DIR, file_name)
+    return None
+
+
+# Write a trace to the ring buffer, dropping the oldest ones beyond RING_SIZE
+def save(data):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{int(data['started_at'] * 1000)}-{data['id']}.json")
+    tmp_file = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as handle:
+        json.dump(data, handle)
+    os.replace(tmp_file, path)
+
+    saved = sorted(file_name for file_name in os.listdir(PROFILE_DIR) if file_name.endswith('.json'))
+    for file_name in saved[:-RING_SIZE]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, file_name))
+        except FileNotFoundError:
+            pass
+    logging.info(f"Saved trace {data['id']} ({data['name']}, {data['seconds']}s)")
+    return data['id']
+
+
+# Summaries of the saved traces, newest first
+def list_saved():
+    summaries = []
+    if not os.path.isdir(PROFILE_DIR):
+        return summaries
+    for file_name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, file_name)) as handle:
+                data = json.load(handle)
+        except (OSError, ValueError):
+            continue
+        summaries.append({
+            key: data.get(key) for key in ('id', 'name', 'parent', 'started_at', 'seconds', 'profiled', 'samples', 'error')
+        })
+        summaries[-1]['google_calls'] = sum(1 for event in data['events'] if event['kind'] == 'http')
+    return summaries
+
+
+def load_saved(trace_id):
+    path = _path(trace_id)
+    if path is None:
+        return None
+    with open(path) as handle:
+        return json.load(handle)
+
+
+# Stack samples in the folded format read by flamegraph.pl and speedscope
+def folded_stacks(data):
+    return ''.join(f'{stack} {count}\n' for stack, count in data['stacks'].items())
@@ -0,0 +1,288 @@
+import os
+import time
+import random
+import socket
+import contextvars
+import logging
+from contextlib import contextmanager
+from googleapiclient.errors import HttpError
+
+import store
+import metrics
+import profiler
+import pipeline
+
+# Requests per minute per API and quota class, shared by every worker on this host.
+# Defaults follow Google's per-user limits; override with e.g. GDOC_QUOTA_DOCS_WRITE=60.
+DEFAULT_QUOTAS = {
+    ('docs', 'read'): 300,
+    ('docs', 'write'): 60,
+    ('drive', 'read'): 1000,
+    ('drive', 'write'): 180,
+}
+# Google also limits each Cloud project, whichever identity makes the call. Every identity
+# of the credential pool is assumed to belong to the same project; override with e.g.
+# GDOC_PROJECT_QUOTA_DOCS_WRITE=600.
+DEFAULT_PROJECT_QUOTAS = {
+    ('docs', 'read'): 3000,
+    ('docs', 'write'): 600,
+    ('drive', 'read'): 12000,
+    ('drive', 'write'): 3000,
+}
+# Share of each bucket that bulk work must leave for interactive requests
+BULK_RESERVE = float(os.getenv('GDOC_BULK_RESERVE', 0.25))
+MAX_RETRIES = int(os.getenv('GDOC_MAX_RETRIES', 5))
+BACKOFF_BASE = float(os.getenv('GDOC_BACKOFF_BASE', 1))
+BACKOFF_CAP = float(os.getenv('GDOC_BACKOFF_CAP', 32))
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'RATE_LIMIT_EXCEEDED')
+
+# Bucket of the whole project, next to one per identity
+PROJECT = '*'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS rate_buckets (
+        name TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )''',
+    # Usage counts for the per-identity stats
+    store.add_column('rate_buckets', 'calls', 'INTEGER NOT NULL DEFAULT 0'),
+    store.add_column('rate_buckets', 'throttled', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+# Priority of the Google calls made in the current context: 'interactive' or 'bulk'.
+# A context variable, so pipeline stages running on other threads inherit it.
+_priority = contextvars.ContextVar('rate_priority', default='interactive')
+# Google identity (see credential_pool) the calls in the current context are made as, and
+# whether a throttled call should fail right away so the caller can switch identities
+_identity = contextvars.ContextVar('rate_identity', default='default')
+_fallback = contextvars.ContextVar('rate_fallback', default=False)
+
+
+def quota_per_minute(api, quota):
+    return float(os.getenv(f'GDOC_QUOTA_{api.upper()}_{quota.upper()}', DEFAULT_QUOTAS.get((api, quota), 600)))
+
+
+def project_quota_per_minute(api, quota):
+    return float(os.getenv(
+        f'GDOC_PROJECT_QUOTA_{api.upper()}_{quota.upper()}', DEFAULT_PROJECT_QUOTAS.get((api, quota), 6000)
+    ))
+
+
+def current_priority():
+    return _priority.get()
+
+
+@contextmanager
+def priority(level):
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_identity():
+    return _identity.get()
+
+
+# Make the calls in this context as `name`. With fallback=True a rate-limited call is raised
+# at once instead of retried, because another identity still has quota.
+@contextmanager
+def identity(name, fallback=False):
+    token = _identity.set(name)
+    fallback_token = _fallback.set(fallback)
+    try:
+        yield
+    finally:
+        _fallback.reset(fallback_token)
+        _identity.reset(token)
+
+
+def _bucket(api, quota, identity_name=None):
+    return f'{identity_name or current_identity()}:{api}:{quota}'
+
+
+def _tokens(row, capacity, rate, now):
+    return capacity if row is None else min(capacity, row['tokens'] + (now - row['updated_at']) * rate)
+
+
+# Take `cost` tokens from every bucket or from none.
+# buckets are (name, capacity, rate); returns 0 on success, or how long to wait.
+def _try_acquire(buckets, cost, bulk):
+    now = time.time()
+    store.ensure_schema('rate_buckets', SCHEMA)
+    with store.transaction() as db:
+        levels = []
+        wait = 0
+        for name, capacity, rate in buckets:
+            row = db.execute('SELECT tokens, updated_at FROM rate_buckets WHERE name = ?', (name,)).fetchone()
+            tokens = _tokens(row, capacity, rate, now)
+            # Never reserve so much that even a full bucket could not admit the call
+            reserve = min(capacity * BULK_RESERVE, max(0, capacity - cost)) if bulk else 0
+            if not (tokens - cost >= reserve or (tokens >= capacity and cost > capacity)):
+                wait = max(wait, (cost + reserve - tokens) / rate)
+            levels.append((name, tokens))
+        for name, tokens in levels:
+            taken = 0 if wait else cost
+            db.execute(
+                'INSERT INTO rate_buckets (name, tokens, updated_at, calls) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at, '
+                'calls = calls + excluded.calls',
+                (name, tokens - taken, now, taken)
+            )
+    return wait
+
+
+# Block until the buckets of the current identity and of the project have room for `cost`
+# requests of an API/quota class
+def acquire(api, quota, cost=1):
+    per_minute = quota_per_minute(api, quota)
+    project_per_minute = project_quota_per_minute(api, quota)
+    buckets = [
+        (_bucket(api, quota), per_minute, per_minute / 60),
+        (_bucket(api, quota, PROJECT), project_per_minute, project_per_minute / 60),
+    ]
+    name = buckets[0][0]
+
+    waited = 0
+    while True:
+        wait = _try_acquire(buckets, cost, current_priority() == 'bulk')
+        if not wait:
+            break
+        wait = min(wait, 1.0)
+        # A call waiting for quota (or abandoned while waiting) does not use up its stage's timeout
+        pipeline.check_cancelled()
+        time.sleep(wait)
+        pipeline.exclude(wait)
+        waited += wait
+    if waited:
+        logging.debug(f"Waited {waited:.2f}s for {name} quota ({current_priority()})")
+    return waited
+
+
+# Empty the current identity's bucket after Google throttled it, so every worker slows down together
+def drain(api, quota):
+    store.ensure_schema('rate_buckets', SCHEMA)
+    store.get_db().execute(
+        'INSERT INTO rate_buckets (name, tokens, updated_at, throttled) VALUES (?, 0, ?, 1) '
+        'ON CONFLICT (name) DO UPDATE SET tokens = 0, updated_at = excluded.updated_at, throttled = throttled + 1',
+        (_bucket(api, quota), time.time())
+    )
+
+
+# Share (0-1) of an identity's quota that is left, for the scarcest of the given classes
+def headroom(identity_name, classes=tuple(DEFAULT_QUOTAS)):
+    store.ensure_schema('rate_buckets', SCHEMA)
+    db = store.get_db()
+    now = time.time()
+    shares = []
+    for api, quota in classes:
+        per_minute = quota_per_minute(api, quota)
+        row = db.execute(
+            'SELECT tokens, updated_at FROM rate_buckets WHERE name = ?', (_bucket(api, quota, identity_name),)
+        ).fetchone()
+        shares.append(_tokens(row, per_minute, per_minute / 60, now) / per_minute)
+    return min(shares, default=1.0)
+
+
+# Calls made and times throttled by Google for each quota class of an identity
+def usage(identity_name):
+    store.ensure_schema('rate_buckets', SCHEMA)
+    db = store.get_db()
+    result = {}
+    for api, quota in DEFAULT_QUOTAS:
+        row = db.execute(
+            'SELECT calls, throttled FROM rate_buckets WHERE name = ?', (_bucket(api, quota, identity_name),)
+        ).fetchone()
+        result[f'{api}.{quota}'] = {
+            'calls': row['calls'] if row else 0,
+            'throttled': row['throttled'] if row else 0,
+            'headroom': round(headroom(identity_name, [(api, quota)]), 3),
+        }
+    return result
+
+
+def is_rate_limited(error):
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    return error.resp.status == 403 and any(reason in str(error.content) for reason in RATE_LIMIT_REASONS)
+
+
+def is_retryable(error):
+    if is_rate_limited(error):
+        return True
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    return isinstance(error, (socket.timeout, ConnectionError, TimeoutError))
+
+
+def backoff_delay(attempt, error=None):
+    retry_after = None
+    if isinstance(error, HttpError):
+        retry_after = error.resp.get('retry-after')
+    if retry_after and str(retry_after).isdigit():
+        return float(retry_after)
+    # Full jitter: a random delay up to the exponential bound
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def _outcome(error):
+    if isinstance(error, HttpError):
+        return str(error.resp.status)
+    return type(error).__name__
+
+
+# Run a Google API call within the shared quota, retrying throttled and failed calls.
+# Calls that must not run twice (safe_to_retry=False) are only retried when Google
+# rejected them for rate limiting, which guarantees they were not applied.
+def call(fn, api, quota, cost=1, safe_to_retry=True, method=None, body_bytes=0):
+    method = method or f'{api}.{quota}'
+    identity_name = current_identity()
+    start = time.perf_counter()
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            pipeline.check_cancelled()
+            waited = acquire(api, quota, cost)
+            pipeline.check_cancelled()
+            metrics.inc('gdoc_google_api_quota_wait_seconds_total', waited, api=api, quota=quota)
+            if waited:
+                profiler.record('quota_wait', method=method, identity=identity_name, seconds=round(waited, 4))
+            metrics.inc('gdoc_google_api_request_bytes_total', body_bytes, api=api, method=method)
+            try:
+                result = fn()
+            except Exception as e:
+                metrics.inc(
+                    'gdoc_google_api_calls_total', api=api, method=method, outcome=_outcome(e), identity=identity_name
+                )
+                if is_rate_limited(e):
+                    drain(api, quota)
+                    if _fallback.get():
+                        raise
+                retryable = is_rate_limited(e) or (safe_to_retry and is_retryable(e))
+                if not retryable or attempt == MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt, e)
+                metrics.inc('gdoc_google_api_retries_total', api=api, method=method)
+                profiler.record('retry', method=method, error=_outcome(e), delay=round(delay, 2))
+                logging.warning(f"{method} call failed ({e}); retry {attempt + 1}/{MAX_RETRIES} in {delay:.1f}s")
+                time.sleep(delay)
+                if is_rate_limited(e):
+                    pipeline.exclude(delay)
+            else:
+                metrics.inc('gdoc_google_api_calls_total', api=api, method=method, outcome='ok', identity=identity_name)
+                return result
+    finally:
+        metrics.observe('gdoc_google_api_seconds', time.perf_counter() - start, api=api, method=method)
+
+
+# Execute a googleapiclient request through the scheduler
+def execute(request, api, quota='write', safe_to_retry=True):
+    return call(
+        request.execute, api, quota, safe_to_retry=safe_to_retry,
+        method=getattr(request, 'methodId', None), body_bytes=len(getattr(request, 'body', None) or b'')
+    )
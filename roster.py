@@ -0,0 +1,245 @@
+import os
+import csv
+import json
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+
+import rate_scheduler
+
+# Processes generating documents, each running THREADS documents at a time.
+# Google calls are paced by the shared rate buckets whatever these are set to.
+PROCESSES = int(os.getenv('GDOC_ROSTER_PROCESSES', os.cpu_count() or 2))
+THREADS = int(os.getenv('GDOC_ROSTER_THREADS', 8))
+# How often the checkpoint file is rewritten while results come in
+CHECKPOINT_INTERVAL = float(os.getenv('GDOC_ROSTER_CHECKPOINT_INTERVAL', 2))
+
+
+class RosterError(Exception):
+    pass
+
+
+# Shop links of a CSV row: a shop_links column holding a JSON array or '|'-separated URLs,
+# or one shop_link_<n> column per link (0-based, in the order links.json uses)
+def _csv_shop_links(row):
+    value = (row.get('shop_links') or '').strip()
+    if value.startswith('['):
+        return json.loads(value)
+    if value:
+        return [link.strip() for link in value.split('|')]
+    numbered = {}
+    for column, link in row.items():
+        if column and column.startswith('shop_link_') and column[len('shop_link_'):].isdigit():
+            numbered[int(column[len('shop_link_'):])] = (link or '').strip()
+    return [numbered.get(index, '') for index in range(max(numbered) + 1)] if numbered else None
+
+
+# (index, record or None, error or None) for every row of a .csv or JSON-lines roster, read lazily
+def iter_rows(path):
+    with open(path, newline='', encoding='utf-8-sig') as handle:
+        if path.lower().endswith('.csv'):
+            for index, row in enumerate(csv.DictReader(handle)):
+                try:
+                    record = {'ibo_id': row.get('ibo_id'), 'ibo_name': row.get('ibo_name') or None}
+                    shop_links = _csv_shop_links(row)
+                    if shop_links is not None:
+                        record['shop_links'] = shop_links
+                    yield index, record, None
+                except ValueError as e:
+                    yield index, None, f"Invalid shop_links: {e}"
+        else:
+            index = 0
+            for line in handle:
+                if not line.strip():
+                    continue
+                try:
+                    yield index, json.loads(line), None
+                except ValueError as e:
+                    yield index, None, f"Invalid JSON: {e}"
+                index += 1
+
+
+# Rows already finished in an earlier run. Rows complete out of order, so the file keeps
+# the number of leading rows that are all done plus the finished rows after them, and how
+# far the results file had been written; results written after the last save are read back.
+class Checkpoint:
+    def __init__(self, path, roster, results_file):
+        self.path = path
+        self.roster = os.path.abspath(roster)
+        self.results_file = results_file
+        self.done_below = 0
+        self.done = set()
+        self._saved_at = 0
+
+    def load(self):
+        offset = 0
+        if os.path.exists(self.path):
+            with open(self.path) as handle:
+                data = json.load(handle)
+            if data.get('roster') != self.roster:
+                raise RosterError(f"{self.path} belongs to {data.get('roster')}; pass --restart to start over.")
+            self.done_below = data['done_below']
+            self.done = set(data['done'])
+            offset = data['results_offset']
+        if os.path.exists(self.results_file):
+            with open(self.results_file, 'rb') as handle:
+                handle.seek(offset)
+                for line in handle:
+                    try:
+                        self.add(json.loads(line)['index'])
+                    except (ValueError, KeyError):
+                        # A line cut short by the crash; its row runs again
+                        pass
+        return self
+
+    def __contains__(self, index):
+        return index < self.done_below or index in self.done
+
+    def add(self, index):
+        self.done.add(index)
+        while self.done_below in self.done:
+            self.done.remove(self.done_below)
+            self.done_below += 1
+
+    def save(self, results_offset, force=False):
+        now = time.monotonic()
+        if not force and now - self._saved_at < CHECKPOINT_INTERVAL:
+            return
+        tmp_file = f'{self.path}.tmp'
+        with open(tmp_file, 'w') as handle:
+            json.dump({
+                'roster': self.roster, 'done_below': self.done_below, 'done': sorted(self.done),
+                'results_offset': results_offset
+            }, handle)
+        os.replace(tmp_file, self.path)
+        self._saved_at = now
+
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as handle:
+        handle.seek(-1, os.SEEK_END)
+        return handle.read(1) == b'\n'
+
+
+def _result(index, record, **fields):
+    return dict(index=index, ibo_id=(record or {}).get('ibo_id'), **fields)
+
+
+# Body of a worker process: THREADS threads taking (index, record) tasks until they get None.
+# Workers also stop when the parent dies, so a killed run leaves nothing behind.
+def _work(tasks, results, generate, threads, parent):
+    def loop():
+        while True:
+            try:
+                task = tasks.get(timeout=1)
+            except queue.Empty:
+                if os.getppid() != parent:
+                    return
+                continue
+            if task is None:
+                return
+            index, record = task
+            try:
+                with rate_scheduler.priority('bulk'):
+                    doc_link = generate(record)
+            except Exception as e:
+                logging.error(f"Roster row {index} failed: {e}")
+                results.put(_result(index, record, success=False, message=str(e)))
+            else:
+                results.put(_result(index, record, success=True, docLink=doc_link))
+
+    workers = [threading.Thread(target=loop, name=f'roster-{index}') for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # Forked processes end with os._exit: write out the queued log records first
+    logging.shutdown()
+
+
+# Generate a document for every valid row of a roster, writing one JSON result line per
+# row to `output` as soon as it is known and recording finished rows in `checkpoint`, so
+# a run that crashed continues where it stopped.
+# validate(record) returns an error message or None; generate(record) returns the docLink
+# and runs in forked worker processes. progress(counts) is called as results come in.
+# Returns the counts {'total', 'skipped', 'invalid', 'done', 'failed'}.
+def run(path, output, checkpoint_path, validate, generate, processes=PROCESSES, threads=THREADS,
+        restart=False, progress=None):
+    if restart:
+        for stale in (output, checkpoint_path):
+            if os.path.exists(stale):
+                os.remove(stale)
+    checkpoint = Checkpoint(checkpoint_path, path, output).load()
+    counts = {'total': 0, 'skipped': 0, 'invalid': 0, 'done': 0, 'failed': 0}
+
+    with open(output, 'ab') as results_file:
+        # A line cut short by a crash must not run into the next result
+        if results_file.tell() and not _ends_with_newline(output):
+            results_file.write(b'\n')
+
+        def write(result):
+            results_file.write(json.dumps(result).encode() + b'\n')
+            results_file.flush()
+            checkpoint.add(result['index'])
+            checkpoint.save(results_file.tell())
+
+        # Validate the whole roster before generating anything, so bad rows are reported at once
+        for index, record, error in iter_rows(path):
+            counts['total'] += 1
+            if index in checkpoint:
+                counts['skipped'] += 1
+                continue
+            error = error or validate(record)
+            if error:
+                counts['invalid'] += 1
+                write(_result(index, record, success=False, message=error))
+        checkpoint.save(results_file.tell(), force=True)
+        if progress:
+            progress(dict(counts))
+
+        pending = counts['total'] - counts['skipped'] - counts['invalid']
+        if pending:
+            context = multiprocessing.get_context('fork')
+            tasks = context.Queue(maxsize=processes * threads * 2)
+            results = context.Queue()
+            workers = [
+                context.Process(
+                    target=_work, args=(tasks, results, generate, threads, os.getpid()), name=f'roster-{index}'
+                )
+                for index in range(min(processes, pending))
+            ]
+            for worker in workers:
+                worker.start()
+
+            def feed():
+                for index, record, error in iter_rows(path):
+                    if error is None and index not in checkpoint and validate(record) is None:
+                        tasks.put((index, record))
+                # One stop marker for every thread of every worker process
+                for _ in range(len(workers) * threads):
+                    tasks.put(None)
+
+            threading.Thread(target=feed, name='roster-feeder', daemon=True).start()
+            try:
+                while pending:
+                    try:
+                        result = results.get(timeout=5)
+                    except queue.Empty:
+                        if not any(worker.is_alive() for worker in workers):
+                            raise RosterError("Every roster worker process exited; rerun to resume.")
+                        continue
+                    counts['done' if result['success'] else 'failed'] += 1
+                    pending -= 1
+                    write(result)
+                    if progress:
+                        progress(dict(counts))
+            finally:
+                checkpoint.save(results_file.tell(), force=True)
+                for worker in workers:
+                    if pending:
+                        worker.terminate()
+                    worker.join()
+
+    return counts
@@ -0,0 +1,139 @@
+import os
+import time
+import secrets
+import threading
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+import store
+
+# 'cookie' keeps the session in a signed cookie (Flask's default, no server state),
+# 'sqlite' keeps it in the shared store and only reads it when a route uses it,
+# 'filesystem' is the previous Flask-Session setup with one file per session
+BACKEND = os.getenv('GDOC_SESSION_BACKEND', 'cookie')
+# How often each worker deletes expired sessions from the store
+PRUNE_INTERVAL = int(os.getenv('GDOC_SESSION_PRUNE_INTERVAL', 600))
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)',
+]
+
+_serializer = TaggedJSONSerializer()
+
+
+# A session that reads its data from the store the first time it is used.
+# Requests that never touch `session` never query the database.
+class LazySession(CallbackDict, SessionMixin):
+    def __init__(self, sid, loader):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(None, on_update)
+        self.sid = sid
+        self.loaded = False
+        self.modified = False
+        self._loader = loader
+
+    def _load(self):
+        if not self.loaded:
+            self.loaded = True
+            dict.update(self, self._loader())
+
+
+def _loading(name):
+    method = getattr(CallbackDict, name)
+
+    def wrapper(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in (
+    '__getitem__', '__contains__', '__iter__', '__len__', '__repr__', '__setitem__', '__delitem__',
+    'get', 'keys', 'values', 'items', 'copy', 'clear', 'pop', 'popitem', 'setdefault', 'update',
+):
+    setattr(LazySession, _name, _loading(_name))
+
+
+class SqliteSessionInterface(SessionInterface):
+    def __init__(self):
+        self._pruned_at = 0
+        self._prune_lock = threading.Lock()
+
+    def _db(self):
+        store.ensure_schema('sessions', SCHEMA)
+        return store.get_db()
+
+    def _read(self, sid):
+        row = self._db().execute(
+            'SELECT data FROM sessions WHERE id = ? AND expires_at > ?', (sid, time.time())
+        ).fetchone()
+        return _serializer.loads(row['data']) if row else {}
+
+    def _prune(self):
+        now = time.time()
+        if now - self._pruned_at < PRUNE_INTERVAL or not self._prune_lock.acquire(blocking=False):
+            return
+        try:
+            self._pruned_at = now
+            self._db().execute('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+        finally:
+            self._prune_lock.release()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        return LazySession(sid, lambda: self._read(sid) if sid else {})
+
+    def save_session(self, app, session, response):
+        if not session.loaded:
+            return
+        response.vary.add('Cookie')
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and session.sid:
+                self._db().execute('DELETE FROM sessions WHERE id = ?', (session.sid,))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+
+        sid = session.sid or secrets.token_urlsafe(32)
+        expires = self.get_expiration_time(app, session)
+        # Browser-session cookies still expire server-side after the permanent lifetime
+        expires_at = expires.timestamp() if expires else time.time() + app.permanent_session_lifetime.total_seconds()
+        self._db().execute(
+            'INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)',
+            (sid, _serializer.dumps(dict(session)), expires_at)
+        )
+        self._prune()
+        response.set_cookie(
+            name, sid, expires=expires, httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app)
+        )
+
+
+# Install the configured session backend on the app
+def init_app(app, backend=BACKEND):
+    if backend == 'cookie':
+        return
+    if backend == 'sqlite':
+        app.session_interface = SqliteSessionInterface()
+    elif backend == 'filesystem':
+        from flask_session import Session
+        app.config.setdefault('SESSION_TYPE', 'filesystem')
+        app.config.setdefault('SESSION_PERMANENT', True)
+        Session(app)
+    else:
+        raise ValueError(f"Unknown session backend {backend!r}; use 'cookie', 'sqlite' or 'filesystem'.")
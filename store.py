@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import threading
+import fcntl
+from contextlib import contextmanager
+
+# Local state shared by every gunicorn worker (template masters, jobs, indexes...)
+DB_PATH = os.getenv('GDOC_DB_PATH', 'gdoccreator.db')
+LOCK_DIR = os.getenv('GDOC_LOCK_DIR', '.locks')
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schemas = set()
+
+
+# Return this thread's connection to the shared SQLite database
+def get_db():
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+
+# Create the tables a module needs, once per process.
+# A statement may also be a function of the connection, e.g. to migrate an older table.
+def ensure_schema(name, statements):
+    if name in _schemas:
+        return
+    with _schema_lock:
+        if name in _schemas:
+            return
+        db = get_db()
+        for statement in statements:
+            if callable(statement):
+                statement(db)
+            else:
+                db.execute(statement)
+        _schemas.add(name)
+
+
+def columns(db, table):
+    return {row['name'] for row in db.execute(f'PRAGMA table_info({table})')}
+
+
+# Schema step that adds a column to a table created before the column existed
+def add_column(table, column, definition):
+    def migrate(db):
+        with transaction():
+            if column not in columns(db, table):
+                db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return migrate
+
+
+# Run a block inside a write transaction (BEGIN IMMEDIATE serializes writers across workers)
+@contextmanager
+def transaction():
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    else:
+        db.execute('COMMIT')
+
+
+# Hold an exclusive lock shared by all processes on this host
+@contextmanager
+def file_lock(name, blocking=True):
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(os.path.join(LOCK_DIR, f'{name}.lock'), 'a') as handle:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(handle, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
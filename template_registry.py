@@ -0,0 +1,142 @@
+import os
+import time
+import hashlib
+import logging
+from googleapiclient.errors import HttpError
+
+import store
+import rate_scheduler
+import template_slimmer
+
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+GDOC_MIMETYPE = 'application/vnd.google-apps.document'
+
+MASTERS_TABLE = '''CREATE TABLE IF NOT EXISTS template_masters (
+    template_hash TEXT NOT NULL,
+    identity TEXT NOT NULL,
+    template_file TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (template_hash, identity)
+)'''
+
+
+# Masters used to be one per template version; each Google identity now has its own,
+# since a document in one account's Drive cannot be copied by another
+def _migrate_masters(db):
+    with store.transaction():
+        existing = store.columns(db, 'template_masters')
+        if existing and 'identity' not in existing:
+            db.execute('ALTER TABLE template_masters RENAME TO template_masters_v1')
+            db.execute(MASTERS_TABLE)
+            db.execute(
+                "INSERT INTO template_masters (template_hash, identity, template_file, document_id, created_at) "
+                "SELECT template_hash, 'default', template_file, document_id, created_at FROM template_masters_v1"
+            )
+            db.execute('DROP TABLE template_masters_v1')
+
+
+SCHEMA = [
+    _migrate_masters,
+    MASTERS_TABLE,
+]
+
+# Hashes are cached per (path, mtime, size) so unchanged templates are not re-read
+_hash_cache = {}
+
+
+# Content hash of a template file
+def template_hash(template_file):
+    stat = os.stat(template_file)
+    key = (os.path.abspath(template_file), stat.st_mtime_ns, stat.st_size)
+    cached = _hash_cache.get(key)
+    if cached:
+        return cached
+
+    digest = hashlib.sha256()
+    with open(template_file, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), b''):
+            digest.update(chunk)
+    _hash_cache[key] = digest.hexdigest()
+    return _hash_cache[key]
+
+
+def _lookup_master(content_hash, identity):
+    store.ensure_schema('template_masters', SCHEMA)
+    row = store.get_db().execute(
+        'SELECT document_id FROM template_masters WHERE template_hash = ? AND identity = ?', (content_hash, identity)
+    ).fetchone()
+    return row['document_id'] if row else None
+
+
+def _forget_master(content_hash, identity, document_id):
+    store.get_db().execute(
+        'DELETE FROM template_masters WHERE template_hash = ? AND identity = ? AND document_id = ?',
+        (content_hash, identity, document_id)
+    )
+
+
+# Upload the `.docx` once (without its embedded fonts) and let Drive convert it into the master Google Doc
+def _upload_master(drive_service, template_file, content_hash, identity):
+    logging.info(f"Uploading template master for {template_file} ({content_hash[:12]}) as {identity}.")
+    file_metadata = {
+        'name': f'Template master - {os.path.basename(template_file)} ({content_hash[:12]})',
+        'mimeType': GDOC_MIMETYPE
+    }
+    from googleapiclient.http import MediaFileUpload
+    media = MediaFileUpload(template_slimmer.slim_template(template_file), mimetype=DOCX_MIMETYPE)
+    # A failed create may still have made the file, so it is only retried when rate limited
+    uploaded_file = rate_scheduler.execute(
+        drive_service.files().create(body=file_metadata, media_body=media, fields='id'), 'drive', 'write',
+        safe_to_retry=False
+    )
+
+    document_id = uploaded_file.get('id')
+    store.get_db().execute(
+        'INSERT OR REPLACE INTO template_masters (template_hash, identity, template_file, document_id, created_at) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (content_hash, identity, template_file, document_id, time.time())
+    )
+    logging.info(f"Template master for {template_file} is document ID: {document_id}")
+    return document_id
+
+
+# Return the master document ID for the template's current contents in the Drive of the
+# identity that drive_service is authorized as, uploading it if needed
+def get_master_id(drive_service, template_file, identity='default'):
+    content_hash = template_hash(template_file)
+    document_id = _lookup_master(content_hash, identity)
+    if document_id:
+        return document_id
+
+    # Only one worker uploads a given template version; the others wait and reuse its ID
+    with store.file_lock(f'template-{content_hash[:16]}-{identity}'):
+        document_id = _lookup_master(content_hash, identity)
+        if document_id:
+            return document_id
+        return _upload_master(drive_service, template_file, content_hash, identity)
+
+
+# Create a new Google Doc for a request by copying the template master server-side
+def copy_template(drive_service, template_file, name='Generated Google Doc', identity='default'):
+    content_hash = template_hash(template_file)
+
+    for attempt in range(2):
+        master_id = get_master_id(drive_service, template_file, identity)
+        try:
+            # Like files.create, a failed copy may have made the file: only rate limited calls are retried
+            copied = rate_scheduler.execute(
+                drive_service.files().copy(fileId=master_id, body={'name': name}, fields='id'), 'drive', 'write',
+                safe_to_retry=False
+            )
+        except HttpError as e:
+            # The master was deleted from Drive; forget it and upload a fresh one
+            if e.resp.status == 404 and attempt == 0:
+                logging.warning(f"Template master {master_id} is gone, re-uploading {template_file}.")
+                _forget_master(content_hash, identity, master_id)
+                continue
+            raise
+
+        document_id = copied.get('id')
+        logging.info(f"Copied template master {master_id} to document ID: {document_id}")
+        return document_id
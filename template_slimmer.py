@@ -0,0 +1,89 @@
+import os
+import re
+import time
+import zipfile
+import logging
+import threading
+
+import template_registry
+
+# Google Docs ignores fonts embedded in a .docx when converting it, and they are
+# most of the template's bytes, so uploads and local renders use a slimmed copy.
+SLIM_TEMPLATES = os.getenv('GDOC_SLIM_TEMPLATES', '1') == '1'
+CACHE_DIR = os.getenv('GDOC_TEMPLATE_CACHE_DIR', '.template_cache')
+# Assumed upload bandwidth for the savings report's estimates, in megabits per second
+UPLOAD_MBPS = float(os.getenv('GDOC_UPLOAD_MBPS', 10))
+
+FONT_RELATIONSHIP_RE = re.compile(r'<Relationship\b[^>]*relationships/font"[^>]*/>')
+EMBED_RE = re.compile(r'<w:embed(?:Regular|Bold|Italic|BoldItalic)\b[^>]*/>')
+ODTTF_DEFAULT_RE = re.compile(r'<Default Extension="odttf"[^>]*/>')
+SETTINGS_RE = re.compile(r'<w:(?:embedTrueTypeFonts|embedSystemFonts|saveSubsetFonts)\b[^>]*/>')
+
+
+def _slim_part(name, data):
+    if name == '[Content_Types].xml':
+        return ODTTF_DEFAULT_RE.sub('', data.decode('utf-8')).encode('utf-8')
+    if name == 'word/fontTable.xml':
+        return EMBED_RE.sub('', data.decode('utf-8')).encode('utf-8')
+    if name == 'word/_rels/fontTable.xml.rels':
+        rels = FONT_RELATIONSHIP_RE.sub('', data.decode('utf-8'))
+        return None if '<Relationship ' not in rels else rels.encode('utf-8')
+    if name == 'word/settings.xml':
+        return SETTINGS_RE.sub('', data.decode('utf-8')).encode('utf-8')
+    return data
+
+
+# Write a copy of the template without embedded fonts, recompressed at the highest level.
+# Threads of one process may build the same copy at once, so each writes its own temporary file.
+def _write_slim(template_file, target):
+    tmp_target = f'{target}.{os.getpid()}-{threading.get_ident()}.tmp'
+    with zipfile.ZipFile(template_file) as source, \
+            zipfile.ZipFile(tmp_target, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as slim:
+        for info in source.infolist():
+            # Skip the fonts without even decompressing them
+            if info.filename.startswith('word/fonts/'):
+                continue
+            data = _slim_part(info.filename, source.read(info.filename))
+            if data is not None:
+                slim.writestr(info.filename, data)
+    os.replace(tmp_target, target)
+
+
+# Path of the slimmed copy of a template, building it on first use. Cached by content hash.
+def slim_template(template_file):
+    if not SLIM_TEMPLATES:
+        return template_file
+
+    content_hash = template_registry.template_hash(template_file)
+    target = os.path.join(CACHE_DIR, f'{content_hash}.docx')
+    if not os.path.exists(target):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        start = time.perf_counter()
+        _write_slim(template_file, target)
+        logging.info(
+            f"Slimmed {template_file}: {os.path.getsize(template_file)} -> {os.path.getsize(target)} bytes "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+    return target
+
+
+def _upload_seconds(size):
+    return size * 8 / (UPLOAD_MBPS * 1000 * 1000)
+
+
+# Size and estimated upload-time savings for each template (upload times are not measured)
+def report(template_files):
+    rows = []
+    for template_file in template_files:
+        slim_file = slim_template(template_file)
+        original_size = os.path.getsize(template_file)
+        slim_size = os.path.getsize(slim_file)
+        rows.append({
+            'template': template_file,
+            'original_bytes': original_size,
+            'slim_bytes': slim_size,
+            'saved_percent': round(100 * (1 - slim_size / original_size), 1),
+            'estimated_original_upload_seconds': round(_upload_seconds(original_size), 3),
+            'estimated_slim_upload_seconds': round(_upload_seconds(slim_size), 3),
+        })
+    return rows
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules live at the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import store
+
+
+# A fresh SQLite store per test, as GDOC_DB_PATH / GDOC_LOCK_DIR would point the app at
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setenv('GDOC_DB_PATH', str(tmp_path / 'gdoccreator.db'))
+    monkeypatch.setenv('GDOC_LOCK_DIR', str(tmp_path / '.locks'))
+    monkeypatch.setattr(store, 'DB_PATH', os.environ['GDOC_DB_PATH'])
+    monkeypatch.setattr(store, 'LOCK_DIR', os.environ['GDOC_LOCK_DIR'])
+    monkeypatch.setattr(store, '_schemas', set())
+    monkeypatch.setattr(store, '_local', type(store._local)())
+    yield store.get_db()
+    store.get_db().close()
+
+
+# The Flask app with Google stubbed out: one authorized identity, and clients that are never
+# called because tests replace the functions that would use them. No background workers start.
+@pytest.fixture
+def app_module(db, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    import app
+    monkeypatch.setattr(app, 'get_creds', lambda: object())
+    monkeypatch.setattr(app.identity_pool, 'ranked', lambda: ['default'])
+    monkeypatch.setattr(app.identity_pool, 'get', lambda name: object())
+    monkeypatch.setattr(app.google_clients, 'drive_service', lambda creds, identity='default': None)
+    monkeypatch.setattr(app.google_clients, 'docs_service', lambda creds, identity='default': None)
+    monkeypatch.setattr(app.job_queue, 'start_workers', lambda handler: None)
+    monkeypatch.setattr(app.lifecycle, 'start', lambda get_drive_services: None)
+    monkeypatch.setattr(app.copy_pool, 'start', lambda get_drive_services, template_file: None)
+    return app
+
+
+# Test client for the stubbed app, arriving over HTTPS as behind the production proxy
+@pytest.fixture
+def client(app_module):
+    test_client = app_module.app.test_client()
+    test_client.environ_base['HTTP_X_FORWARDED_PROTO'] = 'https'
+    return test_client
@@ -0,0 +1,53 @@
+import json
+import threading
+
+import ibo_documents
+import idempotency
+
+SHOP_LINKS = [f'https://shop.example/{index}' for index in range(21)]
+
+
+def _record(version):
+    return {'ibo_id': '7', 'ibo_name': 'Ann', 'shop_links': [f'{link}?v={version}' for link in SHOP_LINKS]}
+
+
+def _batch(lines):
+    return '\n'.join(line if isinstance(line, str) else json.dumps(line) for line in lines)
+
+
+def test_batch_stopped_before_sharing_keeps_the_previous_document(app_module, client, monkeypatch):
+    app = app_module
+    monkeypatch.setattr(app, 'RENDER_MODE', 'local')
+    uploaded = []
+    started = threading.Event()
+
+    def upload(drive_service, template_file, tag_to_link, ibo_name, ibo_id):
+        started.set()
+        uploaded.append(f'doc-{len(uploaded) + 1}')
+        return uploaded[-1]
+
+    shared, deleted = [], []
+    monkeypatch.setattr(app, 'upload_rendered_docx', upload)
+    monkeypatch.setattr(app.bulk, 'share_documents', lambda drive_service, ids: shared.extend(ids) or {})
+    monkeypatch.setattr(app, 'discard_document', lambda drive_service, document_id: deleted.append(document_id))
+
+    first = client.post('/create-docs/batch', data=_batch([_record(1)]), content_type='application/x-ndjson')
+    assert [json.loads(line)['documentId'] for line in first.get_data(as_text=True).splitlines()] == ['doc-1']
+
+    # The client goes away after the first result line, before the new document is shared
+    response = client.post(
+        '/create-docs/batch', data=_batch([_record(2), 'not json']), content_type='application/x-ndjson',
+        buffered=False
+    )
+    lines = iter(response.response)
+    assert json.loads(next(lines))['message'].startswith('Line 2 is not valid JSON')
+    assert started.wait(5)
+    response.close()
+
+    assert shared == ['doc-1']
+    assert deleted == ['doc-2']
+    assert ibo_documents.get(7)['document_id'] == 'doc-1'
+    assert idempotency.lookup(app.generation_key(_record(1))) == 'doc-1'
+    assert idempotency.lookup(app.generation_key(_record(2))) is None
+    rows = app.lifecycle.store.get_db().execute('SELECT document_id, superseded_at FROM document_lifecycle').fetchall()
+    assert [(row['document_id'], row['superseded_at']) for row in rows] == [('doc-1', None)]
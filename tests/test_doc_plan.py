@@ -0,0 +1,136 @@
+import doc_plan
+
+LINK = 'https://example.com/service'
+
+# Segment texts of the fixture template. The body starts at index 1, headers at 0.
+BODY_INTRO = '\U0001F600 Dear {ibo_name}, see {service_link}.\n'
+BODY_CELL = 'ID {ibo_id}{nickname}!\n'
+HEADER = 'For {ibo_name}\n'
+
+
+def _paragraph(start, *runs):
+    elements = []
+    for text in runs:
+        end = start + doc_plan.utf16_len(text)
+        elements.append({'startIndex': start, 'endIndex': end, 'textRun': {'content': text}})
+        start = end
+    return {'paragraph': {'elements': elements}}
+
+
+# A Docs API document with placeholders in a body paragraph, a table cell and a header;
+# {ibo_name} is split across two text runs as Docs does when formatting changes mid-word
+def _document():
+    cell_start = 1 + doc_plan.utf16_len(BODY_INTRO)
+    return {
+        'body': {'content': [
+            _paragraph(1, '\U0001F600 Dear {ibo_', 'name}, see {service_link}.\n'),
+            {'table': {'tableRows': [{'tableCells': [{'content': [_paragraph(cell_start, BODY_CELL)]}]}]}},
+        ]},
+        'headers': {'kix.h1': {'content': [_paragraph(0, HEADER)]}},
+    }
+
+
+# Apply a batchUpdate to UTF-16 segment texts in order, like the Docs API does. The text each
+# link is set on, when its request is applied, is appended to `links` as (url, text).
+def _apply(segments, requests, links=None):
+    units = {key: list(text.encode('utf-16-le')) for key, (base, text) in segments.items()}
+    for request in requests:
+        if 'insertText' in request:
+            location = request['insertText']['location']
+            segment_id = location.get('segmentId')
+            position = (location['index'] - segments[segment_id][0]) * 2
+            units[segment_id][position:position] = list(request['insertText']['text'].encode('utf-16-le'))
+        elif 'deleteContentRange' in request:
+            text_range = request['deleteContentRange']['range']
+            segment_id = text_range.get('segmentId')
+            base = segments[segment_id][0]
+            assert text_range['startIndex'] < text_range['endIndex']
+            del units[segment_id][(text_range['startIndex'] - base) * 2:(text_range['endIndex'] - base) * 2]
+        elif 'updateTextStyle' in request and links is not None:
+            text_range = request['updateTextStyle']['range']
+            base = segments[text_range.get('segmentId')][0]
+            text = bytes(units[text_range.get('segmentId')]).decode('utf-16-le')
+            links.append((
+                request['updateTextStyle']['textStyle']['link']['url'],
+                _text({None: (base, text)}, None, text_range['startIndex'], text_range['endIndex'])
+            ))
+    return {key: (segments[key][0], bytes(value).decode('utf-16-le')) for key, value in units.items()}
+
+
+# Text between two document indexes of a segment
+def _text(segments, segment_id, start, end):
+    base, text = segments[segment_id]
+    return text.encode('utf-16-le')[(start - base) * 2:(end - base) * 2].decode('utf-16-le')
+
+
+def _slice(segments, occurrence):
+    return _text(segments, occurrence['segment_id'], occurrence['start'], occurrence['end'])
+
+
+def _render(replacements, links=None):
+    layout = doc_plan.locate_placeholders(_document())
+    requests = doc_plan.build_requests(layout, {'{service_link}': LINK}, replacements)
+    segments = _apply({None: (1, BODY_INTRO + BODY_CELL), 'kix.h1': (0, HEADER)}, requests, links)
+    return layout, requests, segments
+
+
+def test_locate_placeholders_in_body_table_and_header():
+    layout = doc_plan.locate_placeholders(_document())
+    segments = {None: (1, BODY_INTRO + BODY_CELL), 'kix.h1': (0, HEADER)}
+
+    assert [(o['tag'], o['segment_id']) for o in layout] == [
+        ('{ibo_name}', None), ('{service_link}', None), ('{ibo_id}', None), ('{nickname}', None),
+        ('{ibo_name}', 'kix.h1'),
+    ]
+    # The emoji before {ibo_name} is two UTF-16 code units
+    assert layout[0]['start'] == 1 + len('\U0001F600 Dear ') + 1
+    for occurrence in layout:
+        assert _slice(segments, occurrence) == occurrence['tag']
+
+
+def test_build_requests_fills_every_segment():
+    links = []
+    _, _, segments = _render({'{ibo_name}': 'Zoë \U0001F680', '{ibo_id}': '42', '{nickname}': ''}, links)
+
+    assert segments[None][1] == '\U0001F600 Dear Zoë \U0001F680, see Click here.\nID 42!\n'
+    assert segments['kix.h1'][1] == 'For Zoë \U0001F680\n'
+    assert links == [(LINK, doc_plan.CLICK_HERE)]
+
+
+def test_empty_replacement_is_only_deleted():
+    _, requests, segments = _render({'{ibo_name}': '', '{ibo_id}': '', '{nickname}': None})
+
+    assert segments[None][1] == '\U0001F600 Dear , see Click here.\nID !\n'
+    assert segments['kix.h1'][1] == 'For \n'
+    assert not any(request['insertText']['text'] == '' for request in requests if 'insertText' in request)
+
+
+def test_unknown_placeholders_are_left_alone():
+    _, _, segments = _render({'{ibo_name}': 'Ann'})
+
+    assert segments[None][1] == '\U0001F600 Dear Ann, see Click here.\nID {ibo_id}{nickname}!\n'
+
+
+def test_final_ranges_match_the_filled_in_document():
+    replacements = {'{ibo_name}': 'Zoë \U0001F680', '{ibo_id}': '42', '{nickname}': ''}
+    layout, _, segments = _render(replacements)
+
+    ranges = doc_plan.final_ranges(layout, {'{service_link}': LINK}, replacements)
+    assert [(r['tag'], r['segment_id']) for r in ranges] == [(o['tag'], o['segment_id']) for o in layout]
+    expected = {'{ibo_name}': 'Zoë \U0001F680', '{service_link}': doc_plan.CLICK_HERE, '{ibo_id}': '42', '{nickname}': ''}
+    for text_range in ranges:
+        assert _slice(segments, text_range) == expected[text_range['tag']]
+
+
+def test_replace_text_requests_renames_in_place():
+    replacements = {'{ibo_name}': 'Zoë \U0001F680', '{ibo_id}': '42', '{nickname}': ''}
+    layout, _, segments = _render(replacements)
+    ranges = doc_plan.final_ranges(layout, {'{service_link}': LINK}, replacements)
+    names = [r for r in ranges if r['tag'] == '{ibo_name}']
+
+    segments = _apply(segments, doc_plan.replace_text_requests(names, 'Bo'))
+    assert segments[None][1] == '\U0001F600 Dear Bo, see Click here.\nID 42!\n'
+    assert segments['kix.h1'][1] == 'For Bo\n'
+    expected = {'{ibo_name}': 'Bo', '{service_link}': doc_plan.CLICK_HERE, '{ibo_id}': '42', '{nickname}': ''}
+    for text_range in doc_plan.shift_ranges(ranges, names, 'Bo'):
+        assert _slice(segments, text_range) == expected[text_range['tag']]
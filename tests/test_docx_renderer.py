@@ -0,0 +1,140 @@
+import io
+import re
+import zipfile
+
+import docx_renderer
+from docx_renderer import Slot
+
+BOLD = '<w:rPr><w:b/></w:rPr>'
+ITALIC = '<w:rPr><w:i/></w:rPr>'
+LINK = 'https://example.com/service?a=1&b=2'
+
+
+# Static XML and slots of a parsed paragraph, with slots as (tag, rpr)
+def _shape(segments):
+    return [(segment.tag, segment.rpr) if isinstance(segment, Slot) else segment for segment in segments]
+
+
+# Visible text of a rendered document.xml, one line per paragraph
+def _paragraph_texts(document_xml):
+    return [
+        ''.join(re.findall(r'<w:t\b[^>]*>(.*?)</w:t>', paragraph, re.S))
+        for paragraph in re.findall(r'<w:p\b[^>]*>.*?</w:p>', document_xml, re.S)
+    ]
+
+
+def _render(document_xml, tag_to_link, replacements):
+    buffer = io.BytesIO()
+    zipfile.ZipFile(buffer, 'w').close()
+    template = docx_renderer.ParsedTemplate(
+        'hash', docx_renderer._parse_document(document_xml), '<Relationships></Relationships>', buffer.getvalue()
+    )
+    with zipfile.ZipFile(io.BytesIO(docx_renderer.render(template, tag_to_link, replacements))) as rendered:
+        return rendered.read(docx_renderer.DOCUMENT_PART).decode('utf-8'), rendered.read(docx_renderer.RELS_PART).decode('utf-8')
+
+
+def test_paragraph_without_placeholders_is_left_alone():
+    assert docx_renderer._parse_paragraph('<w:r><w:t>No {tags here</w:t></w:r>') is None
+
+
+def test_placeholder_split_across_runs():
+    inner = (
+        f'<w:r>{BOLD}<w:t xml:space="preserve">Dear {{ibo_</w:t></w:r>'
+        '<w:proofErr w:type="spellStart"/>'
+        f'<w:r w:rsidR="00AB">{ITALIC}<w:t>na</w:t></w:r>'
+        '<w:r><w:t>me}, welcome</w:t></w:r>'
+    )
+
+    assert _shape(docx_renderer._parse_paragraph(inner)) == [
+        f'<w:r>{BOLD}<w:t xml:space="preserve">Dear </w:t></w:r>',
+        ('{ibo_name}', BOLD),
+        '<w:proofErr w:type="spellStart"/>',
+        '<w:r><w:t xml:space="preserve">, welcome</w:t></w:r>',
+    ]
+
+
+def test_several_placeholders_and_non_text_children_in_one_run():
+    inner = f'<w:r>{BOLD}<w:t>{{a}}</w:t><w:tab/><w:t>x{{b}}</w:t></w:r>'
+
+    assert _shape(docx_renderer._parse_paragraph(inner)) == [
+        ('{a}', BOLD),
+        f'<w:r>{BOLD}<w:tab/><w:t xml:space="preserve">x</w:t></w:r>',
+        ('{b}', BOLD),
+    ]
+
+
+def test_non_text_children_inside_a_placeholder_are_kept_after_it():
+    inner = f'<w:r>{BOLD}<w:t>Hi {{ibo_</w:t><w:br/><w:t>name}} there</w:t></w:r>'
+
+    assert _shape(docx_renderer._parse_paragraph(inner)) == [
+        f'<w:r>{BOLD}<w:t xml:space="preserve">Hi </w:t></w:r>',
+        ('{ibo_name}', BOLD),
+        f'<w:r>{BOLD}<w:br/><w:t xml:space="preserve"> there</w:t></w:r>',
+    ]
+
+
+def test_self_closing_paragraphs_and_runs_are_skipped():
+    document_xml = (
+        '<w:body><w:p/><w:p w:rsidR="00AB"/>'
+        '<w:p><w:r/><w:r><w:t>Dear {ibo_name}</w:t></w:r><w:r w:rsidR="00CD"/></w:p>'
+        '</w:body>'
+    )
+
+    rendered, _ = _render(document_xml, {}, {'{ibo_name}': 'Ann'})
+
+    assert rendered == (
+        '<w:body><w:p/><w:p w:rsidR="00AB"/>'
+        '<w:p><w:r/><w:r><w:t xml:space="preserve">Dear </w:t></w:r><w:r><w:t xml:space="preserve">Ann</w:t></w:r>'
+        '<w:r w:rsidR="00CD"/></w:p>'
+        '</w:body>'
+    )
+
+
+def test_text_box_paragraphs_are_filled_in_place():
+    text_box = (
+        '<mc:AlternateContent><mc:Choice Requires="wps"><w:drawing><wps:txbx><w:txbxContent>'
+        '<w:p><w:r><w:t>ID {ibo_id}</w:t></w:r></w:p>'
+        '</w:txbxContent></wps:txbx></w:drawing></mc:Choice></mc:AlternateContent>'
+    )
+    document_xml = (
+        f'<w:body><w:p><w:r><w:t>Hi {{ibo_</w:t></w:r><w:r>{text_box}</w:r><w:r><w:t>name}}!</w:t></w:r></w:p>'
+        '<w:p><w:r><w:t>{nickname}</w:t></w:r></w:p></w:body>'
+    )
+
+    rendered, _ = _render(document_xml, {}, {'{ibo_name}': 'Ann', '{ibo_id}': '42', '{nickname}': 'Annie'})
+
+    assert rendered == (
+        '<w:body><w:p><w:r><w:t xml:space="preserve">Hi </w:t></w:r><w:r><w:t xml:space="preserve">Ann</w:t></w:r>'
+        '<w:r><mc:AlternateContent><mc:Choice Requires="wps"><w:drawing><wps:txbx><w:txbxContent>'
+        '<w:p><w:r><w:t xml:space="preserve">ID </w:t></w:r><w:r><w:t xml:space="preserve">42</w:t></w:r></w:p>'
+        '</w:txbxContent></wps:txbx></w:drawing></mc:Choice></mc:AlternateContent></w:r>'
+        '<w:r><w:t xml:space="preserve">!</w:t></w:r></w:p>'
+        '<w:p><w:r><w:t xml:space="preserve">Annie</w:t></w:r></w:p></w:body>'
+    )
+
+
+def test_render_fills_placeholders():
+    document_xml = (
+        '<w:document><w:body>'
+        '<w:p><w:r><w:t xml:space="preserve">\U0001F600 Dear {ibo_</w:t></w:r><w:r><w:t>name},</w:t></w:r></w:p>'
+        '<w:p><w:r><w:t>See {service_link} {nickname}.</w:t></w:r></w:p>'
+        '<w:p><w:r><w:t>Static &amp; untouched</w:t></w:r></w:p>'
+        '</w:body></w:document>'
+    )
+
+    rendered, rels = _render(
+        document_xml, {'{service_link}': LINK}, {'{ibo_name}': 'Zoë & \U0001F680', '{nickname}': ''}
+    )
+
+    assert _paragraph_texts(rendered) == [
+        '\U0001F600 Dear Zoë &amp; \U0001F680,', 'See Click here .', 'Static &amp; untouched',
+    ]
+    assert '<w:hyperlink r:id="rIdGdoc1" w:history="1"><w:r><w:rPr><w:rStyle w:val="Hyperlink"/><w:b/></w:rPr>' in rendered
+    assert f'Id="rIdGdoc1" Type="{docx_renderer.HYPERLINK_REL}" Target="{LINK.replace("&", "&amp;")}"' in rels
+
+
+def test_render_keeps_unknown_placeholders():
+    rendered, rels = _render('<w:p><w:r><w:t>Hi {other}</w:t></w:r></w:p>', {}, {})
+
+    assert _paragraph_texts(rendered) == ['Hi {other}']
+    assert rels == '<Relationships></Relationships>'
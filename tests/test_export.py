@@ -0,0 +1,95 @@
+import pytest
+
+import ibo_documents
+
+SHOP_LINKS = [f'https://shop.example/{index}' for index in range(21)]
+
+
+# A Google API request that returns a fixed result
+class _Request:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+# Drive exports the document's current content; Docs applies batchUpdates by recording them
+class FakeGoogle:
+    def __init__(self):
+        self.content = b'%PDF-1.7 first version'
+        self.exports = []
+        self.batches = []
+
+    def files(self):
+        return self
+
+    def documents(self):
+        return self
+
+    def export(self, fileId, mimeType):
+        self.exports.append((fileId, mimeType))
+        return _Request(self.content)
+
+    def batchUpdate(self, documentId, body):
+        self.batches.append((documentId, body['requests']))
+        return _Request({})
+
+
+@pytest.fixture
+def google(app_module, tmp_path, monkeypatch):
+    app = app_module
+    fake = FakeGoogle()
+    monkeypatch.setattr(app.export_cache, 'EXPORT_DIR', str(tmp_path / 'exports'))
+    monkeypatch.setattr(app.google_clients, 'drive_service', lambda creds, identity='default': fake)
+    monkeypatch.setattr(app.google_clients, 'docs_service', lambda creds, identity='default': fake)
+    link_ranges = [{'tag': '{flash_mobile}', 'segment_id': None, 'start': 10, 'end': 20}]
+    ibo_documents.save('7', 'doc-1', 'Ann', 'hash', app.build_tag_to_link(SHOP_LINKS), link_ranges)
+    return fake
+
+
+def test_export_is_made_once_and_revalidated_by_etag(client, google):
+    first = client.get('/docs/doc-1/export?format=pdf')
+    assert first.status_code == 200
+    assert first.data == google.content
+    assert first.headers['Content-Disposition'] == 'attachment; filename=7.pdf'
+    assert first.headers['Accept-Ranges'] == 'bytes'
+    etag = first.headers['ETag']
+
+    again = client.get('/docs/doc-1/export?format=pdf', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+    assert len(google.exports) == 1
+
+
+def test_range_request_gets_part_of_the_export(client, google):
+    response = client.get('/docs/doc-1/export', headers={'Range': 'bytes=0-7'})
+
+    assert response.status_code == 206
+    assert response.data == google.content[:8]
+    assert response.headers['Content-Range'] == f'bytes 0-7/{len(google.content)}'
+
+
+def test_updated_document_is_exported_again(app_module, client, google):
+    first = client.get('/docs/doc-1/export')
+    google.content = b'%PDF-1.7 second version'
+
+    links = list(SHOP_LINKS)
+    links[0] = 'https://shop.example/new'
+    app_module.update_document({'ibo_id': '7', 'ibo_name': 'Ann', 'shop_links': links})
+    assert [requests[0]['updateTextStyle']['textStyle']['link']['url'] for _, requests in google.batches] == [
+        'https://shop.example/new'
+    ]
+
+    # The old ETag no longer matches: the client gets the new export
+    second = client.get('/docs/doc-1/export', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    assert second.data == google.content
+    assert second.headers['ETag'] != first.headers['ETag']
+    assert len(google.exports) == 2
+
+
+def test_unknown_document_or_format(client, google):
+    assert client.get('/docs/doc-2/export').status_code == 404
+    assert client.get('/docs/doc-1/export?format=odt').status_code == 400
+    assert google.exports == []
@@ -0,0 +1,135 @@
+import threading
+import time
+
+import pytest
+
+import job_queue
+
+
+def _age(db, job_id, **columns):
+    for column, seconds in columns.items():
+        db.execute(f'UPDATE jobs SET {column} = ? WHERE id = ?', (time.time() - seconds, job_id))
+
+
+def test_concurrent_workers_claim_each_job_once(db):
+    job_ids = [job_queue.enqueue({'n': n}) for n in range(40)]
+    claimed = []
+    lock = threading.Lock()
+
+    def work(worker):
+        while True:
+            job = job_queue.claim(worker)
+            if job is None:
+                return
+            with lock:
+                claimed.append(job[0])
+
+    threads = [threading.Thread(target=work, args=(f'w{n}',)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(job_ids)
+    assert job_queue.backlog() == {'queued': 0, 'running': 40}
+
+
+def test_stale_running_job_is_claimed_again(db):
+    job_id = job_queue.enqueue({'n': 1})
+    assert job_queue.claim('lost')[0] == job_id
+    assert job_queue.claim('other') is None
+
+    _age(db, job_id, updated_at=job_queue.STALE_AFTER + 1)
+    assert job_queue.claim('other') == (job_id, {'n': 1})
+    job = job_queue.get(job_id)
+    assert (job['worker'], job['attempts']) == ('other', 2)
+
+
+def test_transient_failure_is_retried_after_run_after(db, monkeypatch):
+    monkeypatch.setattr(job_queue.rate_scheduler, 'backoff_delay', lambda attempt, error=None: 60)
+    job_id = job_queue.enqueue({'n': 1})
+    job_queue.claim('w')
+
+    assert job_queue.retry(job_id, ConnectionError('reset'))
+    job = job_queue.get(job_id)
+    assert (job['status'], job['error']) == ('queued', 'reset')
+    assert job_queue.claim('w') is None
+
+    _age(db, job_id, run_after=1)
+    assert job_queue.claim('w')[0] == job_id
+    job_queue.complete(job_id, 'https://docs.example/1')
+    job = job_queue.get(job_id)
+    assert (job['status'], job['error'], job['attempts']) == ('done', None, 2)
+
+
+def test_job_fails_for_good_after_max_attempts(db, monkeypatch):
+    monkeypatch.setattr(job_queue, 'MAX_ATTEMPTS', 2)
+    monkeypatch.setattr(job_queue.rate_scheduler, 'backoff_delay', lambda attempt, error=None: 0)
+    job_id = job_queue.enqueue({'n': 1})
+
+    job_queue.claim('w')
+    assert job_queue.retry(job_id, TimeoutError('slow'))
+    job_queue.claim('w')
+    assert not job_queue.retry(job_id, TimeoutError('slow'))
+
+    # A job abandoned by its worker on the last attempt fails instead of running again
+    _age(db, job_id, updated_at=job_queue.STALE_AFTER + 1)
+    assert job_queue.claim('w') is None
+    job = job_queue.get(job_id)
+    assert (job['status'], job['error']) == ('failed', 'Job was abandoned too many times.')
+
+
+def test_worker_retries_only_errors_the_pipeline_left_to_it(db, monkeypatch):
+    monkeypatch.setattr(job_queue.rate_scheduler, 'backoff_delay', lambda attempt, error=None: 0)
+    errors = {
+        'timeout': job_queue.pipeline.StageTimeout('slow'),
+        # Already retried by the pipeline with new documents
+        'server': ConnectionError('reset'),
+        'permanent': ValueError('bad data'),
+    }
+    for error in errors:
+        job_queue.enqueue({'error': error})
+    calls = []
+
+    def handler(payload, progress):
+        calls.append(payload['error'])
+        raise errors[payload['error']]
+
+    # Run the worker loop here until the queue is empty
+    class Idle(BaseException):
+        pass
+
+    claim = job_queue.claim
+
+    def claim_until_idle(worker):
+        job = claim(worker)
+        if job is None:
+            raise Idle
+        return job
+
+    monkeypatch.setattr(job_queue, 'claim', claim_until_idle)
+    with pytest.raises(Idle):
+        job_queue._worker_loop(handler, 'w')
+
+    assert {error: calls.count(error) for error in errors} == {
+        'timeout': job_queue.MAX_ATTEMPTS, 'server': 1, 'permanent': 1
+    }
+    statuses = {row['payload']: (row['status'], row['attempts']) for row in db.execute('SELECT * FROM jobs')}
+    assert statuses == {
+        '{"error": "timeout"}': ('failed', job_queue.MAX_ATTEMPTS),
+        '{"error": "server"}': ('failed', 1),
+        '{"error": "permanent"}': ('failed', 1),
+    }
+
+
+def test_prune_deletes_only_finished_jobs_past_retention(db):
+    done, failed, recent, queued = (job_queue.enqueue({'n': n}) for n in range(4))
+    job_queue.complete(done, 'https://docs.example/1')
+    job_queue.fail(failed, 'bad data')
+    job_queue.complete(recent, 'https://docs.example/2')
+    for job_id in (done, failed):
+        _age(db, job_id, finished_at=job_queue.RETENTION_HOURS * 3600 + 1)
+    _age(db, queued, created_at=job_queue.RETENTION_HOURS * 3600 + 1)
+
+    assert job_queue.prune() == 2
+    assert [job_queue.get(job_id) is not None for job_id in (done, failed, recent, queued)] == [False, False, True, True]
@@ -0,0 +1,55 @@
+import ibo_documents
+import idempotency
+import lifecycle
+
+
+def _create(document_id, key, links):
+    previous = ibo_documents.get(7)
+    idempotency.remember(key, '7', document_id)
+    ibo_documents.save(7, document_id, 'Ann', 'hash', links, None, 'default')
+    lifecycle.record(document_id, 'default', 7, previous)
+
+
+def _superseded(db):
+    return {
+        row['document_id']: row['superseded_at'] is not None
+        for row in db.execute('SELECT document_id, superseded_at FROM document_lifecycle')
+    }
+
+
+def test_record_supersedes_earlier_documents(db):
+    _create('doc-1', 'key-1', {'{spectrum}': 'https://a'})
+    _create('doc-2', 'key-2', {'{spectrum}': 'https://b'})
+
+    assert _superseded(db) == {'doc-1': True, 'doc-2': False}
+    # The superseded document no longer answers repeated requests
+    assert idempotency.lookup('key-1') is None
+    assert idempotency.lookup('key-2') == 'doc-2'
+
+
+def test_unrecord_makes_the_replaced_document_current_again(db, monkeypatch):
+    _create('doc-1', 'key-1', {'{spectrum}': 'https://a'})
+    _create('doc-2', 'key-2', {'{spectrum}': 'https://b'})
+
+    lifecycle.unrecord('doc-2')
+
+    assert _superseded(db) == {'doc-1': False}
+    record = ibo_documents.get(7)
+    assert (record['document_id'], record['tag_to_link']) == ('doc-1', {'{spectrum}': 'https://a'})
+    assert idempotency.lookup('key-1') == 'doc-1'
+    assert idempotency.lookup('key-2') is None
+    # Nothing is left for expiry to delete
+    monkeypatch.setattr(lifecycle, 'SUPERSEDED_RETENTION_DAYS', 0)
+    assert lifecycle._expired(10) == []
+
+
+def test_unrecord_of_a_superseded_document_leaves_the_current_one(db):
+    _create('doc-1', 'key-1', {'{spectrum}': 'https://a'})
+    _create('doc-2', 'key-2', {'{spectrum}': 'https://b'})
+    _create('doc-3', 'key-3', {'{spectrum}': 'https://c'})
+
+    lifecycle.unrecord('doc-2')
+
+    assert _superseded(db) == {'doc-1': True, 'doc-3': False}
+    assert ibo_documents.get(7)['document_id'] == 'doc-3'
+    assert idempotency.lookup('key-1') is None
@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+import pipeline
+from pipeline import Stage
+
+
+def test_stages_run_after_their_dependencies():
+    events = []
+    lock = threading.Lock()
+
+    def stage(name, result):
+        def fn(*args):
+            with lock:
+                events.append((name, args))
+            return result
+        return fn
+
+    stages = [
+        Stage('personalize', stage('personalize', 'done'), deps=('layout', 'document')),
+        Stage('layout', stage('layout', 'L')),
+        Stage('document', stage('document', 'doc-1')),
+        Stage('share', stage('share', 'shared'), deps=('document',)),
+    ]
+
+    assert pipeline.run(stages) == {
+        'layout': 'L', 'document': 'doc-1', 'personalize': 'done', 'share': 'shared'
+    }
+    order = [name for name, _ in events]
+    assert order.index('personalize') > max(order.index('layout'), order.index('document'))
+    assert order.index('share') > order.index('document')
+    # Each stage receives its dependencies' results in the order it lists them
+    assert dict(events)['personalize'] == ('L', 'doc-1')
+    assert dict(events)['share'] == ('doc-1',)
+
+
+def test_failed_stage_cancels_the_stages_waiting_for_it():
+    ran = []
+
+    def fail():
+        raise ValueError('bad template')
+
+    stages = [
+        Stage('layout', fail),
+        Stage('personalize', lambda layout: ran.append('personalize'), deps=('layout',)),
+        Stage('share', lambda layout: ran.append('share'), deps=('personalize',)),
+    ]
+
+    with pytest.raises(ValueError):
+        pipeline.run(stages)
+    assert ran == []
+
+
+def test_unknown_dependency_is_an_error():
+    with pytest.raises(ValueError):
+        pipeline.run([Stage('share', lambda document_id: None, deps=('document',))])
+
+
+def test_created_document_is_abandoned_when_a_later_stage_fails():
+    abandoned = []
+
+    def fail(document_id):
+        raise ConnectionError('reset')
+
+    stages = [
+        Stage('document', lambda: 'doc-1', on_abandon=abandoned.append),
+        Stage('personalize', fail, deps=('document',)),
+    ]
+
+    with pytest.raises(ConnectionError):
+        pipeline.run(stages)
+    assert abandoned == ['doc-1']
+
+
+def test_document_created_after_a_timeout_is_abandoned_when_it_arrives():
+    release = threading.Event()
+    abandoned = []
+    cleaned_up = threading.Event()
+
+    def slow_copy():
+        release.wait(5)
+        return 'doc-2'
+
+    def discard(document_id):
+        abandoned.append(document_id)
+        cleaned_up.set()
+
+    stages = [Stage('document', slow_copy, timeout=0.05, on_abandon=discard)]
+
+    with pytest.raises(pipeline.StageTimeout):
+        pipeline.run(stages)
+    # The pipeline gave up before the copy finished; the copy is only deleted once it exists
+    assert abandoned == []
+    release.set()
+    assert cleaned_up.wait(5)
+    assert abandoned == ['doc-2']
+
+
+def test_stage_still_running_after_a_timeout_stops_at_its_next_check():
+    release = threading.Event()
+    stopped = threading.Event()
+
+    def slow_stage():
+        release.wait(5)
+        try:
+            pipeline.check_cancelled()
+        except pipeline.StageCancelled:
+            stopped.set()
+            raise
+
+    with pytest.raises(pipeline.StageTimeout):
+        pipeline.run([Stage('personalize', slow_stage, timeout=0.05)])
+    release.set()
+    assert stopped.wait(5)
+
+
+def test_finished_pipeline_abandons_nothing():
+    abandoned = []
+
+    assert pipeline.run([Stage('document', lambda: 'doc-1', on_abandon=abandoned.append)]) == {'document': 'doc-1'}
+    assert abandoned == []
@@ -0,0 +1,151 @@
+import socket
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import rate_scheduler
+
+
+# Stands in for the time module: sleeping moves the clock instead of blocking. Like a real
+# sleep, even the shortest one lets some time pass.
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 1e-6)
+
+
+@pytest.fixture
+def clock(db, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_scheduler, 'time', clock)
+    # 6 calls per minute (one token every 10 s) per identity, 8 for the project
+    monkeypatch.setenv('GDOC_QUOTA_DOCS_WRITE', '6')
+    monkeypatch.setenv('GDOC_PROJECT_QUOTA_DOCS_WRITE', '8')
+    monkeypatch.setattr(rate_scheduler, 'BULK_RESERVE', 0.25)
+    return clock
+
+
+def _error(status, **headers):
+    return HttpError(httplib2.Response({'status': status, **headers}), b'{}')
+
+
+# A Google call failing with the given errors first, then returning 'ok'
+def _flaky(*errors):
+    calls = []
+
+    def fn():
+        calls.append(rate_scheduler.time.time())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'ok'
+    return fn, calls
+
+
+def test_identity_bucket_is_spent_and_refills(clock):
+    assert [rate_scheduler.acquire('docs', 'write') for _ in range(6)] == [0] * 6
+    assert rate_scheduler.headroom('default', [('docs', 'write')]) == 0
+
+    # The next token arrives 10 s later
+    assert rate_scheduler.acquire('docs', 'write') == pytest.approx(10)
+    clock.sleep(30)
+    assert rate_scheduler.headroom('default', [('docs', 'write')]) == pytest.approx(0.5)
+    # Refilling stops at the bucket's capacity
+    clock.sleep(3600)
+    assert rate_scheduler.headroom('default', [('docs', 'write')]) == 1
+    assert rate_scheduler.usage('default')['docs.write']['calls'] == 7
+
+
+def test_project_bucket_is_shared_by_identities(clock):
+    with rate_scheduler.identity('a'):
+        assert [rate_scheduler.acquire('docs', 'write') for _ in range(6)] == [0] * 6
+    with rate_scheduler.identity('b'):
+        assert [rate_scheduler.acquire('docs', 'write') for _ in range(2)] == [0] * 2
+        # b has quota left, the project has none: one project token every 7.5 s
+        assert rate_scheduler.acquire('docs', 'write') == pytest.approx(7.5)
+
+
+def test_bulk_leaves_a_reserve_for_interactive_calls(clock):
+    with rate_scheduler.priority('bulk'):
+        assert [rate_scheduler.acquire('docs', 'write') for _ in range(4)] == [0] * 4
+        # A quarter of the identity's 6 tokens is kept back from bulk work
+        assert rate_scheduler._try_acquire([('default:docs:write', 6, 0.1)], 1, True) > 0
+    # Interactive calls still get the reserve right away
+    assert [rate_scheduler.acquire('docs', 'write') for _ in range(2)] == [0] * 2
+
+
+def test_bulk_call_larger_than_the_reserve_allows_still_runs(clock):
+    with rate_scheduler.priority('bulk'):
+        # Costing the whole bucket, it can only wait for a full bucket rather than forever
+        assert rate_scheduler.acquire('docs', 'write', cost=6) == 0
+        assert rate_scheduler.acquire('docs', 'write', cost=6) == pytest.approx(60)
+
+
+def test_rate_limited_call_empties_the_bucket_and_is_retried(clock, monkeypatch):
+    monkeypatch.setattr(rate_scheduler, 'backoff_delay', lambda attempt, error=None: 1)
+    fn, calls = _flaky(_error(429))
+
+    assert rate_scheduler.call(fn, 'docs', 'write') == 'ok'
+    assert len(calls) == 2
+    # After the 429 every worker waits for a fresh token: 1 s of backoff, then 9 s more
+    assert calls[1] - calls[0] == pytest.approx(10)
+    assert rate_scheduler.usage('default')['docs.write']['throttled'] == 1
+
+
+def test_drain_empties_only_the_current_identity(clock):
+    with rate_scheduler.identity('a'):
+        rate_scheduler.drain('docs', 'write')
+    assert rate_scheduler.headroom('a', [('docs', 'write')]) == 0
+    assert rate_scheduler.headroom('b', [('docs', 'write')]) == 1
+
+
+def test_non_idempotent_write_is_not_retried_after_a_server_error(clock):
+    fn, calls = _flaky(_error(503))
+    with pytest.raises(HttpError):
+        rate_scheduler.call(fn, 'drive', 'write', safe_to_retry=False)
+    assert len(calls) == 1
+
+    fn, calls = _flaky(ConnectionError('reset'))
+    with pytest.raises(ConnectionError):
+        rate_scheduler.call(fn, 'drive', 'write', safe_to_retry=False)
+    assert len(calls) == 1
+
+
+def test_non_idempotent_write_is_retried_when_rate_limited(clock):
+    # Google did not apply a call it rejected for rate limiting, so it can be sent again
+    fn, calls = _flaky(_error(429))
+    assert rate_scheduler.call(fn, 'drive', 'write', safe_to_retry=False) == 'ok'
+    assert len(calls) == 2
+
+
+def test_idempotent_call_is_retried_until_max_retries(clock, monkeypatch):
+    monkeypatch.setattr(rate_scheduler, 'MAX_RETRIES', 2)
+    fn, calls = _flaky(_error(503), socket.timeout('slow'))
+    assert rate_scheduler.call(fn, 'drive', 'read') == 'ok'
+    assert len(calls) == 3
+
+    fn, calls = _flaky(_error(503), _error(500), _error(502))
+    with pytest.raises(HttpError):
+        rate_scheduler.call(fn, 'drive', 'read')
+    assert len(calls) == 3
+
+    fn, calls = _flaky(_error(404))
+    with pytest.raises(HttpError):
+        rate_scheduler.call(fn, 'drive', 'read')
+    assert len(calls) == 1
+
+
+def test_backoff_delay(monkeypatch):
+    monkeypatch.setattr(rate_scheduler, 'BACKOFF_BASE', 1)
+    monkeypatch.setattr(rate_scheduler, 'BACKOFF_CAP', 32)
+    assert rate_scheduler.backoff_delay(0, _error(429, **{'retry-after': '7'})) == 7
+    for attempt in range(10):
+        assert 0 <= rate_scheduler.backoff_delay(attempt) <= min(32, 2 ** attempt)